@@ -0,0 +1,332 @@
+#!/usr/bin/python3
+"""
+Benchmark of the lolpig generator pipeline
+
+Synthesizes annotated C++ sources, doxygen xml and python modules of
+configurable size and times each stage of the generator separately.
+The results are printed (or written) as JSON.
+
+Usage: bench_generator.py [--functions N] [--classes M] [--methods K]
+                          [--properties P] [--depth D] [--scale 1 2 4]
+                          [--repeat R] [-o result.json]
+"""
+import os, sys, io, json, time, shutil, tempfile, argparse, platform, contextlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import liblolpig
+from liblolpig import Context, Class, Function, Argument, Renderer, DoxygenParser
+
+
+class Spec:
+    """Size of the synthesized module"""
+    def __init__(self, functions=100, classes=20, methods=10, properties=4, depth=2):
+        self.functions = functions
+        self.classes = classes
+        self.methods = methods
+        self.properties = properties
+        self.depth = depth
+
+    def scaled(self, factor):
+        return Spec(self.functions * factor, self.classes * factor,
+                    self.methods, self.properties, self.depth)
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+    def base_index(self, i):
+        """Index of the base class of class i, or None.
+        Classes form chains of length depth"""
+        if self.depth > 1 and i % self.depth:
+            return i - 1
+        return None
+
+
+# --- synthesized inputs ---
+
+METHOD_TYPES = [
+    ("PyObject*", [("PyObject*", "self"), ("PyObject*", "args")]),
+    ("PyObject*", [("PyObject*", "self"), ("PyObject*", "args"), ("PyObject*", "kwargs")]),
+    ("PyObject*", [("PyObject*", "self")]),
+]
+
+
+def _method_sig(i):
+    return METHOD_TYPES[i % len(METHOD_TYPES)]
+
+
+def make_context(spec):
+    """Returns an unfinalized Context, as created by the parsers"""
+    ctx = Context()
+    ctx.module_name = "bench"
+    ctx.header_name = "bench_module.h"
+
+    def func(py_name, c_name, ret, args):
+        f = Function()
+        f.py_name, f.c_name, f.c_return_type = py_name, c_name, ret
+        f.py_doc = "Documentation of %s" % py_name
+        f.namespaces = ["BENCH"]
+        for t, n in args:
+            a = Argument(t, n)
+            f.arguments.append(a)
+        return f
+
+    for i in range(spec.functions):
+        ret, args = _method_sig(i)
+        ctx.functions.append(func("func%d" % i, "bench_func%d" % i, ret, args))
+
+    for i in range(spec.classes):
+        c = Class()
+        c.py_name, c.c_name = "Class%d" % i, "BenchClass%d" % i
+        c.py_doc = "Documentation of Class%d" % i
+        c.namespaces = ["BENCH"]
+        c.id = c.c_name
+        for j in range(spec.methods):
+            ret, args = _method_sig(j)
+            c.methods.append(func("Class%d.method%d" % (i, j), "class%d_method%d" % (i, j), ret, args))
+        for j in range(spec.properties):
+            g = func("Class%d.prop%d" % (i, j), "class%d_get_prop%d" % (i, j),
+                     "PyObject*", [("PyObject*", "self"), ("void*", "closure")])
+            g.is_property = True
+            s = func("Class%d.prop%d" % (i, j), "class%d_set_prop%d" % (i, j),
+                     "int", [("PyObject*", "self"), ("PyObject*", "value"), ("void*", "closure")])
+            s.is_property = s.is_setter = True
+            c.methods += [g, s]
+        b = spec.base_index(i)
+        if b is not None:
+            c.bases.append(ctx.classes[b])
+        ctx.classes.append(c)
+    return ctx
+
+
+def write_cpp_source(spec, filename):
+    """Writes a doxygen-annotated C++ file declaring the module"""
+    code = "#include <Python.h>\n\nnamespace BENCH {\n\n/** @addtogroup lolpig\n    @{ */\n\n"
+    for i in range(spec.classes):
+        b = spec.base_index(i)
+        code += "/** @p Class%d\n    Documentation of Class%d */\n" % (i, i)
+        code += "struct BenchClass%d%s { %s };\n\n" % (
+            i, " : public BenchClass%d" % b if b is not None else "",
+            "PyObject_HEAD double v;" if b is None else "")
+    for i in range(spec.functions):
+        code += _cpp_function("func%d" % i, "bench_func%d" % i, *_method_sig(i))
+    for i in range(spec.classes):
+        for j in range(spec.methods):
+            code += _cpp_function("Class%d.method%d" % (i, j), "class%d_method%d" % (i, j), *_method_sig(j))
+        for j in range(spec.properties):
+            code += _cpp_function("Class%d.prop%d-get" % (i, j), "class%d_get_prop%d" % (i, j),
+                                  "PyObject*", [("PyObject*", "self"), ("void*", "closure")])
+            code += _cpp_function("Class%d.prop%d-set" % (i, j), "class%d_set_prop%d" % (i, j),
+                                  "int", [("PyObject*", "self"), ("PyObject*", "value"), ("void*", "closure")])
+    code += "/** @} */\n\n} // namespace BENCH\n"
+    with open(filename, "w") as f:
+        f.write(code)
+
+
+def _cpp_function(py_name, c_name, ret, args):
+    return "/** @p %s\n    Documentation of %s */\n%s %s(%s) { return 0; }\n\n" % (
+        py_name, py_name, ret, c_name, ", ".join("%s %s" % a for a in args))
+
+
+def write_doxygen_xml(spec, xml_dir):
+    """Writes the xml which doxygen would create for write_cpp_source()"""
+    os.makedirs(xml_dir, exist_ok=True)
+    members = []
+    for i in range(spec.functions):
+        members.append(_xml_function("func%d" % i, "bench_func%d" % i, *_method_sig(i)))
+    for i in range(spec.classes):
+        for j in range(spec.methods):
+            members.append(_xml_function("Class%d.method%d" % (i, j), "class%d_method%d" % (i, j),
+                                         *_method_sig(j)))
+        for j in range(spec.properties):
+            members.append(_xml_function("Class%d.prop%d-get" % (i, j), "class%d_get_prop%d" % (i, j),
+                                         "PyObject*", [("PyObject*", "self"), ("void*", "closure")]))
+            members.append(_xml_function("Class%d.prop%d-set" % (i, j), "class%d_set_prop%d" % (i, j),
+                                         "int", [("PyObject*", "self"), ("PyObject*", "value"),
+                                                 ("void*", "closure")]))
+    inner = "".join('<innerclass refid="structBENCH_1_1BenchClass%d">BENCH::BenchClass%d</innerclass>\n'
+                    % (i, i) for i in range(spec.classes))
+    with open(os.path.join(xml_dir, "group__lolpig.xml"), "w") as f:
+        f.write('<?xml version="1.0"?>\n<doxygenindex><compounddef kind="group" id="group__lolpig">\n'
+                '<compoundname>lolpig</compoundname>\n%s<sectiondef kind="func">\n%s</sectiondef>\n'
+                '</compounddef></doxygenindex>\n' % (inner, "".join(members)))
+    for i in range(spec.classes):
+        b = spec.base_index(i)
+        base = '<basecompoundref refid="structBENCH_1_1BenchClass%d">BenchClass%d</basecompoundref>' % (b, b) \
+            if b is not None else ""
+        with open(os.path.join(xml_dir, "structBENCH_1_1BenchClass%d.xml" % i), "w") as f:
+            f.write('<?xml version="1.0"?>\n<doxygen><compounddef kind="struct" id="structBENCH_1_1BenchClass%d">'
+                    '<compoundname>BENCH::BenchClass%d</compoundname>%s<briefdescription></briefdescription>'
+                    '<detaileddescription><para><computeroutput>Class%d</computeroutput> Documentation of Class%d'
+                    '</para></detaileddescription><location file="bench.cpp" line="%d"/></compounddef></doxygen>\n'
+                    % (i, i, base, i, i, i + 1))
+
+
+def _xml_function(py_name, c_name, ret, args):
+    params = "".join("<param><type>%s</type><declname>%s</declname></param>" % a for a in args)
+    return ('<memberdef kind="function" id="%s"><type>%s</type><definition>%s BENCH::%s</definition>'
+            '<name>%s</name>%s<briefdescription></briefdescription><detaileddescription><para>'
+            '<computeroutput>%s</computeroutput> Documentation of %s</para></detaileddescription>'
+            '<location file="bench.cpp" line="1"/></memberdef>\n'
+            % (c_name, ret, ret, c_name, c_name, params, py_name, py_name))
+
+
+def write_python_module(spec, filename):
+    """Writes a python module for the export stage"""
+    code = ""
+    for i in range(spec.functions):
+        code += "def func%d(a, b=1, *args, **kwargs):\n    \"\"\"Documentation of func%d\"\"\"\n    pass\n\n" % (i, i)
+    for i in range(spec.classes):
+        b = spec.base_index(i)
+        code += "class Class%d%s:\n    \"\"\"Documentation of Class%d\"\"\"\n" % (
+            i, "(Class%d)" % b if b is not None else "", i)
+        for j in range(spec.methods):
+            code += "    def method%d_%d(self, a, b=2):\n        \"\"\"Documentation\"\"\"\n        pass\n" % (i, j)
+        for j in range(spec.properties):
+            code += "    @property\n    def prop%d_%d(self):\n        return 0\n" % (i, j)
+        code += "    pass\n\n"
+    with open(filename, "w") as f:
+        f.write(code)
+
+
+# --- timing ---
+
+class Timer:
+    """Collects the timings of the stages"""
+    def __init__(self, repeat):
+        self.repeat = repeat
+        self.stages = dict()
+
+    def run(self, name, func, setup=None):
+        """Times func(setup()) repeat times, setup is not timed"""
+        times = []
+        for i in range(self.repeat):
+            arg = setup() if setup else None
+            with contextlib.redirect_stdout(io.StringIO()):
+                start = time.perf_counter()
+                func(arg)
+                times.append(time.perf_counter() - start)
+        self.stages[name] = {
+            "min": min(times),
+            "mean": sum(times) / len(times),
+            "runs": len(times),
+        }
+
+    def skip(self, name, reason):
+        self.stages[name] = {"skipped": reason}
+
+
+def run_benchmark(spec, repeat):
+    timer = Timer(repeat)
+    with tempfile.TemporaryDirectory() as tmp:
+        cpp_file = os.path.join(tmp, "bench.cpp")
+        xml_dir = os.path.join(tmp, "xml")
+        py_file = os.path.join(tmp, "bench_export.py")
+        write_cpp_source(spec, cpp_file)
+        write_doxygen_xml(spec, xml_dir)
+        write_python_module(spec, py_file)
+
+        # front ends
+        def parse_xml(arg):
+            p = DoxygenParser()
+            p._parse_xml_dir(xml_dir)
+            p._resolve_bases()
+            p.as_context()
+        timer.run("doxygen_xml", parse_xml)
+
+        if shutil.which("doxygen"):
+            def parse_doxygen(arg):
+                p = DoxygenParser()
+                p.parse_files([cpp_file])
+                p.as_context()
+            timer.run("doxygen", parse_doxygen)
+        else:
+            timer.skip("doxygen", "doxygen not installed")
+
+        if shutil.which("gccxml"):
+            from liblolpig import XmlParser
+            def parse_gccxml(arg):
+                p = XmlParser()
+                p.parse(cpp_file)
+                p.as_context()
+            timer.run("gccxml", parse_gccxml)
+        else:
+            timer.skip("gccxml", "gccxml not installed")
+
+        # context and renderer
+        timer.run("context_finalize", lambda ctx: ctx.finalize(), lambda: make_context(spec))
+        ctx = make_context(spec)
+        ctx.finalize()
+
+        def renderer():
+            r = Renderer(ctx)
+            r.namespaces = ["BENCH"]
+            r.is_timestamp = False
+            return r
+        timer.run("render_hpp", lambda r: r.render_hpp(), renderer)
+        timer.run("render_cpp", lambda r: r.render_cpp(), renderer)
+
+        r = renderer()
+        hpp, cpp = r.render_hpp(), r.render_cpp()
+        out = os.path.join(tmp, "out")
+
+        def remove_outputs():
+            for fn in (out + ".h", out + ".cpp"):
+                if os.path.exists(fn):
+                    os.remove(fn)
+        timer.run("write_files", lambda arg: (Renderer.write_to_file(out + ".h", hpp),
+                                              Renderer.write_to_file(out + ".cpp", cpp)), remove_outputs)
+        timer.run("write_files_unchanged", lambda arg: (Renderer.write_to_file(out + ".h", hpp),
+                                                        Renderer.write_to_file(out + ".cpp", cpp)))
+
+        # python -> cpp
+        from liblolpig.export import scan_module_files
+        timer.run("export_scan", lambda arg: scan_module_files([py_file]))
+        with contextlib.redirect_stdout(io.StringIO()):
+            export_ctx = scan_module_files([py_file])
+
+        def export_renderer():
+            r = Renderer(export_ctx)
+            r.namespaces = ["BENCH"]
+            r.is_timestamp = False
+            return r
+        timer.run("render_export", lambda r: r.render_export(), export_renderer)
+
+    return {
+        "spec": spec.as_dict(),
+        "output_size": {"hpp": len(hpp), "cpp": len(cpp)},
+        "stages": timer.stages,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the lolpig generator pipeline")
+    parser.add_argument("--functions", type=int, default=100, help="number of global functions")
+    parser.add_argument("--classes", type=int, default=20, help="number of classes")
+    parser.add_argument("--methods", type=int, default=10, help="methods per class")
+    parser.add_argument("--properties", type=int, default=4, help="properties per class")
+    parser.add_argument("--depth", type=int, default=2, help="length of the inheritance chains")
+    parser.add_argument("--scale", type=int, nargs="+", default=[1],
+                        help="run for each factor, multiplying functions and classes")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per stage")
+    parser.add_argument("-o", "--output", default="", help="json file, default is stdout")
+    a = parser.parse_args()
+
+    spec = Spec(a.functions, a.classes, a.methods, a.properties, a.depth)
+    result = {
+        "lolpig_version": liblolpig.__version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "repeat": a.repeat,
+        "runs": [run_benchmark(spec.scaled(f), a.repeat) for f in a.scale],
+    }
+    text = json.dumps(result, indent=2)
+    if a.output:
+        with open(a.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
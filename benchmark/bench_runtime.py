@@ -0,0 +1,453 @@
+#!/usr/bin/python3
+"""
+Runtime benchmark of lolpig generated modules
+
+Generates a module which implements one trivial function for each kind of
+slot and method calling convention (see c_types.FUNCTIONS), compiles it
+together with an embedding main() and measures the time per call from
+within the embedded interpreter. The C functions do (almost) nothing,
+so the numbers show the call overhead of the python api and of the
+generated wrappers. The results are printed (or written) as JSON.
+
+Usage: bench_runtime.py [--number N] [--repeat R] [--cxx g++]
+                        [--cxxflags "-O2"] [--instrument] [--keep dir] [-o result.json]
+"""
+import os, sys, json, shlex, tempfile, argparse, platform, sysconfig, subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import liblolpig
+from liblolpig import Context, Class, Function, Argument, Member, Renderer
+
+MODULE_NAME = "lolpig_bench"
+
+# bodies of the C functions
+RETURN_NONE = "Py_RETURN_NONE;"
+RETURN_SELF = "Py_INCREF(self); return self;"
+RETURN_TRUE = "Py_RETURN_TRUE;"
+RETURN_STRING = 'static PyObject* s = PyUnicode_InternFromString("o"); Py_INCREF(s); return s;'
+ATTRIBUTES = "x y z w xy xyz"
+RETURN_ATTRIBUTE_ID = ('int id = attribute_id_BenchAttrId(name); '
+                       'if (id < 0) { PyErr_SetObject(PyExc_AttributeError, name); return NULL; } '
+                       'return PyLong_FromLong(id);')
+RETURN_ATTRIBUTE_STRCMP = ('static const char* names[] = { "%s" }; '
+                           'const char* s = PyUnicode_AsUTF8AndSize(name, NULL); if (!s) return NULL; '
+                           'for (int i=0; i<%d; ++i) if (!strcmp(s, names[i])) return PyLong_FromLong(i); '
+                           'PyErr_SetObject(PyExc_AttributeError, name); return NULL;'
+                           % ('", "'.join(ATTRIBUTES.split()), len(ATTRIBUTES.split())))
+
+"""
+The classes of the module:
+(python name, c name, struct members, options, [methods])
+with methods as
+(python name, return type, [(argument type, argument name)], body, property)
+"""
+CLASSES = [
+    ("Obj", "BenchObj", "", {}, [
+        ("noargs",          "PyObject*", [("PyObject*", "self")], RETURN_NONE, None),
+        ("meth_o",          "PyObject*", [("PyObject*", "self"), ("PyObject*", "obj")], RETURN_NONE, None),
+        ("varargs",         "PyObject*", [("PyObject*", "self"), ("PyObject*", "args")], RETURN_NONE, None),
+        ("keywords",        "PyObject*", [("PyObject*", "self"), ("PyObject*", "args"), ("PyObject*", "kwargs")],
+                            RETURN_NONE, None),
+        ("fastcall",        "PyObject*", [("PyObject*", "self"), ("PyObject*const*", "args"),
+                                          ("Py_ssize_t", "nargs")], RETURN_NONE, None),
+        ("fastcall_kw",     "PyObject*", [("PyObject*", "self"), ("PyObject*const*", "args"),
+                                          ("Py_ssize_t", "nargs"), ("PyObject*", "kwnames")], RETURN_NONE, None),
+        ("x",               "PyObject*", [("PyObject*", "self"), ("void*", "closure")], RETURN_NONE, "get"),
+        ("x",               "int", [("PyObject*", "self"), ("PyObject*", "value"), ("void*", "closure")],
+                            "return 0;", "set"),
+        ("__init__",        "int", [("PyObject*", "self"), ("PyObject*", "args"), ("PyObject*", "kwargs")],
+                            "return 0;", None),
+        ("__repr__",        "PyObject*", [("PyObject*", "self")], RETURN_STRING, None),
+        ("__str__",         "PyObject*", [("PyObject*", "self")], RETURN_STRING, None),
+        ("__hash__",        "Py_hash_t", [("PyObject*", "self")], "return 1;", None),
+        ("__iter__",        "PyObject*", [("PyObject*", "self")], RETURN_SELF, None),
+        ("__next__",        "PyObject*", [("PyObject*", "self")], "return NULL;", None),
+        ("__len__",         "Py_ssize_t", [("PyObject*", "self")], "return 1;", None),
+        ("__getitem__",     "PyObject*", [("PyObject*", "self"), ("Py_ssize_t", "index")], RETURN_NONE, None),
+        ("__setitem__",     "int", [("PyObject*", "self"), ("Py_ssize_t", "index"), ("PyObject*", "arg")],
+                            "return 0;", None),
+        ("__contains__",    "int", [("PyObject*", "self"), ("PyObject*", "arg")], "return 1;", None),
+        ("__add__",         "PyObject*", [("PyObject*", "self"), ("PyObject*", "other")], RETURN_SELF, None),
+        ("__neg__",         "PyObject*", [("PyObject*", "self")], RETURN_SELF, None),
+        ("__pow__",         "PyObject*", [("PyObject*", "self"), ("PyObject*", "other"), ("PyObject*", "mod")],
+                            RETURN_SELF, None),
+        ("__bool__",        "int", [("PyObject*", "self")], "return 1;", None),
+    ]),
+    ("Pooled", "BenchPooled", "", {"freelist": True}, []),
+    ("New", "BenchNew", "", {}, [
+        ("__new__",         "PyObject*", [("_typeobject*", "type"), ("PyObject*", "args"), ("PyObject*", "kwargs")],
+                            "return PyType_GenericAlloc(type, 0);", None),
+    ]),
+    ("VecNew", "BenchVecNew", "", {}, [
+        ("__vectorcall__",  "PyObject*", [("PyObject*", "type"), ("PyObject*const*", "args"),
+                                          ("size_t", "nargsf"), ("PyObject*", "kwnames")],
+                            "return PyType_GenericAlloc(reinterpret_cast<PyTypeObject*>(type), 0);", None),
+    ]),
+    ("Gc", "BenchGc", "", {}, [
+        ("__traverse__",    "int", [("PyObject*", "self"), ("visitproc", "visit"), ("void*", "arg")],
+                            "return 0;", None),
+    ]),
+    ("Map", "BenchMap", "", {}, [
+        ("__getitem__",     "PyObject*", [("PyObject*", "self"), ("PyObject*", "key")], RETURN_NONE, None),
+        ("__setitem__",     "int", [("PyObject*", "self"), ("PyObject*", "key"), ("PyObject*", "value")],
+                            "return 0;", None),
+    ]),
+    ("RichCmp", "BenchRichCmp", "", {}, [
+        ("__eq__",          "PyObject*", [("PyObject*", "self"), ("PyObject*", "other"), ("int", "op")],
+                            RETURN_TRUE, None),
+    ]),
+    ("Cmp", "BenchCmp", "", {}, [
+        ("__lt__",          "PyObject*", [("PyObject*", "self"), ("PyObject*", "other")], RETURN_TRUE, None),
+    ]),
+    ("Call", "BenchCall", "", {}, [
+        ("__call__",        "PyObject*", [("PyObject*", "self"), ("PyObject*", "args"), ("PyObject*", "kwargs")],
+                            RETURN_NONE, None),
+    ]),
+    ("VectorCall", "BenchVectorCall", "vectorcallfunc vectorcall;", {}, [
+        ("__call__",        "PyObject*", [("PyObject*", "self"), ("PyObject*const*", "args"),
+                                          ("size_t", "nargsf"), ("PyObject*", "kwnames")], RETURN_NONE, None),
+    ]),
+    ("GetAttr", "BenchGetAttr", "", {}, [
+        ("__getattr__",     "PyObject*", [("PyObject*", "self"), ("char*", "name")], RETURN_NONE, None),
+    ]),
+    ("GetAttrO", "BenchGetAttrO", "", {}, [
+        ("__getattro__",    "PyObject*", [("PyObject*", "self"), ("PyObject*", "name")], RETURN_NONE, None),
+        ("__setattro__",    "int", [("PyObject*", "self"), ("PyObject*", "name"), ("PyObject*", "arg")],
+                            "return 0;", None),
+    ]),
+    ("AttrId", "BenchAttrId", "", {"attributes": ATTRIBUTES}, [
+        ("__getattro__",    "PyObject*", [("PyObject*", "self"), ("PyObject*", "name")], RETURN_ATTRIBUTE_ID, None),
+    ]),
+    ("AttrStr", "BenchAttrStr", "", {}, [
+        ("__getattro__",    "PyObject*", [("PyObject*", "self"), ("PyObject*", "name")],
+                            RETURN_ATTRIBUTE_STRCMP, None),
+    ]),
+    ("Members", "BenchMembers", "double d; int i;", {}, []),
+    ("Buffer", "BenchBuffer", "char data[8];", {}, [
+        ("__getbuffer__",   "int", [("PyObject*", "self"), ("Py_buffer*", "view"), ("int", "flags")],
+                            "return PyBuffer_FillInfo(view, self, reinterpret_cast<BenchBuffer*>(self)->data, "
+                            "8, 1, flags);", None),
+        ("__releasebuffer__", "void", [("PyObject*", "self"), ("Py_buffer*", "view")], "", None),
+    ]),
+]
+
+"""
+The struct fields exposed through a PyMemberDef:
+(class python name, field type, field name, options)
+"""
+MEMBERS = [
+    ("Members", "double", "d", {}),
+    ("Members", "int", "i", {}),
+]
+
+"""
+The global functions, as in CLASSES.
+Like all global functions, they are called with the module as first argument
+"""
+FUNCTIONS = [
+    ("meth_o",          "PyObject*", [("PyObject*", "obj")], RETURN_NONE),
+    ("varargs",         "PyObject*", [("PyObject*", "args")], RETURN_NONE),
+    ("keywords",        "PyObject*", [("PyObject*", "args"), ("PyObject*", "kwargs")], RETURN_NONE),
+    ("fastcall",        "PyObject*", [("PyObject*", "module"), ("PyObject*const*", "args"),
+                                      ("Py_ssize_t", "nargs")], RETURN_NONE),
+    ("fastcall_kw",     "PyObject*", [("PyObject*", "module"), ("PyObject*const*", "args"),
+                                      ("Py_ssize_t", "nargs"), ("PyObject*", "kwnames")], RETURN_NONE),
+]
+
+"""
+The timed statements: (name, function type or calling convention, statement)
+"""
+CASES = [
+    ("baseline",            "",                             "pass"),
+    ("func_meth_o",         "METH_O",                       "m.meth_o(1)"),
+    ("func_varargs",        "METH_VARARGS",                 "m.varargs(1)"),
+    ("func_keywords",       "METH_VARARGS | METH_KEYWORDS", "m.keywords(1, a=2)"),
+    ("func_fastcall",       "METH_FASTCALL",                "m.fastcall(1)"),
+    ("func_fastcall_kw",    "METH_FASTCALL | METH_KEYWORDS", "m.fastcall_kw(1, a=2)"),
+    ("method_noargs",       "METH_NOARGS",                  "o.noargs()"),
+    ("method_meth_o",       "METH_O",                       "o.meth_o(1)"),
+    ("method_varargs",      "METH_VARARGS",                 "o.varargs(1)"),
+    ("method_keywords",     "METH_VARARGS | METH_KEYWORDS", "o.keywords(1, a=2)"),
+    ("method_fastcall",     "METH_FASTCALL",                "o.fastcall(1)"),
+    ("method_fastcall_kw",  "METH_FASTCALL | METH_KEYWORDS", "o.fastcall_kw(1, a=2)"),
+    ("property_get",        "getter",                       "o.x"),
+    ("property_set",        "setter",                       "o.x = 1"),
+    ("new_init",            "newfunc+initproc",             "m.Obj()"),
+    ("new_vectorcall",      "vectorcallfunc",               "m.VecNew()"),
+    ("new_freelist",        "newfunc+freelist",             "m.Pooled()"),
+    ("new_user",            "newfunc",                      "m.New()"),
+    ("new_gc",              "newfunc+traverseproc",         "m.Gc()"),
+    ("repr",                "reprfunc",                     "repr(o)"),
+    ("str",                 "reprfunc",                     "str(o)"),
+    ("hash",                "hashfunc",                     "hash(o)"),
+    ("iter",                "getiterfunc",                  "iter(o)"),
+    ("next",                "iternextfunc",                 "next(o, None)"),
+    ("len",                 "lenfunc",                      "len(o)"),
+    ("sequence_getitem",    "ssizeargfunc",                 "o[0]"),
+    ("sequence_setitem",    "ssizeobjargproc",              "o[0] = 1"),
+    ("contains",            "objobjproc",                   "1 in o"),
+    ("number_add",          "binaryfunc",                   "o + o"),
+    ("number_neg",          "unaryfunc",                    "-o"),
+    ("number_pow",          "ternaryfunc",                  "o ** o"),
+    ("number_bool",         "inquiry",                      "not o"),
+    ("mapping_getitem",     "binaryfunc",                   "mp['a']"),
+    ("mapping_setitem",     "objobjargproc",                "mp['a'] = 1"),
+    ("richcompare",         "richcmpfunc",                  "rc == rc"),
+    ("compare_split",       "binaryfunc",                   "cmp < cmp"),
+    ("call",                "ternaryfunc",                  "call(1)"),
+    ("call_vectorcall",     "vectorcallfunc",               "vcall(1)"),
+    ("getattr",             "getattrfunc",                  "ga.a"),
+    ("getattro",            "getattrofunc",                 "gao.a"),
+    ("setattro",            "setattrofunc",                 "gao.a = 1"),
+    ("getattro_attribute_id", "getattrofunc+attribute_id",  "aid.xyz"),
+    ("getattro_strcmp",     "getattrofunc+strcmp",          "astr.xyz"),
+    ("member_get_double",   "T_DOUBLE",                     "mem.d"),
+    ("member_set_double",   "T_DOUBLE",                     "mem.d = 1."),
+    ("member_get_int",      "T_INT",                        "mem.i"),
+    ("member_set_int",      "T_INT",                        "mem.i = 1"),
+    ("buffer",              "getbufferproc",                "memoryview(buf)"),
+]
+
+# the class and the case of the __vectorcall__ constructor, which is not possible with the limited API
+VECTORCALL_NEW = ("VecNew", "new_vectorcall")
+
+SETUP = """
+import %(module)s as m
+o, mp, rc, cmp = m.Obj(), m.Map(), m.RichCmp(), m.Cmp()
+call, vcall, ga, gao, buf = m.Call(), m.VectorCall(), m.GetAttr(), m.GetAttrO(), m.Buffer()
+aid, astr, mem = m.AttrId(), m.AttrStr(), m.Members()
+"""
+
+
+def _function(py_name, c_name, ret, args, prop=None):
+    f = Function()
+    f.py_name, f.c_name, f.c_return_type = py_name, c_name, ret
+    f.py_doc = "Benchmark of %s" % py_name
+    f.namespaces = ["BENCH"]
+    f.arguments = [Argument(t, n) for t, n in args]
+    if prop:
+        f.is_property = True
+        f.is_setter = prop == "set"
+    return f
+
+
+def make_context(multi_phase=False, limited_api=False):
+    """Returns the finalized Context of the module and the C++ code implementing it,
+    with multi_phase the attribute id functions also take the instance"""
+    ctx = Context()
+    ctx.module_name = MODULE_NAME
+    ctx.header_name = "%s_module.h" % MODULE_NAME
+    code = '#include <cstddef>\n#include <cstring>\n#include "%s"\n\nnamespace BENCH {\n\n' % ctx.header_name
+
+    def add_impl(f, body):
+        if multi_phase:
+            body = body.replace("attribute_id_BenchAttrId(name)", "attribute_id_BenchAttrId(self, name)")
+        return "%s { %s }\n" % (f.c_definition(), body)
+
+    for py_name, c_name, members, options, methods in CLASSES:
+        if limited_api and py_name == VECTORCALL_NEW[0]:
+            continue
+        c = Class()
+        c.py_name, c.c_name = py_name, c_name
+        c.py_doc = "Benchmark class %s" % py_name
+        c.namespaces = ["BENCH"]
+        c.options = dict(options)
+        if limited_api:
+            # the typedef is not part of the limited API, the field is only used with vectorcall
+            members = members.replace("vectorcallfunc", "void*")
+        code += "\nstruct %s { PyObject_HEAD %s };\n" % (c_name, members)
+        code += "size_t sizeof_%s() { return sizeof(%s); }\n" % (c_name, c_name)
+        if "vectorcall" in members:
+            code += "Py_ssize_t vectorcall_offset_%s() { return offsetof(%s, vectorcall); }\n" % (c_name, c_name)
+        if "attributes" in options:
+            code += 'extern "C" int attribute_id_%s(%sPyObject* name);\n' % (
+                c_name, "PyObject* self, " if multi_phase else "")
+        for cls_name, c_type, field, field_options in MEMBERS:
+            if cls_name == py_name:
+                member = Member(c_type, field)
+                member.py_name = field
+                member.options = dict(field_options)
+                c.members.append(member)
+        if c.members:
+            code += "LOLPIG_MEMBER_OFFSETS_%s\n" % c_name
+        for name, ret, args, body, prop in methods:
+            suffix = "_%s" % prop if prop else ""
+            f = _function("%s.%s" % (py_name, name), "%s_%s%s" % (c_name, name.strip("_"), suffix), ret, args, prop)
+            c.methods.append(f)
+            code += add_impl(f, body)
+        ctx.classes.append(c)
+
+    code += "\n"
+    for name, ret, args, body in FUNCTIONS:
+        f = _function(name, "bench_%s" % name, ret, args)
+        ctx.functions.append(f)
+        code += add_impl(f, body)
+
+    code += "\n} // namespace BENCH\n"
+    ctx.finalize()
+    return ctx, code
+
+
+MAIN_CPP = """
+#include <cstdio>
+// the embedding uses the full API, also if the module is built for the limited API
+#include <python3.4/Python.h>
+#include "%(header)s"
+
+int main(int argc, char** argv)
+{
+    if (argc < 2)
+        return 2;
+    BENCH::initialize_module_%(module)s();
+    Py_Initialize();
+    FILE* f = fopen(argv[1], "r");
+    if (!f)
+        return 2;
+    int ret = PyRun_SimpleFile(f, argv[1]);
+    fclose(f);
+    if (Py_FinalizeEx() < 0)
+        ret = 1;
+    return ret ? 1 : 0;
+}
+"""
+
+SCRIPT = """
+import json, timeit
+cases = %(cases)r
+setup = %(setup)r
+result = dict()
+for name, stmt in cases:
+    t = timeit.Timer(stmt, setup)
+    best = min(t.repeat(%(repeat)d, %(number)d))
+    result[name] = best / %(number)d * 1e9
+print(json.dumps(result))
+"""
+
+
+def _python_build_flags():
+    """Returns (include dir, linker flags) of the running python"""
+    cfg = sysconfig.get_config_var
+    libs = ["-L%s" % cfg("LIBDIR"), "-Wl,-rpath,%s" % cfg("LIBDIR"),
+            "-lpython%s%s" % (cfg("VERSION"), cfg("ABIFLAGS") or "")]
+    libs += shlex.split(cfg("LIBS") or "") + shlex.split(cfg("SYSLIBS") or "")
+    return sysconfig.get_paths()["include"], libs
+
+
+def build(build_dir, cxx, cxxflags, instrument=False, multi_phase=False, limited_api=False):
+    """Renders and compiles the benchmark executable, returns it's filename"""
+    ctx, impl = make_context(multi_phase, limited_api)
+    r = Renderer(ctx)
+    r.namespaces = ["BENCH"]
+    r.is_timestamp = False
+    r.is_instrumented = instrument
+    r.is_multi_phase = multi_phase
+    r.is_limited_api = limited_api
+    base = os.path.join(build_dir, "%s_module" % MODULE_NAME)
+    Renderer.write_to_file(base + ".h", r.render_hpp())
+    Renderer.write_to_file(base + ".cpp", r.render_cpp())
+    with open(os.path.join(build_dir, "impl.cpp"), "w") as f:
+        f.write(impl)
+    with open(os.path.join(build_dir, "main.cpp"), "w") as f:
+        f.write(MAIN_CPP % {"header": ctx.header_name, "module": MODULE_NAME})
+
+    # the generated code includes <python3.4/Python.h>
+    include, libs = _python_build_flags()
+    shim = os.path.join(build_dir, "include")
+    os.makedirs(shim, exist_ok=True)
+    if not os.path.exists(os.path.join(shim, "python3.4")):
+        os.symlink(include, os.path.join(shim, "python3.4"))
+
+    exe = os.path.join(build_dir, "bench_runtime")
+    cmd = [cxx, "-std=c++11"] + shlex.split(cxxflags) + ["-I%s" % shim, "-I%s" % include, "-I%s" % build_dir,
+           base + ".cpp", os.path.join(build_dir, "impl.cpp"), os.path.join(build_dir, "main.cpp"),
+           "-o", exe] + libs
+    subprocess.check_call(cmd)
+    return exe
+
+
+def get_cases(limited_api=False):
+    """Returns the CASES which can be run with the module"""
+    return [c for c in CASES if not (limited_api and c[0] == VECTORCALL_NEW[1])]
+
+
+def run(exe, build_dir, number, repeat, limited_api=False):
+    """Runs the timings in the embedded interpreter, returns dict of name -> ns per call"""
+    script = os.path.join(build_dir, "bench_script.py")
+    with open(script, "w") as f:
+        f.write(SCRIPT % {
+            "cases": [(c[0], c[2]) for c in get_cases(limited_api)],
+            "setup": SETUP % {"module": MODULE_NAME},
+            "number": number,
+            "repeat": repeat,
+        })
+    env = dict(os.environ)
+    env["PYTHONHOME"] = sys.base_prefix
+    output = subprocess.check_output([exe, script], env=env, universal_newlines=True)
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def run_benchmark(build_dir, cxx, cxxflags, number, repeat, instrument=False, multi_phase=False,
+                  limited_api=False):
+    exe = build(build_dir, cxx, cxxflags, instrument, multi_phase, limited_api)
+    timings = run(exe, build_dir, number, repeat, limited_api)
+    baseline = timings["baseline"]
+    cases = []
+    for name, type, stmt in get_cases(limited_api):
+        cases.append({
+            "name": name,
+            "type": type,
+            "statement": stmt,
+            "ns_per_call": timings[name],
+            "overhead_ns": timings[name] - baseline,
+        })
+    return cases
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runtime benchmark of lolpig generated modules")
+    parser.add_argument("--number", type=int, default=200000, help="calls per timing")
+    parser.add_argument("--repeat", type=int, default=5, help="timings per statement, the best is used")
+    parser.add_argument("--cxx", default=os.environ.get("CXX", "c++"), help="c++ compiler")
+    parser.add_argument("--cxxflags", default="-O2", help="compiler flags")
+    parser.add_argument("--instrument", action="store_true", help="render the module with call counting shims")
+    parser.add_argument("--multi-phase", action="store_true",
+                        help="render the module with multi-phase initialization and heap types")
+    parser.add_argument("--limited-api", action="store_true",
+                        help="render the module for the limited API (abi3)")
+    parser.add_argument("--keep", default="", help="build in this directory and keep it")
+    parser.add_argument("-o", "--output", default="", help="json file, default is stdout")
+    a = parser.parse_args()
+
+    if a.keep:
+        os.makedirs(a.keep, exist_ok=True)
+        cases = run_benchmark(a.keep, a.cxx, a.cxxflags, a.number, a.repeat, a.instrument,
+                              a.multi_phase, a.limited_api)
+    else:
+        with tempfile.TemporaryDirectory() as tmp:
+            cases = run_benchmark(tmp, a.cxx, a.cxxflags, a.number, a.repeat, a.instrument,
+                                  a.multi_phase, a.limited_api)
+
+    result = {
+        "lolpig_version": liblolpig.__version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "compiler": a.cxx,
+        "cxxflags": a.cxxflags,
+        "instrument": a.instrument,
+        "multi_phase": a.multi_phase,
+        "limited_api": a.limited_api,
+        "number": a.number,
+        "repeat": a.repeat,
+        "cases": cases,
+    }
+    text = json.dumps(result, indent=2)
+    if a.output:
+        with open(a.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
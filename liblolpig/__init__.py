@@ -1,5 +1,8 @@
+__version__ = "0.1"
+
 from .gccxml import XmlParser
 from .doxy import DoxygenParser
 from .context import *
 from .renderer import *
+from .doc_options import split_doc_options
 
@@ -0,0 +1,3 @@
+from liblolpig.cmdline import process_commands
+
+process_commands()
@@ -72,6 +72,48 @@ FUNCTIONS = {
                                             ("self", "data")),
     "traverseproc":         ("int",         ("PyObject*", "visitproc", "void*"),
                                             ("self", "func", "data")),
+    "getbufferproc":        ("int",         ("PyObject*", "Py_buffer*", "int"),
+                                            ("self", "view", "flags")),
+    "releasebufferproc":    ("void",        ("PyObject*", "Py_buffer*"),
+                                            ("self", "view")),
+
+    # vectorcall-style method signatures (METH_FASTCALL)
+    "_PyCFunctionFast":     ("PyObject*",   ("PyObject*", "PyObject*const*", "Py_ssize_t"),
+                                            ("self", "args", "nargs")),
+    "_PyCFunctionFastWithKeywords":
+                            ("PyObject*",   ("PyObject*", "PyObject*const*", "Py_ssize_t", "PyObject*"),
+                                            ("self", "args", "nargs", "kwnames")),
+    "vectorcallfunc":       ("PyObject*",   ("PyObject*", "PyObject*const*", "size_t", "PyObject*"),
+                                            ("callable", "args", "nargsf", "kwnames")),
+}
+
+
+"""
+Function types that are not available in every python version:
+typename: PY_VERSION_HEX of first version supporting the type
+"""
+FUNCTIONS_MIN_VERSION = {
+    "_PyCFunctionFast":             0x03070000,
+    "_PyCFunctionFastWithKeywords": 0x03070000,
+    "vectorcallfunc":               0x03080000,
+}
+
+"""
+Function types that were removed from the python api:
+typename: PY_VERSION_HEX of first version without the type
+"""
+FUNCTIONS_MAX_VERSION = {
+    "printfunc":                    0x03080000,
+}
+
+"""
+Struct members whose type changed between python versions:
+member: (old type, new type, PY_VERSION_HEX of first version with the new type)
+"""
+STRUCT_MEMBER_COMPAT_TYPES = {
+    "tp_print":     ("printfunc",   "Py_ssize_t",           0x03080000),
+    "tp_reserved":  ("void*",       "PyAsyncMethods*",      0x03050000),
+    "m_reload":     ("inquiry",     "PyModuleDef_Slot*",    0x03050000),
 }
 
 
@@ -128,6 +170,14 @@ PyTypeObject = [
     ("tp_finalize",         "destructor"),
 ]
 
+"""
+Members of PyTypeObject which are not part of the static layout above.
+They are assigned by the class init function before PyType_Ready()
+"""
+PyTypeObject_runtime = [
+    ("tp_vectorcall",       "vectorcallfunc"),
+]
+
 PyNumberMethods = [
     ("nb_add",                  "binaryfunc"),
     ("nb_subtract",             "binaryfunc"),
@@ -213,6 +263,19 @@ SEQUENCE_FUNCS = [
     ("__irepeat__",     "sq_inplace_repeat"),
 ]
 
+# these have the same names as sequence functions,
+# see Function.is_mapping_function()
+MAPPING_FUNCS = [
+    ("__len__",         "mp_length"),
+    ("__getitem__",     "mp_subscript"),
+    ("__setitem__",     "mp_ass_subscript"),
+]
+
+BUFFER_FUNCS = [
+    ("__getbuffer__",       "bf_getbuffer"),
+    ("__releasebuffer__",   "bf_releasebuffer"),
+]
+
 NUMBER_FUNCS = [
     ("__add__",         "nb_add"),
     ("__sub__",         "nb_subtract"),
@@ -276,9 +339,43 @@ TYPE_FUNCS = [
     # these are unofficial
     ("__dealloc__",     "tp_dealloc"),
     ("__finalize__",    "tp_finalize"),
+    ("__vectorcall__",  "tp_vectorcall"),
+    ("__traverse__",    "tp_traverse"),
+    ("__clear__",       "tp_clear"),
 ]
 
-ALL_FUNCS = TYPE_FUNCS + SEQUENCE_FUNCS + NUMBER_FUNCS
+ALL_FUNCS = TYPE_FUNCS + SEQUENCE_FUNCS + NUMBER_FUNCS + BUFFER_FUNCS
+
+
+"""
+Special functions which may use another signature than the one
+of their struct member: py_name: (function types,)
+"""
+ALTERNATIVE_FUNCS = {
+    "__call__":         ("vectorcallfunc",),
+    # single comparison operators, see RICHCOMPARE_FUNCS
+    "__lt__":           ("binaryfunc",),
+    "__le__":           ("binaryfunc",),
+    "__eq__":           ("binaryfunc",),
+    "__ne__":           ("binaryfunc",),
+    "__gt__":           ("binaryfunc",),
+    "__ge__":           ("binaryfunc",),
+    # mapping functions, see MAPPING_FUNCS
+    "__getitem__":      ("binaryfunc",),
+    "__setitem__":      ("objobjargproc",),
+}
+
+"""
+Comparison functions and their richcmpfunc operator
+"""
+RICHCOMPARE_FUNCS = [
+    ("__lt__",          "Py_LT"),
+    ("__le__",          "Py_LE"),
+    ("__eq__",          "Py_EQ"),
+    ("__ne__",          "Py_NE"),
+    ("__gt__",          "Py_GT"),
+    ("__ge__",          "Py_GE"),
+]
 
 
 SPECIAL_FUNCS = [
@@ -288,12 +385,35 @@ SPECIAL_FUNCS = [
 ]
 
 
+# struct field types that can be exposed through a PyMemberDef, with their type code
+# (without whitespace, as the types are compared)
+# https://docs.python.org/3/c-api/structures.html#c.PyMemberDef
+MEMBER_TYPES = {
+    "signedchar":       "T_BYTE",
+    "unsignedchar":     "T_UBYTE",
+    "short":            "T_SHORT",
+    "unsignedshort":    "T_USHORT",
+    "int":              "T_INT",
+    "unsignedint":      "T_UINT",
+    "long":             "T_LONG",
+    "unsignedlong":     "T_ULONG",
+    "longlong":         "T_LONGLONG",
+    "unsignedlonglong": "T_ULONGLONG",
+    "Py_ssize_t":       "T_PYSSIZET",
+    "float":            "T_FLOAT",
+    "double":           "T_DOUBLE",
+    "bool":             "T_BOOL",
+    "PyObject*":        "T_OBJECT_EX",
+}
+
+
 FUNCNAME_TO_STRUCT_MEMBER = dict()
 for i in ALL_FUNCS:
     FUNCNAME_TO_STRUCT_MEMBER.setdefault(i[0], i[1])
 
 STRUCT_MEMBER_TO_TYPE = dict()
-for i in PyModuleDef + PyBufferProcs + PyMappingMethods + PySequenceMethods + PyNumberMethods + PyTypeObject:
+for i in PyModuleDef + PyBufferProcs + PyMappingMethods + PySequenceMethods + PyNumberMethods + PyTypeObject \
+         + PyTypeObject_runtime:
     STRUCT_MEMBER_TO_TYPE.setdefault(i[0], i[1])
 
 FUNCNAME_TO_TYPE = dict()
@@ -1,16 +1,42 @@
+from liblolpig import profiling
+
+# doxygen groups parsed as modules with -batch, e.g. 'lolpig_vec' for module 'vec'
+BATCH_GROUP_PREFIX = "lolpig_"
+
+# input files compiled into the extension with -setup
+SOURCE_EXTENSIONS = (".c", ".cc", ".cpp", ".cxx")
+
 
 class Arguments:
     def __init__(self):
         self.ok = False
         self.error_txt = ""
         self.module_name = "module"
+        self.output_name = ""
         self.output_cpp = ""
         self.output_hpp = ""
+        self.output_manifest = ""
         self.header_inc = ""
         self.input_filenames = []
         self.namespaces = []
         self.is_export = False
         self.is_gccxml = False
+        self.is_batch = False
+        self.cache_dir = ""
+        self.stamp = "none"
+        self.is_force = False
+        self.is_instrumented = False
+        self.is_multi_phase = False
+        self.is_per_interpreter_gil = False
+        self.is_shared_lib = False
+        self.setup_file = ""
+        self.is_limited_api = False
+        self.is_profile = False
+        self.is_profile_memory = False
+        self.pstats_file = ""
+        self.is_quiet = False
+        self.jobs = 0
+        self.job_file = ""
 
     def dump(self):
         print("""
@@ -19,27 +45,73 @@ input:      %s
 module:     %s
 output:     %s%s %s
 namespaces: %s
+cache:      %s
         """ % ("python -> cpp" if self.is_export else "cpp -> cpp",
                str(self.input_filenames),
                self.module_name,
                self.output_hpp + " " if not self.is_export else "",
                self.output_cpp,
                '(#include "%s")' % self.header_inc if not self.is_export else "",
-               self.namespaces
+               self.namespaces,
+               self.cache_dir or "-"
                ))
 
     def help(self):
         print("""
-Usage: lolpig.py [-export] -i files -o file [-m modulename] [-n namespaces]
+Usage: lolpig.py [-export] -i files -o file [-m modulename] [-n namespaces] [-cache dir]
+                 [-stamp none|hash|date] [-force] [-j workers] [-instrument]
+                 [-multiphase] [-owngil] [-shared] [-setup file] [-abi3]
+                 [-profile] [-profilemem] [-pstats file] [-quiet]
+       lolpig.py -batch -i files -o directory [...]
+       lolpig.py -jobfile file [switches for all modules]
+
+-cache dir   keep doxygen output in dir and reuse it while the input files are unchanged
+-stamp       what to print in the head of generated files, none (default), a hash of the
+             input files or the date
+-force       parse and render all inputs, even if the manifest from the last run says they are unchanged
+-j workers   number of processes parsing files with -gccxml, default is the number of cores
+-instrument  count calls and time of each function, returned by the module function _lolpig_stats()
+-multiphase  multi-phase initialization (PEP 489) with heap types and per-module state,
+             requires python >= 3.9
+-owngil      declare the module safe for sub-interpreters with their own GIL (python >= 3.12),
+             only if the user code keeps no static python objects, implies -multiphase
+-shared      export PyInit_<module> to build the module as python extension (shared library)
+-setup file  write a setuptools script building the extension from the generated and
+             the input .c/.cpp files, implies -shared
+-abi3        use only the limited API (stable ABI) with heap types, so one build of the
+             extension can be imported by all later python versions, implies -shared
+-profile     print the wall time of each stage
+-profilemem  also print the peak memory of each stage, which slows down the python stages
+             several times, implies -profile
+-pstats file profile with cProfile and write the statistics to file, implies -profile
+-quiet       do not print the settings and the parsed interface
+-jobfile     file with the switches for one module per line, the other switches
+             on the command line are applied to each module
+-batch       run doxygen once over all input files and render each group lolpig_<name>
+             as module <name> into the directory given by -o
 """)
 
     def verify(self):
         self.ok = True
         self.error_txt = ""
-        if not self.output_cpp or not self.output_hpp:
-            self.error("No output file specified (-o)")
-        if not self.input_filenames:
-            self.error("No input files specified (-i)")
+        # the modules are defined in the job file
+        if not self.job_file:
+            if not self.output_cpp or not self.output_hpp:
+                self.error("No output file specified (-o)")
+            if not self.input_filenames:
+                self.error("No input files specified (-i)")
+        if self.stamp not in ("hash", "date", "none"):
+            self.error("Unknown stamp '%s' (-stamp)" % self.stamp)
+        if self.jobs < 0:
+            self.error("Invalid number of workers (-j)")
+        if self.is_batch and (self.is_export or self.is_gccxml):
+            self.error("-batch only works with doxygen")
+        if self.is_multi_phase and self.is_instrumented:
+            self.error("-instrument keeps static state and can not be used with -multiphase")
+        if self.setup_file and (self.is_batch or self.is_export):
+            self.error("-setup can not be used with -batch or -export")
+        if self.is_limited_api and self.is_multi_phase:
+            self.error("-abi3 can not be used with -multiphase")
         return self.ok
 
     def error(self, txt):
@@ -52,7 +124,13 @@ Usage: lolpig.py [-export] -i files -o file [-m modulename] [-n namespaces]
         if not argv:
             import sys
             argv = sys.argv
-        param = [("-i", -1), ("-n", -1), ("-o", 1), ("-m", 1), ("-export", 0), ("-gccxml", 0)]
+        param = [("-i", -1), ("-n", -1), ("-o", 1), ("-m", 1), ("-export", 0), ("-gccxml", 0),
+                 ("-cache", 1), ("-stamp", 1), ("-force", 0),
+                 ("-j", 1), ("-instrument", 0), ("-multiphase", 0), ("-owngil", 0),
+                 ("-shared", 0), ("-setup", 1),
+                 ("-abi3", 0),
+                 ("-profile", 0), ("-profilemem", 0), ("-pstats", 1), ("-quiet", 0),
+                 ("-jobfile", 1), ("-batch", 0)]
         expect = ""
         expect_len = 0
         arg_cnt = 0
@@ -63,99 +141,413 @@ Usage: lolpig.py [-export] -i files -o file [-m modulename] [-n namespaces]
                 expect = ""
 
             if expect:
-                if expect == "-export":
-                    self.is_export = True
-                elif expect == "-gccxml":
-                    self.is_gccxml = True
-                elif expect == "-i":
-                    self.input_filenames.append(a)
-                elif expect == "-n":
-                    self.namespaces.append(a)
-                elif expect == "-o":
-                    self.set_output_name(a)
-                elif expect == "-m":
-                    self.module_name = a
-                else:
-                    raise NotImplementedError("unimplemented switch %s" % expect)
-
+                self._apply(expect, a)
                 arg_cnt += 1
                 if expect_len >= 0 and arg_cnt >= expect_len:
                     expect = ""
-                if not expect_len == 0:
-                    continue
-
-            if not expect:
-                for cmd, le in param:
-                    if a == cmd:
+                continue
+
+            for cmd, le in param:
+                if a == cmd:
+                    # switches without parameters are applied right away,
+                    # so they also work as last argument
+                    if le == 0:
+                        self._apply(cmd, None)
+                    else:
                         expect = cmd
                         expect_len = le
                         arg_cnt = 0
-                        break
-                else:
-                    self.error("Unknown command '%s'" % a)
-                    return False
+                    break
+            else:
+                self.error("Unknown command '%s'" % a)
+                return False
         return self.verify()
 
+    def _apply(self, cmd, a):
+        """Applies the switch cmd with the parameter a, which is None for switches without parameters"""
+        if cmd == "-export":
+            self.is_export = True
+        elif cmd == "-gccxml":
+            self.is_gccxml = True
+        elif cmd == "-force":
+            self.is_force = True
+        elif cmd == "-instrument":
+            self.is_instrumented = True
+        elif cmd == "-multiphase":
+            self.is_multi_phase = True
+        elif cmd == "-owngil":
+            self.is_per_interpreter_gil = True
+            self.is_multi_phase = True
+        elif cmd == "-shared":
+            self.is_shared_lib = True
+        elif cmd == "-setup":
+            self.setup_file = a
+            self.is_shared_lib = True
+        elif cmd == "-abi3":
+            self.is_limited_api = True
+            self.is_shared_lib = True
+        elif cmd == "-profile":
+            self.is_profile = True
+        elif cmd == "-profilemem":
+            self.is_profile_memory = True
+            self.is_profile = True
+        elif cmd == "-pstats":
+            self.pstats_file = a
+            self.is_profile = True
+        elif cmd == "-quiet":
+            self.is_quiet = True
+        elif cmd == "-jobfile":
+            self.job_file = a
+        elif cmd == "-batch":
+            self.is_batch = True
+        elif cmd == "-i":
+            self.input_filenames.append(a)
+        elif cmd == "-n":
+            self.namespaces.append(a)
+        elif cmd == "-o":
+            self.set_output_name(a)
+        elif cmd == "-m":
+            self.module_name = a
+        elif cmd == "-cache":
+            self.cache_dir = a
+        elif cmd == "-stamp":
+            self.stamp = a
+        elif cmd == "-j":
+            try:
+                self.jobs = int(a)
+            except ValueError:
+                self.jobs = -1
+        else:
+            raise NotImplementedError("unimplemented switch %s" % cmd)
+
+    def settings(self):
+        """Returns a dict of all settings that influence the generated module"""
+        return {
+            "module_name": self.module_name,
+            "output_cpp": self.output_cpp,
+            "output_hpp": self.output_hpp,
+            "header_inc": self.header_inc,
+            "namespaces": list(self.namespaces),
+            "is_gccxml": self.is_gccxml,
+            "is_batch": self.is_batch,
+            "stamp": self.stamp,
+            "is_instrumented": self.is_instrumented,
+            "is_multi_phase": self.is_multi_phase,
+            "is_per_interpreter_gil": self.is_per_interpreter_gil,
+            "is_shared_lib": self.is_shared_lib,
+            "setup_file": self.setup_file,
+            "is_limited_api": self.is_limited_api,
+        }
+
     def set_output_name(self, n):
+        self.output_name = n
         self.output_cpp = n + ".cpp"
         self.output_hpp = n + ".h"
+        self.output_manifest = n + ".lolpig"
         import os
         self.header_inc = os.path.basename(self.output_hpp)
 
 
-def _get_gcc_xml(filenames):
-    from liblolpig import XmlParser, Context
+def _parse_gcc_xml_file(filename, input_dirs=()):
+    """Parses a single file with gccxml, called in the worker processes.
+    Returns the Context and the list of files included by the file"""
+    from liblolpig import XmlParser
+
+    print("parsing %s ..." % filename)
+    p = XmlParser()
+    p.input_dirs = list(input_dirs)
+    p.parse(filename)
+    #p.dump()
+    c = p.as_context()
+    #c.dump()
+    return c, p.get_dependencies()
+
+def _get_parsed_key(parser, filenames, manifest=None, *extra):
+    """Returns the key of the parse result of the files in the 'parsed' dict
+    of _get_gcc_xml() and _get_doxygen(), which includes the file hashes"""
+    from liblolpig.manifest import hash_file
+    key = [parser]
+    for fn in filenames:
+        key.append((fn, manifest.hashes.get(fn) if manifest and fn in manifest.hashes else hash_file(fn)))
+    return tuple(key) + extra
+
+def _get_gcc_xml(filenames, manifest=None, old_manifest=None, jobs=0, parsed=None):
+    """Parses each file with gccxml, or takes it's Context from the old manifest
+    if the file is unchanged. The files are parsed in parallel by [jobs] processes,
+    or by one process per core if jobs is 0, and merged in the order of filenames.
+    The dict parsed keeps the pickled Context of each file for other modules in the same run.
+    The manifest records the headers included by each file, as their objects are part of the Context"""
+    import os, functools, pickle
+    from liblolpig import Context
+
+    # objects from all input files' directories are kept by the parser
+    input_dirs = sorted(set(os.path.dirname(os.path.abspath(fn)) for fn in filenames))
+    parse = functools.partial(_parse_gcc_xml_file, input_dirs=input_dirs)
+
+    contexts = dict()
+    dependencies = dict()
+    todo = []
+    for fn in filenames:
+        c = old_manifest.get_unit(fn, manifest) if old_manifest else None
+        if c is not None:
+            print("%s is unchanged" % fn)
+            dependencies[fn] = old_manifest.get_unit_dependencies(fn)
+        elif parsed is not None:
+            data = parsed.get(_get_parsed_key("gccxml", [fn], manifest, tuple(input_dirs)))
+            if data:
+                print("reusing gccxml output of %s" % fn)
+                c, dependencies[fn] = pickle.loads(data)
+        if c is None:
+            if fn not in todo:
+                todo.append(fn)
+        else:
+            contexts[fn] = c
+
+    if len(todo) > 1 and not jobs == 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=jobs or None) as pool:
+            for fn, (c, deps) in zip(todo, pool.map(parse, todo)):
+                contexts[fn], dependencies[fn] = c, deps
+    else:
+        for fn in todo:
+            contexts[fn], dependencies[fn] = parse(fn)
+    if parsed is not None:
+        for fn in todo:
+            parsed[_get_parsed_key("gccxml", [fn], manifest, tuple(input_dirs))] = \
+                pickle.dumps((contexts[fn], dependencies[fn]))
 
     ctx = Context()
-
     for fn in filenames:
-        print("parsing %s ..." % fn)
-        p = XmlParser()
-        p.parse(fn)
-        #p.dump()
-        c = p.as_context()
-        #c.dump()
+        c = contexts[fn]
+        if manifest:
+            manifest.add_unit(fn, [fn], c, dependencies[fn])
         ctx.merge(c)
     ctx.finalize()
     return ctx
 
-def _get_doxygen(filenames):
+def _get_doxygen(filenames, cache_dir=None, manifest=None, parsed=None):
+    """Parses all files in one doxygen run, as classes and their bases may
+    be spread over several files.
+    The dict parsed keeps the pickled Context for other modules with the same inputs in the same run"""
+    import pickle
     from liblolpig import DoxygenParser
-    p = DoxygenParser()
-    p.parse_files(filenames)
+    from liblolpig.doxy import expand_input_filenames
+
+    key = None
+    ctx = None
+    if parsed is not None:
+        key = _get_parsed_key("doxygen", expand_input_filenames(filenames), manifest)
+        if key in parsed:
+            print("reusing doxygen output of %s" % " ".join(filenames))
+            ctx = pickle.loads(parsed[key])
+    if ctx is None:
+        p = DoxygenParser()
+        p.cache_dir = cache_dir
+        p.parse_files(filenames)
+
+        with profiling.stage("context"):
+            ctx = p.as_context()
+        if key:
+            parsed[key] = pickle.dumps(ctx)
+    if manifest:
+        manifest.add_unit("doxygen", expand_input_filenames(filenames), ctx)
+    return ctx
 
-    return p.as_context()
 
+def _get_source_hash(filenames):
+    """Returns a hash of the contents of all input files"""
+    import hashlib
+    from liblolpig.doxy import expand_input_filenames
+    h = hashlib.sha1()
+    for fn in expand_input_filenames(filenames):
+        h.update(fn.encode("utf-8"))
+        with open(fn, "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
 
-def _render_module(a):
-    """Renders the module code from scanning cpp files"""
-    from liblolpig import Renderer
 
-    if a.is_gccxml:
-        ctx = _get_gcc_xml(a.input_filenames)
-    else:
-        ctx = _get_doxygen(a.input_filenames)
+def _init_renderer(r, a, source_hash=None):
+    """Applies the command line settings to the Renderer"""
+    r.namespaces = a.namespaces
+    r.is_gccxml = a.is_gccxml
+    r.is_timestamp = a.stamp == "date"
+    r.is_instrumented = a.is_instrumented
+    r.is_multi_phase = a.is_multi_phase
+    r.is_per_interpreter_gil = a.is_per_interpreter_gil
+    r.is_shared_lib = a.is_shared_lib
+    r.is_limited_api = a.is_limited_api
+    if a.stamp == "hash":
+        r.source_hash = source_hash or _get_source_hash(a.input_filenames)
+
+
+def _write_module(a, ctx, source_hash=None):
+    """Renders the Context into the output files of the Arguments"""
+    from liblolpig import Renderer
 
     ctx.module_name = a.module_name
     ctx.header_name = a.header_inc
-    ctx.dump()
+    if not a.is_quiet:
+        ctx.dump()
 
     r = Renderer(ctx)
-    r.namespaces = a.namespaces
-    r.write_to_file(a.output_hpp, r.render_hpp())
-    r.write_to_file(a.output_cpp, r.render_cpp())
+    _init_renderer(r, a, source_hash)
+    with profiling.stage("render_hpp"):
+        hpp = r.render_hpp()
+    with profiling.stage("render_cpp"):
+        cpp = r.render_cpp()
+    with profiling.stage("write"):
+        r.write_to_file(a.output_hpp, hpp)
+        r.write_to_file(a.output_cpp, cpp)
+        if a.setup_file:
+            r.write_to_file(a.setup_file, _render_setup_py(r, a))
+
+
+def _render_setup_py(r, a):
+    """Renders the setuptools script of the Arguments, which compiles the generated
+    cpp file and the c/c++ input files, with paths relative to the script"""
+    import os
+    from liblolpig.doxy import expand_input_filenames
+
+    setup_dir = os.path.dirname(os.path.abspath(a.setup_file))
+
+    def rel(fn):
+        return os.path.relpath(os.path.abspath(fn), setup_dir).replace(os.sep, "/")
+
+    filenames = expand_input_filenames(a.input_filenames)
+    sources, include_dirs = [], []
+    for fn in [a.output_cpp] + filenames:
+        if os.path.splitext(fn)[1].lower() in SOURCE_EXTENSIONS and rel(fn) not in sources:
+            sources.append(rel(fn))
+    for fn in [a.output_hpp] + filenames:
+        d = rel(os.path.dirname(os.path.abspath(fn)))
+        if d not in include_dirs:
+            include_dirs.append(d)
+    return r.render_setup_py(sources, include_dirs)
+
+
+def _render_module(a, parsed=None):
+    """Renders the module code from scanning cpp files.
+    The dict parsed keeps the parsed inputs for other modules in the same run"""
+    import os
+    from liblolpig.doxy import expand_input_filenames
+    from liblolpig.manifest import Manifest
+
+    manifest = Manifest(a.output_manifest)
+    manifest.settings = a.settings()
+    with profiling.stage("manifest"):
+        manifest.update_hashes(expand_input_filenames(a.input_filenames))
+        old_manifest = None if a.is_force else Manifest.load(a.output_manifest)
+    if old_manifest and old_manifest.is_up_to_date(manifest) \
+            and os.path.exists(a.output_hpp) and os.path.exists(a.output_cpp) \
+            and (not a.setup_file or os.path.exists(a.setup_file)):
+        print("module %s is up to date" % a.module_name)
+        return
+    # parsed contexts can only be reused with the same settings
+    if old_manifest and old_manifest.settings != manifest.settings:
+        old_manifest = None
+
+    with profiling.stage("parse"):
+        if a.is_gccxml:
+            ctx = _get_gcc_xml(a.input_filenames, manifest, old_manifest, a.jobs, parsed)
+        else:
+            ctx = _get_doxygen(a.input_filenames, a.cache_dir, manifest, parsed)
+
+    _write_module(a, ctx)
+    manifest.save()
+
+
+def _get_batch_module_arguments(a, name):
+    """Returns the Arguments for module 'name' of the -batch Arguments a"""
+    import os, copy
+    m = copy.copy(a)
+    m.module_name = name
+    m.set_output_name(os.path.join(a.output_name, name))
+    return m
+
+
+def _render_batch(a):
+    """Renders a module for each doxygen group 'lolpig_<module>' from one doxygen run
+    over all input files. The modules are written into the directory a.output_name"""
+    import os, hashlib
+    from liblolpig import DoxygenParser
+    from liblolpig.doxy import expand_input_filenames
+    from liblolpig.manifest import Manifest
+
+    os.makedirs(a.output_name, exist_ok=True)
+    manifest = Manifest(os.path.join(a.output_name, "lolpig_batch.lolpig"))
+    manifest.settings = a.settings()
+    with profiling.stage("manifest"):
+        filenames = expand_input_filenames(a.input_filenames)
+        manifest.update_hashes(filenames)
+        old_manifest = None if a.is_force else Manifest.load(manifest.filename)
+    if old_manifest and old_manifest.is_up_to_date(manifest):
+        outputs = []
+        for name in old_manifest.units:
+            m = _get_batch_module_arguments(a, name)
+            outputs += [m.output_hpp, m.output_cpp]
+        if all(os.path.exists(fn) for fn in outputs):
+            print("modules %s are up to date" % ", ".join(sorted(old_manifest.units)))
+            return
+
+    with profiling.stage("parse"):
+        p = DoxygenParser()
+        p.cache_dir = a.cache_dir
+        p.group_names = []
+        p.batch_prefix = BATCH_GROUP_PREFIX
+        p.parse_files(a.input_filenames)
+
+    for name, group in p.batch_groups().items():
+        m = _get_batch_module_arguments(a, name)
+        with profiling.stage("module %s" % name):
+            with profiling.stage("context"):
+                ctx = p.as_context(group)
+            manifest.add_unit(name, filenames, ctx)
+            # the hash of the module's interface goes into the file head, so the
+            # files of the other modules stay unchanged when one module changes
+            _write_module(m, ctx, hashlib.sha1(manifest.units[name][1]).hexdigest())
+    manifest.save()
 
 
 def _render_export(a):
     """Renders cpp stub from python code"""
     from liblolpig.export import scan_module_files
     from liblolpig import Renderer
-    ctx = scan_module_files(a.input_filenames)
+    with profiling.stage("scan"):
+        ctx = scan_module_files(a.input_filenames, verbose=not a.is_quiet)
 
     r = Renderer(ctx)
-    r.namespaces = a.namespaces
-    r.is_gccxml = a.is_gccxml
-    r.write_to_file(a.output_cpp, r.render_export())
+    _init_renderer(r, a)
+    with profiling.stage("render_export"):
+        code = r.render_export()
+    with profiling.stage("write"):
+        r.write_to_file(a.output_cpp, code)
+
+
+def _read_job_file(filename, argv):
+    """Returns an Arguments instance for each line of the job file.
+    The switches of the command line argv, except -jobfile, precede the switches of each line"""
+    import shlex
+    common = []
+    args = argv[1:]
+    i = 0
+    while i < len(args):
+        if args[i] == "-jobfile":
+            i += 2
+            continue
+        common.append(args[i])
+        i += 1
+
+    jobs = []
+    with open(filename) as f:
+        for line_num, line in enumerate(f):
+            line_args = shlex.split(line, comments=True)
+            if not line_args:
+                continue
+            a = Arguments()
+            if not a.parse(argv[:1] + common + line_args) or a.job_file:
+                a.error("%s:%d: invalid module definition" % (filename, line_num + 1))
+            jobs.append(a)
+    return jobs
 
 
 def process_commands(argv=None):
@@ -163,25 +555,46 @@ def process_commands(argv=None):
         import sys
         argv = sys.argv
 
-    s = "-export -i example/export/stuff.py -o example/export/pydef -n MO PYTHON"
-    # s = "-i vector/pyimpl -o vector/vec_module -n MOP -m vec"
-    # s = "-i test_doxygen/code/vec_base.h -o test_doxygen/gen/vec_module -n MOP -m vec"
-    # s = "-i example/test.cpp -o example/test_module -m mod -n PYMOD"
-    argv = ["lolpig.py", ] + s.split()
-
     a = Arguments()
     if not a.parse(argv) or not a.verify():
         a.help()
         print(a.error_txt)
         exit(1)
 
-    a.dump()
-
-    if a.is_export:
-        _render_export(a)
-    else:
-        _render_module(a)
+    jobs = [a]
+    if a.job_file:
+        try:
+            jobs = _read_job_file(a.job_file, argv)
+        except IOError as e:
+            print(e)
+            exit(1)
+        for job in jobs:
+            if not job.ok:
+                print(job.error_txt)
+                exit(1)
+
+    profiler = None
+    if a.is_profile:
+        profiler = profiling.Profiler(a.pstats_file or None, a.is_profile_memory)
+        profiler.start()
+    try:
+        # parse results shared between the modules
+        parsed = dict()
+        for job in jobs:
+            if not job.is_quiet:
+                job.dump()
+            with profiling.stage("module %s" % job.module_name):
+                if job.is_export:
+                    _render_export(job)
+                elif job.is_batch:
+                    _render_batch(job)
+                else:
+                    _render_module(job, parsed)
+    finally:
+        if profiler:
+            profiler.stop()
+            profiler.dump()
 
 
 if __name__ == "__main__":
-    process_commands()
\ No newline at end of file
+    process_commands()
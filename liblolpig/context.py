@@ -1,6 +1,12 @@
 import inspect
+from collections import OrderedDict
 from .c_types import *
 from .gccxml import ParseError
+from . import profiling
+
+# size of a class' free list if only [freelist] is given
+DEFAULT_FREELIST_SIZE = 64
+
 
 class Namespaced:
     def __init__(self):
@@ -33,6 +39,30 @@ class Argument:
         self.c_type = c_type
 
 
+class Member:
+    """A struct field which is exposed to python through a PyMemberDef"""
+    def __init__(self, c_type="", c_name=""):
+        self.c_name = c_name
+        self.c_type = c_type
+        self.py_name = ""
+        self.py_doc = ""
+        self.options = dict()
+        # offset in the struct in bytes, if known by the parser
+        self.offset = None
+
+    def __str__(self):
+        return "Member(%s %s, %s)" % (self.c_type, self.c_name, self.py_name)
+
+    @property
+    def member_type(self):
+        """The T_* code of the field's type or None"""
+        return MEMBER_TYPES.get(self.c_type.replace(" ", ""))
+
+    @property
+    def is_readonly(self):
+        return bool(self.options.get("readonly"))
+
+
 class Function(Namespaced):
     def __init__(self):
         super(Function, self).__init__()
@@ -47,6 +77,7 @@ class Function(Namespaced):
         self.is_property = False
         self.is_setter = False
         self.py_args = None
+        self.options = dict()
 
     def __hash__(self):
         return hash(self.c_name)
@@ -96,13 +127,18 @@ class Function(Namespaced):
         """Returns the python name of the function, without class"""
         return self.py_name.split(".")[-1]
 
+    def is_fastcall(self):
+        """Returns True if the function uses the METH_FASTCALL convention"""
+        return self.get_function_type() in ("_PyCFunctionFast", "_PyCFunctionFastWithKeywords")
+
     def is_class_method(self):
         return "." in self.py_name
 
     def is_normal_function(self):
         if not self.is_class_method():
             return True
-        return not (self.is_type_function() or self.is_number_function() or self.is_sequence_function())
+        return not (self.is_type_function() or self.is_number_function() or self.is_sequence_function()
+                    or self.is_mapping_function() or self.is_buffer_function())
 
     def is_special_function(self, func_list):
         if self.is_property:
@@ -120,7 +156,25 @@ class Function(Namespaced):
         return self.is_special_function(NUMBER_FUNCS)
 
     def is_sequence_function(self):
-        return self.is_special_function(SEQUENCE_FUNCS)
+        return self.is_special_function(SEQUENCE_FUNCS) and not self.is_mapping_function()
+
+    def is_mapping_function(self):
+        """Returns True if the function belongs into PyMappingMethods, either by
+        the [mapping] option or because it's signature only fits the mapping slot"""
+        if self.is_property:
+            return False
+        n = self.py_name_single()
+        for i in MAPPING_FUNCS:
+            if n == i[0]:
+                if self.options.get("mapping"):
+                    return True
+                type = self.get_function_type()
+                return type == STRUCT_MEMBER_TO_TYPE[i[1]] \
+                       and not type == STRUCT_MEMBER_TO_TYPE[FUNCNAME_TO_STRUCT_MEMBER[n]]
+        return False
+
+    def is_buffer_function(self):
+        return self.is_special_function(BUFFER_FUNCS)
 
     def get_function_type(self):
         """Returns the type of function, e.g 'unary', 'lenfunc', etc.."""
@@ -129,6 +183,14 @@ class Function(Namespaced):
         n = self.py_name_single()
         # see if function's name requires special signature
         if self.is_class_method():
+            if self.options.get("mapping"):
+                for i in MAPPING_FUNCS:
+                    if n == i[0]:
+                        return STRUCT_MEMBER_TO_TYPE[i[1]]
+            if not self.options.get("sequence"):
+                for type in ALTERNATIVE_FUNCS.get(n, ()):
+                    if self.has_signature(type):
+                        return type
             for i in ALL_FUNCS:
                 if n == i[0]:
                     return STRUCT_MEMBER_TO_TYPE[i[1]]
@@ -155,9 +217,19 @@ class Function(Namespaced):
         # dunno
         return None
 
+    def has_signature(self, type):
+        """Returns True if return type and arguments match the function type in c_types.FUNCTIONS"""
+        args = FUNCTIONS[type]
+        return self.c_return_type == args[0] and tuple(self.c_arguments()) == args[1]
+
     def get_c_method_type(self):
         """Returns one of the METH_xxx enums used in PyMethodDef"""
         type = self.get_function_type()
+        # vectorcall signatures are the same for methods and global functions
+        if type == "_PyCFunctionFast":
+            return "METH_FASTCALL"
+        if type == "_PyCFunctionFastWithKeywords":
+            return "METH_FASTCALL | METH_KEYWORDS"
         if self.is_class_method():
             if type == "unaryfunc":
                 return "METH_NOARGS"
@@ -288,10 +360,29 @@ class Class(Namespaced):
         self.methods = []
         self.normal_methods = [] # generated
         self.bases = []
+        self.members = []
+        self.options = dict()
+        self._method_index = None
+        self._method_index_key = None
 
     def __hash__(self):
         return hash(self.c_name)
 
+    def _get_method_index(self):
+        """Returns a dict of python name -> list of methods, in the order of methods.
+        It is rebuilt when methods were added or removed or after invalidate_index()"""
+        key = (id(self.methods), len(self.methods))
+        if self._method_index_key != key:
+            self._method_index = dict()
+            for f in self.methods:
+                self._method_index.setdefault(f.py_name_single(), []).append(f)
+            self._method_index_key = key
+        return self._method_index
+
+    def invalidate_index(self):
+        """Must be called when methods are reordered or renamed"""
+        self._method_index_key = None
+
     @classmethod
     def from_python(cls, pyclass):
         c = Class()
@@ -306,50 +397,101 @@ class Class(Namespaced):
         self._update_methods()
         for f in self.methods:
             f.verify()
+        self.get_richcompare_method()
+        if self.has_method("__clear__") and not self.is_gc():
+            raise TypeError("Class %s defines __clear__ but no __traverse__" % self.py_name)
+        size = self.options.get("freelist", 0)
+        if not (size is True or isinstance(size, int)):
+            raise ValueError("Class %s has invalid freelist size '%s'" % (self.py_name, size))
+        for m in self.members:
+            if not m.member_type:
+                raise TypeError("Member %s.%s has unsupported type %s, expected one of %s" % (
+                    self.py_name, m.py_name, m.c_type, ", ".join(sorted(MEMBER_TYPES))))
+        names = self.attribute_names
+        for name in names:
+            if not name.isidentifier():
+                raise ValueError("Class %s has invalid attribute name '%s'" % (self.py_name, name))
+        if len(set(names)) != len(names):
+            raise ValueError("Class %s has duplicate attribute names" % self.py_name)
+
+    @property
+    def freelist_size(self):
+        """Maximum number of instances kept for reuse, or 0 if no free list"""
+        size = self.options.get("freelist", 0)
+        if size is True:
+            return DEFAULT_FREELIST_SIZE
+        return size
+
+    @property
+    def attribute_names(self):
+        """List of the names given by [attributes=name1 name2 ...], the index
+        is the id returned by the generated attribute_id function"""
+        names = self.options.get("attributes")
+        if not names or names is True:
+            return []
+        return str(names).split()
 
     def merge(self, other):
+        index = self._get_method_index()
         for i in other.methods:
             if not self.has_method(i.c_name):
                 self.methods.append(i)
+                # keep the index up to date instead of rebuilding it for each method
+                index.setdefault(i.py_name_single(), []).append(i)
+                self._method_index_key = (id(self.methods), len(self.methods))
             if not self.bases:
                 self.bases = i.bases
+        for m in other.members:
+            if not any(m.c_name == x.c_name for x in self.members):
+                self.members.append(m)
 
     def properties(self):
         """Returns all Functions which are properties"""
-        p = []
+        p = OrderedDict()
         for f in self.methods:
             if f.is_property:
-                tup = None
-                for i in p:
-                    if (i[0] and i[0].py_name == f.py_name) or (i[1] and i[1].py_name == f.py_name):
-                        tup = i
-                        break
-                if not tup:
-                    tup = [None, None]
-                    p.append(tup)
+                tup = p.setdefault(f.py_name, [None, None])
                 if f.is_setter:
                     tup[1] = f
                 else:
                     tup[0] = f
-        return p
+        return list(p.values())
 
     def _update_names(self):
         self.class_struct_name = self.c_name
         self.type_struct_name = "%s_type_struct" % self.c_name
+        self.type_slots_name = "%s_type_slots" % self.c_name
+        self.type_spec_name = "%s_type_spec" % self.c_name
+        self.state_type_name = "%s_type" % self.c_name
         self.method_struct_name = "%s_method_struct" % self.c_name
         self.number_struct_name = "%s_as_number_struct" % self.c_name
         self.mapping_struct_name = "%s_as_mapping_struct" % self.c_name
         self.sequence_struct_name = "%s_as_sequence_struct" % self.c_name
+        self.buffer_struct_name = "%s_as_buffer_struct" % self.c_name
         self.getset_struct_name = "%s_getset_struct" % self.c_name
+        self.members_struct_name = "%s_members_struct" % self.c_name
+        self.member_offset_func = "member_offset_%s" % self.c_name
         self.class_new_func_name = "create_%s" % self.c_name
         self.class_copy_func_name = "copy_%s" % self.c_name
         self.class_dealloc_func_name = "destroy_%s" % self.c_name
+        self.class_traverse_func_name = "traverse_%s" % self.c_name
         self.init_func_name = "initialize_class_%s" % self.py_name
         self.doc_string_name = "%s_doc_string" % self.c_name
         self.user_new_func = "new_%s" % self.c_name
         self.user_is_func = "is_%s" % self.c_name
         self.user_type_func = "type_%s" % self.c_name
         self.sizeof_func = "sizeof_%s" % self.c_name
+        self.vectorcall_offset_func = "vectorcall_offset_%s" % self.c_name
+        self.freelist_name = "%s_freelist" % self.c_name
+        self.class_alloc_func_name = "alloc_%s" % self.c_name
+        self.class_free_func_name = "free_%s" % self.c_name
+        self.freelist_stats_func_name = "freelist_stats_%s" % self.c_name
+        self.class_call_func_name = "call_%s" % self.c_name
+        self.class_richcompare_func_name = "richcompare_%s" % self.c_name
+        self.class_init_vectorcall_func_name = "init_vectorcall_%s" % self.c_name
+        self.attribute_table_name = "%s_attribute" % self.c_name
+        self.attribute_init_func_name = "initialize_attributes_%s" % self.c_name
+        self.attribute_id_func = "attribute_id_%s" % self.c_name
 
     def _update_methods(self):
         self.normal_methods = []
@@ -366,15 +508,88 @@ class Class(Namespaced):
         return False
 
     def has_method(self, py_name):
-        for i in self.methods:
-            if i.py_name_single() == py_name:
-                return True
-        return False
+        return py_name in self._get_method_index()
 
     def get_method(self, py_name):
-        for i in self.methods:
-            if i.py_name_single() == py_name:
-                return i
+        funcs = self._get_method_index().get(py_name)
+        return funcs[0] if funcs else None
+
+    def get_inherited_method(self, py_name):
+        """Returns the method of this class or of the nearest base which has it, or None"""
+        f = self.get_method(py_name)
+        if f:
+            return f
+        for c in self.bases:
+            f = c.get_inherited_method(py_name)
+            if f:
+                return f
+        return None
+
+    def is_gc(self):
+        """Returns True if the class or one of it's bases takes part in the
+        cyclic garbage collection by implementing __traverse__"""
+        return bool(self.get_inherited_method("__traverse__"))
+
+    def has_vectorcall_call(self):
+        """Returns True if the class' own __call__ uses the vectorcall signature"""
+        f = self.get_method("__call__")
+        return bool(f) and f.get_function_type() == "vectorcallfunc"
+
+    def get_vectorcall_class(self):
+        """Returns the class (self or a base) which implements __call__
+        with the vectorcall signature, or None"""
+        if self.has_method("__call__"):
+            return self if self.has_vectorcall_call() else None
+        for c in self.bases:
+            v = c.get_vectorcall_class()
+            if v:
+                return v
+        return None
+
+    def _get_compare_classes(self):
+        """Returns this class and all it's bases in the order
+        in which comparison methods are looked up"""
+        ret = [self]
+        for c in self.bases:
+            for b in c._get_compare_classes():
+                if b not in ret:
+                    ret.append(b)
+        return ret
+
+    def get_compare_methods(self):
+        """Returns a list of (Function, operator) for all comparison methods
+        with the single-operator signature (self, other), of this class or
+        inherited, unless a nearer class handles the operator with a richcmpfunc"""
+        ret = []
+        classes = self._get_compare_classes()
+        for i in RICHCOMPARE_FUNCS:
+            for c in classes:
+                f = c.get_method(i[0])
+                if f and f.get_function_type() == "binaryfunc":
+                    ret.append((f, i[1]))
+                    break
+                if c.get_richcompare_method():
+                    break
+        return ret
+
+    def get_richcompare_method(self):
+        """Returns the comparison method with the full richcmpfunc signature, or None"""
+        funcs = []
+        for i in RICHCOMPARE_FUNCS:
+            f = self.get_method(i[0])
+            if f and f.get_function_type() == "richcmpfunc":
+                funcs.append(f)
+        if len(funcs) > 1:
+            raise TypeError("Class %s has more than one richcmpfunc comparison: %s" % (
+                self.py_name, ", ".join(f.c_name for f in funcs)))
+        return funcs[0] if funcs else None
+
+    def get_inherited_richcompare_method(self):
+        """Returns the richcmpfunc comparison of this class or of the nearest base which has one, or None"""
+        for c in self._get_compare_classes():
+            f = c.get_richcompare_method()
+            if f:
+                return f
         return None
 
     def has_special_method(self, func_list):
@@ -386,8 +601,32 @@ class Class(Namespaced):
     def has_number_method(self):
         return self.has_special_method(NUMBER_FUNCS)
 
+    def get_sequence_method(self, py_name):
+        for i in self._get_method_index().get(py_name, ()):
+            if not i.is_mapping_function():
+                return i
+        return None
+
+    def get_mapping_method(self, py_name):
+        for i in self._get_method_index().get(py_name, ()):
+            if i.is_mapping_function():
+                return i
+        return None
+
     def has_sequence_method(self):
-        return self.has_special_method(SEQUENCE_FUNCS)
+        for f in SEQUENCE_FUNCS:
+            if self.get_sequence_method(f[0]):
+                return True
+        return False
+
+    def has_mapping_method(self):
+        for f in MAPPING_FUNCS:
+            if self.get_mapping_method(f[0]):
+                return True
+        return False
+
+    def has_buffer_method(self):
+        return self.has_special_method(BUFFER_FUNCS)
 
 
 
@@ -399,8 +638,30 @@ class Context:
         self.module_doc = "The module documentation"
         self.struct_name = "module_struct"
         self.method_struct_name = "module_method_struct"
+        # used with multi-phase initialization
+        self.state_struct_name = "module_state"
+        self.slots_struct_name = "module_slots"
         self.functions = []
         self.classes = []
+        self._index = None
+        self._index_key = None
+
+    def _get_index(self):
+        """Returns a tuple of dicts (id -> object, c_name -> object) for all functions
+        and classes, rebuilt when objects were added or removed or after invalidate_index()"""
+        key = (id(self.functions), len(self.functions), id(self.classes), len(self.classes))
+        if self._index_key != key:
+            by_id, by_c_name = dict(), dict()
+            for i in self.functions + self.classes:
+                by_id.setdefault(i.id, i)
+                by_c_name.setdefault(i.c_name, i)
+            self._index = (by_id, by_c_name)
+            self._index_key = key
+        return self._index
+
+    def invalidate_index(self):
+        """Must be called when objects are reordered or renamed"""
+        self._index_key = None
 
     def dump(self):
         print("FUNCTIONS:")
@@ -415,14 +676,17 @@ class Context:
                 print("    " + f.py_name + " " + str(f.get_function_type()) + " (" + f.key() + ")")
 
     def finalize(self):
-        for f in self.functions:
-            f.verify()
-        for c in self.classes:
-            c.finalize()
-            c.methods.sort(key=lambda f: f.c_name)
-        self.functions.sort(key=lambda f: f.c_name)
-        self.classes.sort(key=lambda c: c.c_name)
-        self._sort_classes_by_bases()
+        with profiling.stage("finalize"):
+            for f in self.functions:
+                f.verify()
+            for c in self.classes:
+                c.finalize()
+                c.methods.sort(key=lambda f: f.c_name)
+                c.invalidate_index()
+            self.functions.sort(key=lambda f: f.c_name)
+            self.classes.sort(key=lambda c: c.c_name)
+            self._sort_classes_by_bases()
+            self.invalidate_index()
 
     def merge(self, other):
         dic = dict()
@@ -436,6 +700,7 @@ class Context:
                 self.classes.append(i)
             else:
                 dic[i.key()].merge(i)
+        self.invalidate_index()
 
 
     def _sort_classes_by_bases(self):
@@ -450,13 +715,7 @@ class Context:
         self.classes = srt
 
     def get_object_by_id(self, id):
-        for i in self.functions + self.classes:
-            if i.id == id:
-                return i
-        return None
+        return self._get_index()[0].get(id)
 
     def get_object_by_c_name(self, c_name):
-        for i in self.functions + self.classes:
-            if i.c_name == c_name:
-                return i
-        return None
+        return self._get_index()[1].get(c_name)
@@ -0,0 +1,28 @@
+"""
+lolpig options in the doc-strings of the parsed objects
+"""
+import re
+
+
+def split_doc_options(text):
+    """
+    Splits lolpig options in square brackets from the beginning of a doc-string,
+    e.g. "[freelist=32, gc] The doc" -> ("The doc", {"freelist": 32, "gc": True})
+    :return: tuple (str, dict)
+    """
+    if not text:
+        return (text, {})
+    match = re.match(r"\s*\[([A-Za-z0-9_=,\s]*)\]", text)
+    if not match:
+        return (text, {})
+    dic = {}
+    for opt in match.groups()[0].split(","):
+        opt = opt.strip()
+        if not opt:
+            continue
+        if "=" in opt:
+            key, value = [x.strip() for x in opt.split("=", 1)]
+            dic[key] = int(value) if value.isdigit() else value
+        else:
+            dic[opt] = True
+    return (text[match.end():].strip(), dic)
@@ -1,17 +1,42 @@
 """
 Doxygen-XML parser
 """
-import os, subprocess, tempfile
+import os, re, subprocess, tempfile, hashlib, shutil
+from collections import OrderedDict
 from xml.etree import ElementTree as ET
+from . import profiling
+from .doc_options import split_doc_options
 
 class ParseError(BaseException):
     pass
 
+
+def expand_input_filenames(filenames):
+    """Returns the input files and the files in input directories, like doxygen's non-recursive INPUT"""
+    ret = []
+    for fn in filenames:
+        if os.path.isdir(fn):
+            for f in sorted(os.listdir(fn)):
+                if os.path.isfile(os.path.join(fn, f)):
+                    ret.append(os.path.join(fn, f))
+        else:
+            ret.append(fn)
+    return ret
+
+
+def unescape_compound_name(name):
+    """Reverts doxygen's escaping of compound names in xml file names,
+    e.g. 'lolpig__vec' -> 'lolpig_vec'"""
+    return re.sub(r"_(_|[a-z])", lambda m: "_" if m.group(1) == "_" else m.group(1).upper(), name)
+
+
 class XmlContext:
     def __init__(self):
         self.id = None
         self.location = ("", 0)
         self.c_name = ""
+        # the doxygen groups containing the object
+        self.groups = []
 
     def get_c_name(self):
         return self.c_name.split("::")[-1]
@@ -39,15 +64,30 @@ class XmlStruct(XmlContext):
         c = Class()
         c.id = self.id
         c.py_name = self.py_name
-        c.py_doc = self.py_doc
+        c.py_doc, c.options = split_doc_options(self.py_doc)
         c.c_name = self.get_c_name()
         c.file = self.location[0]
         c.line = self.location[1]
         c.struct_size = self.size
         c.namespaces = self.get_namespace_list()
+        c.members = [f.as_member() for f in self.fields]
         return c
 
 
+class XmlField(XmlContext):
+    def __init__(self):
+        super().__init__()
+        self.type = None
+        self.py_name = None
+        self.py_doc = None
+
+    def as_member(self):
+        from .context import Member
+        m = Member(self.type, self.c_name)
+        m.py_name = self.py_name
+        m.py_doc, m.options = split_doc_options(self.py_doc)
+        return m
+
 
 class XmlFunction(XmlContext):
     def __init__(self):
@@ -78,7 +118,7 @@ class XmlFunction(XmlContext):
         if len(pyname) > 1:
             f.is_property = pyname[1] == "get" or pyname[1] == "set"
             f.is_setter = pyname[1] == "set"
-        f.py_doc = self.py_doc
+        f.py_doc, f.options = split_doc_options(self.py_doc)
         f.file = self.location[0]
         f.line = self.location[1]
         f.namespaces = self.get_namespace_list()
@@ -95,6 +135,12 @@ class DoxygenParser:
     def __init__(self):
         self.filenames = []
         self.group_names = ["python", "lolpig"]
+        # groups starting with this prefix are parsed as well, see batch_groups()
+        self.batch_prefix = None
+        # directory to keep doxygen's xml output between runs, or None
+        self.cache_dir = None
+        self._group = None
+        self._found_groups = set()
 
         self.structs = dict()
         self.functions = dict()
@@ -126,25 +172,39 @@ class DoxygenParser:
         print("structs", self.structs)
         print("functions", self.functions)
 
-    def as_context(self):
+    def batch_groups(self):
+        """Returns a dict of module name -> group name for all parsed groups
+        starting with batch_prefix, e.g. 'vec' -> 'lolpig_vec'"""
+        if not self.batch_prefix:
+            return dict()
+        return OrderedDict((g[len(self.batch_prefix):], g) for g in sorted(self._found_groups)
+                           if g.startswith(self.batch_prefix) and len(g) > len(self.batch_prefix))
+
+    def as_context(self, group=None):
+        """Returns the Context of all parsed objects, or of the objects in the group"""
         from .context import Context
         c = Context()
         c.filenames = [self.filenames]
-        # global functions
+        # global functions and methods by class name
+        methods = dict()
         for func in self.functions.values():
+            if group is not None and group not in func.groups:
+                continue
             if func.py_name and not func.is_class_function():
                 c.functions.append(func.as_function())
+            if func.py_name:
+                methods.setdefault(func.py_name.split(".")[0], []).append(func)
         # classes
-        for struct in self.structs.values():
+        structs = [s for s in self.structs.values() if group is None or group in s.groups]
+        for struct in structs:
             if struct.py_name:
                 cls = struct.as_class()
-                for func in self.functions.values():
-                    if func.py_name and func.py_name.split(".")[0] == cls.py_name:
-                        cls.methods.append(func.as_function())
+                for func in methods.get(cls.py_name, ()):
+                    cls.methods.append(func.as_function())
                 c.classes.append(cls)
         # resolve class bases
         self.push_stack("resolve bases")
-        for xmlstruct in self.structs.values():
+        for xmlstruct in structs:
             struct = c.get_object_by_id(xmlstruct.id)
             if not struct:
                 self.error("struct '%s' not found in Context" % xmlstruct.id)
@@ -236,8 +296,20 @@ class DoxygenParser:
         SKIP_FUNCTION_MACROS   = YES
         """
 
+        cache_key = None
+        if self.cache_dir:
+            cache_key = self._get_cache_key(filenames, doxygen_config % {
+                "filenames": " ".join(filenames),
+                "output_dir": "",
+            })
+            cached_dir = os.path.join(self.cache_dir, cache_key)
+            if os.path.isdir(cached_dir):
+                print("using cached doxygen output %s" % cached_dir)
+                self._parse_xml_dir(cached_dir)
+                self.filenames = filenames
+                return
+
         with tempfile.TemporaryDirectory() as xml_dir:
-            self.xml_dir = os.path.join(xml_dir, "xml")
             # create config file
             doxygen_config %= {
                "filenames": " ".join(filenames),
@@ -254,51 +326,112 @@ class DoxygenParser:
             # create doxygen output
             self.push_stack("doxygen call")
             try:
-                subprocess.call(args=["doxygen", conf_filename])
-            except subprocess.CalledProcessError as e:
+                with profiling.stage("doxygen"):
+                    subprocess.check_call(args=["doxygen", conf_filename])
+            except (subprocess.CalledProcessError, OSError) as e:
                 self.error(str(e))
             self.pop_stack()
 
-            # parse doxygen output
-            self.push_stack("reading doxygen output")
-            try:
+            # only reached if doxygen succeeded, a failed run is never cached
+            if cache_key:
+                self._store_cache(os.path.join(xml_dir, "xml"), cache_key)
+
+            self._parse_xml_dir(os.path.join(xml_dir, "xml"))
+
+            self.filenames = filenames
+
+    def _parse_xml_dir(self, xml_dir):
+        """Parse the lolpig groups in doxygen's xml output directory"""
+        self.xml_dir = xml_dir
+        self.push_stack("reading doxygen output")
+        try:
+            with profiling.stage("doxygen xml"):
                 for root, dirs, files in os.walk(xml_dir):
                     for f in files:
                         #print(f)
                         if f.startswith("group__") and f.endswith(".xml"):
-                            group_name = f[7:f.index(".xml")]
-                            if group_name in self.group_names:
+                            group_name = unescape_compound_name(f[7:f.index(".xml")])
+                            if group_name in self.group_names or \
+                                    (self.batch_prefix and group_name.startswith(self.batch_prefix)):
+                                self._group = group_name
+                                self._found_groups.add(group_name)
                                 self._parse_doxy_xml(os.path.join(root, f))
-            except IOError as e:
-                self.error(str(e))
-            #except BaseException as e:
-            #    self.error(e.__class__.__name__ + ":" + str(e))
+                self._group = None
+        except IOError as e:
+            self.error(str(e))
+        #except BaseException as e:
+        #    self.error(e.__class__.__name__ + ":" + str(e))
 
-            self.pop_stack()
+        self.pop_stack()
 
-            self.filenames = filenames
+    def _get_cache_key(self, filenames, doxygen_config):
+        """Returns a hash of the input files' contents, the doxygen config
+        and the doxygen executable"""
+        h = hashlib.sha256()
+        h.update(doxygen_config.encode("utf-8"))
+        # the binary's location, size and date stand in for the doxygen version,
+        # so a cache hit does not need to start doxygen at all
+        exe = shutil.which("doxygen")
+        if exe:
+            stat = os.stat(exe)
+            h.update(("%s %d %d" % (exe, stat.st_size, stat.st_mtime)).encode("utf-8"))
+        self.push_stack("hashing input files")
+        for fn in expand_input_filenames(filenames):
+            h.update(fn.encode("utf-8"))
+            try:
+                with open(fn, "rb") as f:
+                    h.update(f.read())
+            except IOError as e:
+                self.error(str(e))
+        self.pop_stack()
+        return h.hexdigest()
+
+    def _store_cache(self, xml_dir, cache_key):
+        """Copy doxygen's xml output into the cache directory"""
+        self.push_stack("storing doxygen output in cache %s" % self.cache_dir)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # copy under a temporary name first, so concurrent runs never see a partial entry
+            tmp_dir = tempfile.mkdtemp(prefix=cache_key + ".", dir=self.cache_dir)
+            shutil.rmtree(tmp_dir)
+            shutil.copytree(xml_dir, tmp_dir)
+            try:
+                os.rename(tmp_dir, os.path.join(self.cache_dir, cache_key))
+            except OSError:
+                # another process stored the same entry
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+        except (IOError, OSError) as e:
+            self.error(str(e))
+        self.pop_stack()
 
     def _parse_doxy_xml(self, filename):
+        """Parses a doxygen xml file incrementally, members are discarded once parsed"""
         print("parsing %s" % filename)
         self.push_stack("parsing xml %s" % filename)
-        root = ET.parse(filename).getroot()
-        comp = root.find("compounddef")
-        if not comp:
+        kind = None
+        level = 0
+        for event, elem in ET.iterparse(filename, events=("start", "end")):
+            if event == "start":
+                level += 1
+                if level == 2 and elem.tag == "compounddef":
+                    kind = elem.attrib.get("kind", "")
+                continue
+            level -= 1
+            if kind == "struct":
+                # struct compounds are small and parsed as a whole
+                if level == 1 and elem.tag == "compounddef":
+                    self._parse_struct(elem)
+                    return
+            elif level == 2 and elem.tag == "innerclass":
+                self._parse_innerclass(elem)
+                elem.clear()
+            elif level == 3 and elem.tag == "memberdef":
+                self.push_stack("sectiondef.memberdef %s" % elem.get("id", "unknown"))
+                self._parse_section_member(elem)
+                self.pop_stack()
+                elem.clear()
+        if kind is None:
             self.error("No compounddef found in xml")
-        kind = comp.attrib.get("kind", "")
-        if kind == "struct":
-            self._parse_struct(comp)
-            return
-        for child in comp:
-            #print(child.tag)
-            if child.tag == "innerclass":
-                self._parse_innerclass(child)
-            elif child.tag == "sectiondef":
-                for mem in child:
-                    if mem.tag == "memberdef":
-                        self.push_stack("sectiondef.memberdef %s" % mem.get("id", "unknown"))
-                        self._parse_section_member(mem)
-                        self.pop_stack()
         self.pop_stack()
 
     def _parse_section_member(self, root):
@@ -407,8 +540,12 @@ class DoxygenParser:
             nnode = i.find("declname")
             o.arguments.append((self._get_type(i), nnode.text if nnode is not None else ""))
         self.pop_stack()
+        if self._add_to_group(o.id):
+            self.pop_stack()
+            return
         if self.has_object(o.id):
             self.error("Duplicate function id '%s'" % o.id)
+        o.groups.append(self._group)
         self.functions.setdefault(o.id, o)
         self.pop_stack()
 
@@ -431,8 +568,40 @@ class DoxygenParser:
             if not "refid" in bnode.attrib:
                 self.error("Could not find 'refid' in %s" % bnode)
             o.bases_id.append(bnode.get("refid"))
+        for mnode in node.iterfind("sectiondef/memberdef[@kind='variable']"):
+            field = self._parse_field(mnode)
+            if field:
+                o.fields.append(field)
+        if self._add_to_group(o.id):
+            self.pop_stack()
+            return
         if self.has_object(o.id):
             self.error("Duplicate struct id '%s'" % o.id)
+        o.groups.append(self._group)
         self.structs.setdefault(o.id, o)
         self.pop_stack()
 
+    def _parse_field(self, node):
+        """Returns the XmlField of a struct member variable or None if it has no python name"""
+        dnode = node.find("detaileddescription")
+        if dnode is None or not self._get_sub_doc(dnode).strip().startswith(self.py_tag_open):
+            return None
+        o = XmlField()
+        o.c_name = node.find("name").text
+        self.push_stack("parsing field %s" % o.c_name)
+        o.id = node.attrib.get("id")
+        o.type = self._get_type(node)
+        o.py_name, o.py_doc = self._get_doc(node)
+        o.location = self._get_location(node)
+        self.pop_stack()
+        return o
+
+    def _add_to_group(self, id):
+        """Adds the current group to an object parsed from another group,
+        returns False if there is no such object"""
+        o = self.get_object(id)
+        if o is None or self._group in o.groups:
+            return False
+        o.groups.append(self._group)
+        return True
+
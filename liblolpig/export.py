@@ -24,9 +24,10 @@ class _Exporter:
     def __init__(self):
         self.scope_stack = []
         self.context = None
+        self.is_verbose = True
 
     def log(self, str):
-        if 1:
+        if self.is_verbose:
             print(" " * len(self.scope_stack) + self.full_scope_name() + ": " + str)
 
     def scope_name(self):
@@ -142,15 +143,17 @@ class _Exporter:
                         c.bases.append(i)
 
 
-def scan_module(module):
+def scan_module(module, verbose=True):
     """
     Scans the module and returns a liblolpig.Context class
     :param module: a loaded module
+    :param verbose: print the inspected objects
     """
     if not inspect.ismodule(module):
         raise TypeError("Expected module, got %s" % type(module))
 
     c = _Exporter()
+    c.is_verbose = verbose
     c.inspect_module(module)
     return c.context
 
@@ -161,7 +164,7 @@ def _import_module_file(module_file):
     module = SourceFileLoader(module_name, module_file).load_module()
     return module
 
-def scan_module_files(files):
+def scan_module_files(files, verbose=True):
     mods = []
     for f in files:
         mods.append(_import_module_file(f))
@@ -169,9 +172,9 @@ def scan_module_files(files):
     if not mods:
         raise RuntimeError("No modules to scan")
 
-    context = scan_module(mods[0])
+    context = scan_module(mods[0], verbose)
     for i in range(1,len(mods)):
-        context.merge(scan_module(mods[i]))
+        context.merge(scan_module(mods[i], verbose))
 
     return context
 
@@ -1,6 +1,8 @@
 """
 GCC-XML parser
 """
+from . import profiling
+from .doc_options import split_doc_options
 
 class ParseError(BaseException):
     pass
@@ -105,7 +107,7 @@ class XmlStruct(XmlContext):
         from .context import Class
         c = Class()
         c.py_name = self.py_name
-        c.py_doc = self.py_doc
+        c.py_doc, c.options = split_doc_options(self.py_doc)
         c.c_name = self.c_name
         c.line = self.line
         c.struct_size = self.size
@@ -118,8 +120,20 @@ class XmlField(XmlContext):
     def __init__(self):
         super().__init__()
         self.c_name = None
+        self.py_name = None
+        self.py_doc = None
         self.type = None
         self.type_id = None
+        # in bits
+        self.offset = 0
+
+    def as_member(self):
+        from .context import Member
+        m = Member(self.type.c_string(), self.c_name)
+        m.py_name = self.py_name
+        m.py_doc, m.options = split_doc_options(self.py_doc)
+        m.offset = self.offset // 8
+        return m
 
 
 class XmlArgument:
@@ -170,7 +184,7 @@ class XmlFunction(XmlContext):
         if len(pyname) > 1:
             f.is_property = pyname[1] == "get" or pyname[1] == "set"
             f.is_setter = pyname[1] == "set"
-        f.py_doc = self.py_doc
+        f.py_doc, f.options = split_doc_options(self.py_doc)
         f.line = self.line
         f.end_line = self.end_line
         f.namespaces = self.get_namespace_list()
@@ -192,9 +206,15 @@ class XmlParser:
         self.namespaces = dict()
         self.files = dict()
         self.classes = dict()
+        # only keep the objects needed for the python-annotated objects
+        self.is_streaming = True
+        # directories whose objects are always kept, besides the parsed file's directory
+        self.input_dirs = []
 
     def parse(self, filename, clean_temps=True):
         self._parse(filename, clean_temps=clean_temps)
+        if self.is_streaming:
+            self._prune()
         self._resolve_types()
         self._resolve_context(self.namespaces.values())
         self._resolve_context(self.functions.values())
@@ -203,6 +223,14 @@ class XmlParser:
         self._resolve_context(self.fields.values())
         self._find_lolpig_def(self.functions.values())
         self._find_lolpig_def(self.structs.values())
+        for f in self.fields.values():
+            if f.file:
+                f.py_name, f.py_doc = self._get_field_def(f.file, f.line)
+
+    def get_dependencies(self):
+        """Returns the names of all files of the parsed translation unit, except the parsed file"""
+        return sorted(set(f.name for f in self.files.values()
+                          if f.name and f.name != "<builtin>" and f.name != self.filename))
 
     def dump(self):
         print("namespaces", self.namespaces)
@@ -213,15 +241,25 @@ class XmlParser:
         from .context import Context
         c = Context()
         c.filenames = [self.filename]
+        # global functions and methods by class name
+        methods = dict()
         for func in self.functions.values():
             if func.py_name and not func.is_class_function():
                 c.functions.append(func.as_function())
+            if func.py_name:
+                methods.setdefault(func.py_name.split(".")[0], []).append(func)
+        # python-annotated fields by struct id
+        fields = dict()
+        for f in self.fields.values():
+            if f.py_name:
+                fields.setdefault(f.context_id, []).append(f)
         for struct in self.structs.values():
             if struct.py_name:
                 cls = struct.as_class()
-                for func in self.functions.values():
-                    if func.py_name and func.py_name.split(".")[0] == cls.py_name:
-                        cls.methods.append(func.as_function())
+                for func in methods.get(cls.py_name, ()):
+                    cls.methods.append(func.as_function())
+                for f in sorted(fields.get(struct.id, ()), key=lambda f: f.offset):
+                    cls.members.append(f.as_member())
                 c.classes.append(cls)
         # resolve bases
         for xmlstruct in self.structs.values():
@@ -316,6 +354,51 @@ class XmlParser:
                     raise ParseError("Unknown context id %s in object %s" % (i.context_id, i))
                 i.context = self.get_object(i.context_id)
 
+    def _prune(self):
+        """Removes all objects which are not reachable from functions and structs
+        in files of the input directories or in files containing LOLPIG_DEF"""
+        import os
+        dirs = [os.path.dirname(os.path.abspath(self.filename))]
+        dirs += [os.path.abspath(d) for d in self.input_dirs]
+
+        def is_root(obj):
+            file = self.files.get(obj.file_id)
+            if not file or file.name.startswith("<"):
+                return False
+            path = os.path.abspath(file.name)
+            for d in dirs:
+                if path.startswith(d + os.sep):
+                    return True
+            return bool(self._scan_file(file))
+
+        fields_by_context = dict()
+        for f in self.fields.values():
+            fields_by_context.setdefault(f.context_id, []).append(f)
+
+        keep = set()
+        todo = [o for o in list(self.functions.values()) + list(self.structs.values()) if is_root(o)]
+        while todo:
+            o = todo.pop()
+            if o.id in keep:
+                continue
+            keep.add(o.id)
+            ids = [o.context_id, getattr(o, "ref_id", None), getattr(o, "type_id", None),
+                   getattr(o, "return_type_id", None)]
+            ids += getattr(o, "bases_id", [])
+            ids += [a.type_id for a in getattr(o, "arguments", [])]
+            for id in ids:
+                if id and id not in keep:
+                    obj = self.get_object(id)
+                    if obj is None:
+                        obj = self.fields.get(id)
+                    if obj is not None:
+                        todo.append(obj)
+            todo += fields_by_context.get(o.id, [])
+
+        for dic in (self.types, self.structs, self.functions, self.fields, self.namespaces, self.classes):
+            for id in [id for id in dic if id not in keep]:
+                del dic[id]
+
     def _find_lolpig_def(self, iter):
         for obj in iter:
             if obj.file:# and func.file.name == self.filename:
@@ -329,15 +412,20 @@ class XmlParser:
         import subprocess, os
 
         xmlname = filename + "_temp_.xml"
-        subprocess.call(["gccxml", filename,
-                         "--gccxml-cxxflags", "-DGCC_XML",
-                         #"--gccxml-cxxflags", "-std=c++11",
-                         #"--gccxml-executable", "g++",
-                         "-fxml=%s" % xmlname])
+        with profiling.stage("gccxml"):
+            subprocess.call(["gccxml", filename,
+                             "--gccxml-cxxflags", "-DGCC_XML",
+                             #"--gccxml-cxxflags", "-std=c++11",
+                             #"--gccxml-executable", "g++",
+                             "-fxml=%s" % xmlname])
 
         import xml.etree.ElementTree as ET
-        tree = ET.parse(xmlname)
-        self._parse_xml(tree.getroot())
+        with profiling.stage("gccxml xml"):
+            if self.is_streaming:
+                self._parse_xml_stream(ET.iterparse(xmlname, events=("start", "end")))
+            else:
+                tree = ET.parse(xmlname)
+                self._parse_xml(tree.getroot())
         if clean_temps:
             os.remove(xmlname)
 
@@ -346,37 +434,57 @@ class XmlParser:
     def _parse_xml(self, root):
 
         for child in root:
-            #print(child.tag)
-            if child.tag == "Namespace":
-                self._parse_namespace(child)
-            elif child.tag == "File":
-                self._parse_file(child)
-            elif child.tag == "Function":
-                self._parse_function(child)
-            elif child.tag == "FundamentalType":
-                self._parse_fundamental_type(child)
-            elif child.tag == "PointerType":
-                self._parse_pointer_type(child)
-            elif child.tag == "ReferenceType":
-                self._parse_reference_type(child)
-            elif child.tag == "ArrayType":
-                self._parse_array_type(child)
-            elif child.tag == "CvQualifiedType":
-                self._parse_cv_type(child)
-            elif child.tag == "FunctionType":
-                self._parse_function_type(child)
-            elif child.tag == "Union":
-                self._parse_union_type(child)
-            elif child.tag == "Typedef":
-                self._parse_typedef(child)
-            elif child.tag == "Enumeration":
-                self._parse_enum(child)
-            elif child.tag == "Struct":
-                self._parse_struct(child)
-            elif child.tag == "Field":
-                self._parse_field(child)
-            elif child.tag == "Class":
-                self._parse_class(child)
+            self._parse_xml_node(child)
+
+    def _parse_xml_stream(self, events):
+        """Parses the top-level nodes from ElementTree.iterparse events
+        and discards each node once parsed"""
+        root = None
+        level = 0
+        for event, elem in events:
+            if event == "start":
+                level += 1
+                if root is None:
+                    root = elem
+                continue
+            level -= 1
+            if level == 1:
+                self._parse_xml_node(elem)
+                # drop the parsed node from the root
+                root.clear()
+
+    def _parse_xml_node(self, child):
+        #print(child.tag)
+        if child.tag == "Namespace":
+            self._parse_namespace(child)
+        elif child.tag == "File":
+            self._parse_file(child)
+        elif child.tag == "Function":
+            self._parse_function(child)
+        elif child.tag == "FundamentalType":
+            self._parse_fundamental_type(child)
+        elif child.tag == "PointerType":
+            self._parse_pointer_type(child)
+        elif child.tag == "ReferenceType":
+            self._parse_reference_type(child)
+        elif child.tag == "ArrayType":
+            self._parse_array_type(child)
+        elif child.tag == "CvQualifiedType":
+            self._parse_cv_type(child)
+        elif child.tag == "FunctionType":
+            self._parse_function_type(child)
+        elif child.tag == "Union":
+            self._parse_union_type(child)
+        elif child.tag == "Typedef":
+            self._parse_typedef(child)
+        elif child.tag == "Enumeration":
+            self._parse_enum(child)
+        elif child.tag == "Struct":
+            self._parse_struct(child)
+        elif child.tag == "Field":
+            self._parse_field(child)
+        elif child.tag == "Class":
+            self._parse_class(child)
 
     def _parse_context(self, node, ctx):
         ctx.id = node.attrib.get("id", None)
@@ -473,7 +581,9 @@ class XmlParser:
     def _parse_field(self, node):
         field = XmlField()
         self._parse_context(node, field)
+        field.c_name = node.attrib.get("name")
         field.type_id = node.attrib.get("type")
+        field.offset = int(node.attrib.get("offset", 0))
         self.fields.setdefault(field.id, field)
 
     def _parse_class(self, node):
@@ -482,24 +592,27 @@ class XmlParser:
         c.c_name = node.attrib.get("name")
         self.classes.setdefault(c.id, c)
 
-    def _get_def(self, file, line, name):
-        """
-        Returns python name and doc-string from the LOLPIG_DEF macro.
-        line expected to point at the beginning of the function/struct body
-        :return: tuple
-        """
+    def _scan_file(self, file):
+        """Reads the file once, returns it's content if it contains LOLPIG_DEF"""
         if file.do_scan:
             file.do_scan = False
             if file.name.startswith("<"):# or file.name.startswith("/")):
-                return None, None
+                return None
             with open(file.name) as f:
                 file.content = f.read()
             if not "LOLPIG_DEF" in file.content:
                 file.content = None
             else:
                 file.lines = file.content.split("\n")
+        return file.content
 
-        if not file.content:
+    def _get_def(self, file, line, name):
+        """
+        Returns python name and doc-string from the LOLPIG_DEF macro.
+        line expected to point at the beginning of the function/struct body
+        :return: tuple
+        """
+        if not self._scan_file(file):
             return None, None
         if line < 1 or line >= len(file.lines):
             raise ParseError("line number %d out of range" % line)
@@ -516,7 +629,31 @@ class XmlParser:
         txt = ""
         for i in range(line, endline):
             txt += file.lines[i] + "\n"
+        return self._parse_def(txt)
+
+    def _get_field_def(self, file, line):
+        """
+        Returns python name and doc-string from the LOLPIG_DEF macro in the lines
+        before a struct field, line is the field's line number
+        :return: tuple
+        """
+        if not self._scan_file(file):
+            return None, None
+        if line < 1 or line > len(file.lines):
+            raise ParseError("line number %d out of range" % line)
+        # the DEF must directly precede the field's line
+        start = line - 2
+        while start >= 0 and "LOLPIG_DEF(" not in file.lines[start]:
+            if file.lines[start].strip().endswith((";", "{", "}")):
+                return None, None
+            start -= 1
+        if start < 0:
+            return None, None
+        return self._parse_def("\n".join(file.lines[start:line - 1]) + "\n")
 
+    def _parse_def(self, txt):
+        """Returns python name and doc-string of the LOLPIG_DEF macro at the
+        beginning of txt, if only whitespace follows the macro"""
         # scan first part of DEF for proper syntax
         import re
         match = None
@@ -0,0 +1,129 @@
+"""
+Manifest of a previous lolpig run, to skip or reduce parsing and rendering
+when the inputs did not change
+"""
+import os, hashlib, pickle
+
+from . import __version__
+
+MANIFEST_FORMAT = 2
+
+
+def hash_file(filename):
+    """Returns the sha1 of the file's content"""
+    h = hashlib.sha1()
+    with open(filename, "rb") as f:
+        h.update(f.read())
+    return h.hexdigest()
+
+
+def hash_dependency(filename):
+    """Returns the sha1 of the file's content, or None if the file does not exist"""
+    if not os.path.isfile(filename):
+        return None
+    return hash_file(filename)
+
+
+def get_generator_version():
+    """Returns the lolpig version plus a hash of the liblolpig sources,
+    so changes to the generator invalidate all manifests"""
+    h = hashlib.sha1()
+    path = os.path.dirname(os.path.abspath(__file__))
+    for fn in sorted(os.listdir(path)):
+        if fn.endswith(".py"):
+            h.update(fn.encode("utf-8"))
+            with open(os.path.join(path, fn), "rb") as f:
+                h.update(f.read())
+    return "%s-%s" % (__version__, h.hexdigest())
+
+
+class Manifest:
+    """
+    Records the settings of a run, the hash of each input file and the
+    parsed Context of each parse unit (an input file, or all input files
+    for parsers that need to see them together).
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.version = get_generator_version()
+        self.settings = dict()
+        # filename -> sha1 of content
+        self.hashes = dict()
+        # unit name -> (tuple of filenames, pickled Context, dict of dependency -> sha1)
+        self.units = dict()
+        # sha1 of the dependencies, hashed once per run
+        self._dependency_hashes = dict()
+
+    @classmethod
+    def load(cls, filename):
+        """Returns the Manifest stored in filename, or None if it does not exist or can not be read"""
+        try:
+            with open(filename, "rb") as f:
+                data = pickle.load(f)
+        except (IOError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+            return None
+        if not isinstance(data, dict) or data.get("format") != MANIFEST_FORMAT:
+            return None
+        m = Manifest(filename)
+        if data["version"] != m.version:
+            return None
+        m.settings = data["settings"]
+        m.hashes = data["hashes"]
+        m.units = data["units"]
+        return m
+
+    def save(self):
+        with open(self.filename, "wb") as f:
+            pickle.dump({
+                "format": MANIFEST_FORMAT,
+                "version": self.version,
+                "settings": self.settings,
+                "hashes": self.hashes,
+                "units": self.units,
+            }, f)
+
+    def update_hashes(self, filenames):
+        for fn in filenames:
+            self.hashes[fn] = hash_file(fn)
+
+    def get_dependency_hash(self, filename):
+        """Returns the sha1 of a file the parse units depend on, see hash_dependency()"""
+        if filename in self.hashes:
+            return self.hashes[filename]
+        if filename not in self._dependency_hashes:
+            self._dependency_hashes[filename] = hash_dependency(filename)
+        return self._dependency_hashes[filename]
+
+    def add_unit(self, name, filenames, context, dependencies=()):
+        """Store the Context parsed from the filenames.
+        dependencies are other files the Context depends on, e.g. included headers"""
+        hashes = dict((fn, self.get_dependency_hash(fn)) for fn in dependencies if fn not in filenames)
+        self.units[name] = (tuple(filenames), pickle.dumps(context), hashes)
+
+    def get_unit_dependencies(self, name):
+        """Returns the dependencies given to add_unit()"""
+        return tuple(self.units[name][2]) if name in self.units else ()
+
+    def _are_dependencies_unchanged(self, name, current):
+        for fn, h in self.units[name][2].items():
+            if current.get_dependency_hash(fn) != h:
+                return False
+        return True
+
+    def get_unit(self, name, current):
+        """Returns a copy of the stored Context of the unit if none of it's files
+        and dependencies differ from the hashes in Manifest current, otherwise None"""
+        if name not in self.units:
+            return None
+        filenames, data, _ = self.units[name]
+        for fn in filenames:
+            if self.hashes.get(fn) != current.hashes.get(fn):
+                return None
+        if not self._are_dependencies_unchanged(name, current):
+            return None
+        return pickle.loads(data)
+
+    def is_up_to_date(self, current):
+        """Returns True if settings, inputs and the dependencies of all units equal those of Manifest current"""
+        return self.settings == current.settings and self.hashes == current.hashes \
+            and all(self._are_dependencies_unchanged(name, current) for name in self.units)
@@ -0,0 +1,94 @@
+"""
+Wall time and peak memory of the stages of a lolpig run
+"""
+import time, contextlib, tracemalloc
+
+# the Profiler between start() and stop()
+_active = None
+
+
+@contextlib.contextmanager
+def stage(name):
+    """Records the enclosed code as stage 'name' of the active Profiler,
+    does nothing if no Profiler is running"""
+    if _active is None:
+        yield
+    else:
+        with _active.stage(name):
+            yield
+
+
+class Profiler:
+    """
+    Records the wall time and, if is_memory, the peak of the memory allocated
+    by python (tracemalloc) for each stage. Stages may be nested.
+    tracemalloc slows down python code several times, so the times are only
+    comparable between runs with the same is_memory.
+    If pstats_file is given, the whole run is also profiled with cProfile
+    and the statistics are written to the file in stop()
+    """
+    def __init__(self, pstats_file=None, is_memory=False):
+        self.pstats_file = pstats_file
+        self.is_memory = is_memory
+        # list of [name, depth, seconds, peak bytes], in order of entry
+        self.stages = []
+        self._open = []
+        self._cprofile = None
+
+    def start(self):
+        global _active
+        _active = self
+        if self.is_memory:
+            tracemalloc.start()
+        if self.pstats_file:
+            import cProfile
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+
+    def stop(self):
+        global _active
+        if self._cprofile:
+            self._cprofile.disable()
+            self._cprofile.dump_stats(self.pstats_file)
+            self._cprofile = None
+        if self.is_memory:
+            tracemalloc.stop()
+        _active = None
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        entry = [name, len(self._open), 0., 0]
+        self.stages.append(entry)
+        self._update_peak()
+        self._open.append(entry)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            entry[2] = time.perf_counter() - start
+            self._update_peak()
+            self._open.pop()
+
+    def _update_peak(self):
+        """Passes the peak since the last call to all open stages"""
+        if not self.is_memory:
+            return
+        peak = tracemalloc.get_traced_memory()[1]
+        for entry in self._open:
+            entry[3] = max(entry[3], peak)
+        # the peak of each stage is only measured from it's start (python >= 3.9)
+        if hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+
+    def dump(self):
+        if self.is_memory:
+            print("%-40s %10s %12s" % ("stage", "seconds", "peak MiB"))
+        else:
+            print("%-40s %10s" % ("stage", "seconds"))
+        for name, depth, seconds, peak in self.stages:
+            if self.is_memory:
+                print("%-40s %10.4f %12.2f" % ("  " * depth + name, seconds, peak / 1024. / 1024.))
+            else:
+                print("%-40s %10.4f" % ("  " * depth + name, seconds))
+        if self.pstats_file:
+            print("cProfile statistics written to %s" % self.pstats_file)
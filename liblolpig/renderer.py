@@ -2,6 +2,7 @@
 Collection of formatting helper functions
 and the final Renderer to generate the output
 """
+import re, functools
 from collections import OrderedDict
 from .c_types import *
 
@@ -82,6 +83,71 @@ def change_text_indent(code, len):
     return code
 
 
+class Template:
+    """
+    A text with %(key)s placeholders, split once into literal and placeholder
+    segments, so that rendering is linear in the size of the output.
+    See apply_string_dict() for the substitution rules.
+    """
+    _placeholder = re.compile(r"%\(([A-Za-z0-9_]+)\)s")
+
+    def __init__(self, code):
+        # list of (literal text, key or None)
+        self.segments = []
+        pos = 0
+        for m in self._placeholder.finditer(code):
+            self.segments.append((code[pos:m.start()], m.group(1)))
+            pos = m.end()
+        self.segments.append((code[pos:], None))
+
+    def render(self, dic):
+        # literal texts and placeholders, in order
+        pieces = []
+        slots = dict()
+        for literal, key in self.segments:
+            pieces.append(literal)
+            if key is not None:
+                slots.setdefault(key, []).append(len(pieces))
+                pieces.append("%(" + key + ")s")
+        # keys are applied in the order of dic, which decides the
+        # indentation when several tags share a line
+        for key in dic:
+            for idx in slots.get(key, ()):
+                self._substitute(pieces, idx, dic[key])
+        return "".join(pieces)
+
+    @staticmethod
+    def _substitute(pieces, idx, value):
+        # length of the line up to the tag, if it's only whitespace
+        indent = 0
+        i = idx - 1
+        while i >= 0:
+            text = pieces[i]
+            nl = text.rfind("\n")
+            line = text[nl+1:]
+            if not all(is_whitespace(c) for c in line):
+                break
+            indent += len(line)
+            if nl >= 0:
+                # replace the leading whitespace by the indented value
+                j, strip = idx - 1, indent
+                while strip:
+                    n = min(len(pieces[j]), strip)
+                    pieces[j] = pieces[j][:len(pieces[j])-n]
+                    strip -= n
+                    j -= 1
+                pieces[idx] = change_text_indent(value, indent)
+                return
+            i -= 1
+        pieces[idx] = change_text_indent(value, 0)
+
+
+@functools.lru_cache(maxsize=256)
+def compile_template(code):
+    """Returns the Template for code, templates are cached"""
+    return Template(code)
+
+
 def apply_string_dict(code_, dic):
     """
     Replaces %(key)s tags in the given code_ with values from the dictionary dic.
@@ -102,30 +168,11 @@ def apply_string_dict(code_, dic):
         for i in bar:
             baz
 
-    The original indentation of dic values will be stripped using change_text_indent()
+    The original indentation of dic values will be stripped using change_text_indent().
+    Tags inside the dic values are not replaced.
     :return: str
     """
-    code = str(code_)
-    for key in dic:
-        skey = "%(" + key + ")s"
-        pos = code.find(skey)
-        while pos >= 0:
-            linestart = code.rfind("\n", 0, pos)
-            if linestart < 0:
-                linestart = pos
-                indent = 0
-            else:
-                linestart += 1
-                for i in range(linestart, pos):
-                    if not is_whitespace(code[i]):
-                        linestart = pos
-                        break
-                indent = pos - linestart
-            #print(linestart, pos, indent)
-            text = change_text_indent(dic[key], indent)
-            code = code[:linestart] + text + code[pos + len(skey):]
-            pos = code.find(skey)
-    return code
+    return compile_template(str(code_)).render(dic)
 
 
 
@@ -209,6 +256,11 @@ def render_function(name, type, cpp, for_class=None):
     return code
 
 
+def compat_type_name(member):
+    """Name of the typedef for a struct member in STRUCT_MEMBER_COMPAT_TYPES"""
+    return "lolpig_%s_t" % member
+
+
 def render_struct(structtypename, struct_table, name, dictionary, first_line=""):
     """
     Renders a struct with the contents from 'dictionary'
@@ -219,6 +271,8 @@ def render_struct(structtypename, struct_table, name, dictionary, first_line="")
     :param first_line: optional first line in struct entry, e.g. "PyVarObject_HEAD_INIT(NULL, 0)"
     :return: str
     """
+    struct_table = [(i[0], compat_type_name(i[0]) if i[0] in STRUCT_MEMBER_COMPAT_TYPES else i[1])
+                    for i in struct_table]
     name_width = 1
     type_width = 1
     for i in struct_table:
@@ -235,11 +289,15 @@ def render_struct(structtypename, struct_table, name, dictionary, first_line="")
         # return type of cppy's 'new' function is the class struct, not PyObject
         if i[0] == "tp_new":
             cast = "reinterpret"
+        value = str(dictionary.get(i[0], "NULL"))
+        # NULL does not convert to the integer types of newer python versions
+        if i[0] in STRUCT_MEMBER_COMPAT_TYPES and value == "NULL":
+            value = "0"
         code += "%(indent)s%(name)s %(type)s(%(value)s)" % {
             "indent": INDENT,
             "name" : ("/* %s */" % i[0]).ljust(name_width + 6),
             "type" : ("%s_cast<%s>" % (cast, i[1])).ljust(type_width + 13),
-            "value" : str(dictionary.get(i[0], "NULL"))
+            "value" : value
         }
         if not i == struct_table[-1]:
             code += ","
@@ -261,6 +319,22 @@ class Renderer:
         self.is_doxygen_group_created = False
         self.context = context
         self.namespaces = []
+        # hash of the input files, printed in the file head instead of the date
+        self.source_hash = None
+        self.is_timestamp = True
+        # wrap functions in call counting shims, see _render_instrumentation()
+        self.is_instrumented = False
+        # PEP 489 module initialization with heap types and per-module state
+        self.is_multi_phase = False
+        # declare support for sub-interpreters with their own GIL (python >= 3.12), only
+        # valid if the user code keeps no static python objects, requires is_multi_phase
+        self.is_per_interpreter_gil = False
+        # export PyInit_<module> and include <Python.h> from the include path of the
+        # python installation, to build the module as extension (shared library)
+        self.is_shared_lib = False
+        # only use the stable ABI (Py_LIMITED_API), the classes are heap types
+        self.is_limited_api = False
+        self._instrumented = None
         self.default_inc = change_text_indent("""
         #include <python3.4/Python.h>
         #include <python3.4/structmember.h>
@@ -276,9 +350,20 @@ class Renderer:
 
     @classmethod
     def write_to_file(cls, filename, code):
+        """Writes the code to the file, unless the file already has this content,
+        to keep it's modification time for make & co.
+        :return: True if the file was written"""
         import codecs
+        try:
+            with codecs.open(filename, "r", "utf-8") as file:
+                if file.read() == code:
+                    print("%s is unchanged" % filename)
+                    return False
+        except (IOError, UnicodeDecodeError):
+            pass
         with codecs.open(filename, "w", "utf-8") as file:
             file.write(code)
+        return True
 
     def to_namespace_dict(self, objs):
         """Creates a dict with each obj in list objs belonging
@@ -292,17 +377,52 @@ class Renderer:
                 dic[n].append(i)
         return dic
 
-    def _lolpig_head(self):
+    def _stamp(self):
         import datetime
+        if self.source_hash:
+            return " from sources %s" % self.source_hash
+        elif self.is_timestamp:
+            return " on %s" % datetime.datetime.now()
+        return ""
+
+    def _lolpig_head(self):
         code = """
-        /* generated by lolpig on %(date)s
+        /* generated by lolpig%(stamp)s
          * https://github.com/defgsus/lolpig is free software licensed under the MIT License
          * However, this file is licensed under the license of the containing package
          */
-        """ % {
-            "date": datetime.datetime.now(),
-        }
-        return change_text_indent(code, 0).strip()
+        """
+        return change_text_indent(code % {"stamp": self._stamp()}, 0).strip()
+
+    def _python_inc(self, code=None):
+        """Returns the include directives of code (default_inc) for the kind of build,
+        the python include directory is in the include path of extension builds"""
+        code = self.default_inc if code is None else code
+        if self.is_shared_lib:
+            code = code.replace("<python3.4/", "<")
+        if self.is_limited_api:
+            code = "#ifndef Py_LIMITED_API\n#   define Py_LIMITED_API 0x%08X\n#endif\n%s" % (
+                self.limited_api_version(), code)
+        return code
+
+    def limited_api_version(self):
+        """Returns the lowest Py_LIMITED_API value that provides all functions used by the module"""
+        version = 0x03080000
+        funcs = self.functions + [f for c in self.classes for f in c.methods]
+        if any(f.is_fastcall() for f in funcs):
+            version = max(version, 0x030A0000)
+        if any(c.has_buffer_method() for c in self.classes):
+            version = max(version, 0x030B0000)
+        return version
+
+    def _has_heap_types(self):
+        """Returns True if the classes are created from a PyType_Spec instead of static type structs"""
+        return self.is_multi_phase or self.is_limited_api
+
+    def _vectorcall_class(self, cls):
+        """Returns the class which stores the vectorcall function of the instances of cls, or None.
+        The limited API can not set tp_vectorcall_offset, so __call__ always goes through tp_call"""
+        return None if self.is_limited_api else cls.get_vectorcall_class()
 
     def render_hpp(self):
         code = """
@@ -311,7 +431,7 @@ class Renderer:
         #ifndef %(GUARD)s
         #define %(GUARD)s
 
-        #include <python3.4/Python.h>
+        %(python_inc)s
 
         %(namespace_open)s
         INDENT_/* Call this before Py_Initialize() */
@@ -332,6 +452,7 @@ class Renderer:
         import datetime
         code = apply_string_dict(code, {
             "lolpig_head": self._lolpig_head(),
+            "python_inc": self._python_inc("#include <python3.4/Python.h>"),
             "name": self.context.module_name,
             "struct_defs": self._render_struct_decl(),
             "func_defs": self._render_function_decl(),
@@ -380,7 +501,7 @@ class Renderer:
 
         code = apply_string_dict(code, {
             "lolpig_head": self._lolpig_head(),
-            "default_inc": self.default_inc,
+            "default_inc": self._python_inc(),
             "module_name": self.context.module_name,
             "header_name": self.context.header_name,
             "static_asserts" : self._render_static_asserts(),
@@ -390,17 +511,106 @@ class Renderer:
             "module_init": self._render_module_init(),
             "helper_funcs": self._render_all_user_funcs(),
         })
+        if self.is_shared_lib:
+            code += self._render_module_export()
         return code
 
+    def render_setup_py(self, sources, include_dirs=()):
+        """Renders a setuptools script that builds the module as extension from the
+        list of sources, which are the generated cpp file and the implementation files.
+        Paths should be relative to the script"""
+        code = """
+        # generated by lolpig%(stamp)s
+        # builds the python extension module '%(name)s', e.g. with: python setup.py build_ext --inplace
+        from setuptools import setup, Extension
+
+        setup(
+            name="%(name)s",
+            ext_modules=[
+                Extension(
+                    "%(name)s",
+                    sources=[%(sources)s],
+                    include_dirs=[%(include_dirs)s],
+                    language="c++",
+                    extra_compile_args=["-std=c++11"],
+                    %(limited_api)s
+                ),
+            ],
+        )
+        """
+        code = change_text_indent(code, 0).lstrip()
+        limited_api = ""
+        if self.is_limited_api:
+            # one binary for all python versions since the limited API version, named *.abi3.so
+            limited_api = 'define_macros=[("Py_LIMITED_API", "0x%08X")],\n' % self.limited_api_version()
+            limited_api += INDENT * 3 + "py_limited_api=True,"
+        else:
+            code = re.sub(r"^[ \t]*%\(limited_api\)s\n", "", code, flags=re.M)
+        return code % {
+            "limited_api": limited_api,
+            "stamp": self._stamp(),
+            "name": self.context.module_name,
+            "sources": ", ".join('"%s"' % fn for fn in sources),
+            "include_dirs": ", ".join('"%s"' % fn for fn in include_dirs),
+        }
+
     def _render_static_asserts(self):
         code = "#include <type_traits>\n"
+        if self.is_instrumented:
+            code += "#include <chrono>\n"
+        if self.is_limited_api:
+            return code + self._render_limited_api_checks()
         for functype in FUNCTIONS:
-            params = FUNCTIONS[functype]
-            parstr = params[1][0]
-            for j in range(1, len(params[1])):
-                parstr += ", %s" % params[1][j]
-            typedef = "%(ret)s(*)(%(params)s)" % { "ret": params[0], "params": parstr }
+            typedef = self._function_pointer_type(functype)
+            min_version = FUNCTIONS_MIN_VERSION.get(functype)
+            max_version = FUNCTIONS_MAX_VERSION.get(functype)
+            if min_version:
+                code += "#if PY_VERSION_HEX >= 0x%08X\n" % min_version
+            elif max_version:
+                code += "#if PY_VERSION_HEX < 0x%08X\n" % max_version
             code += 'static_assert(std::is_same<%s,\n    %s>::value, "lolpig/python api mismatch");\n' % (functype, typedef)
+            if min_version or max_version:
+                code += "#endif\n"
+        if self.is_multi_phase:
+            code += change_text_indent("""
+            #if PY_VERSION_HEX < 0x03090000
+            #   error "lolpig's multi-phase initialization needs python 3.9 or newer"
+            #endif
+            """, 0) + "\n"
+        # types of struct members that changed, see render_struct()
+        for member in sorted(STRUCT_MEMBER_COMPAT_TYPES):
+            old, new, version = STRUCT_MEMBER_COMPAT_TYPES[member]
+            code += "#if PY_VERSION_HEX >= 0x%08X\n" % version
+            code += "typedef %s %s;\n" % (new, compat_type_name(member))
+            code += "#else\n"
+            code += "typedef %s %s;\n" % (old, compat_type_name(member))
+            code += "#endif\n"
+        if any(self._vectorcall_class(c) for c in self.classes):
+            code += change_text_indent("""
+            #if PY_VERSION_HEX >= 0x03080000 && !defined(Py_TPFLAGS_HAVE_VECTORCALL)
+            #   define Py_TPFLAGS_HAVE_VECTORCALL _Py_TPFLAGS_HAVE_VECTORCALL
+            #endif
+            """, 0) + "\n"
+        return code
+
+    def _function_pointer_type(self, functype):
+        """Returns the function pointer type of the typedef functype from c_types.FUNCTIONS"""
+        params = FUNCTIONS[functype]
+        parstr = params[1][0]
+        for j in range(1, len(params[1])):
+            parstr += ", %s" % params[1][j]
+        return "%(ret)s(*)(%(params)s)" % { "ret": params[0], "params": parstr }
+
+    def _render_limited_api_checks(self):
+        """The function typedefs are not all part of the limited API and it has no
+        static type structs, so only the version and the module struct are checked"""
+        code = change_text_indent("""
+        #if !defined(Py_LIMITED_API) || Py_LIMITED_API + 0 < 0x%08X
+        #   error "lolpig: this module is rendered for the limited API and needs Py_LIMITED_API >= 0x%08X"
+        #endif
+        """ % ((self.limited_api_version(),) * 2), 0) + "\n"
+        # the limited API versions are all newer than the change of m_reload
+        code += "typedef %s %s;\n" % (STRUCT_MEMBER_COMPAT_TYPES["m_reload"][1], compat_type_name("m_reload"))
         return code
 
     def _render_function_decl(self):
@@ -437,15 +647,40 @@ class Renderer:
                 for j in i:
                     code += INDENT + "struct %s;\n" % j.class_struct_name
                     code += INDENT + "size_t %s();\n" % j.sizeof_func
+                    if j.has_vectorcall_call():
+                        code += INDENT + "Py_ssize_t %s();\n" % j.vectorcall_offset_func
+                    if self._has_member_offset_func(j):
+                        code += change_text_indent(self._render_member_offset_decl(j), len(INDENT))
                 code += self._render_namespace_close(i[0].namespaces)
             else:
                 for j in i:
                     code += "struct %s;\n" % j.class_struct_name
                     code += "size_t %s();\n" % j.sizeof_func
+                    if j.has_vectorcall_call():
+                        code += "Py_ssize_t %s();\n" % j.vectorcall_offset_func
+                    if self._has_member_offset_func(j):
+                        code += self._render_member_offset_decl(j)
         if code:
             code = "/* class struct forwards */\n" + code
         return code
 
+    def _has_member_offset_func(self, cls):
+        """Returns True if the user code must define the offsets of the struct members"""
+        return any(m.offset is None for m in cls.members)
+
+    def _render_member_offset_decl(self, cls):
+        """Declaration of the function returning the offsets of struct members
+        not known to the parser, and a macro defining it"""
+        code = "Py_ssize_t %s(int index);\n" % cls.member_offset_func
+        code += "/* Defines %s(), use it after the definition of %s */\n" % (
+            cls.member_offset_func, cls.class_struct_name)
+        code += "#define LOLPIG_MEMBER_OFFSETS_%s \\\n" % cls.c_name
+        code += INDENT + "Py_ssize_t %s(int index) { \\\n" % cls.member_offset_func
+        code += INDENT * 2 + "static const Py_ssize_t offsets[] = { %s }; \\\n" % ", ".join(
+            "offsetof(%s, %s)" % (cls.class_struct_name, m.c_name) for m in cls.members)
+        code += INDENT * 2 + "return offsets[index]; }\n"
+        return code
+
     def _render_namespace_open(self, namespaces):
         code = ""
         for i in namespaces:
@@ -483,6 +718,10 @@ class Renderer:
             return true;
         }
         """
+        if self.is_multi_phase:
+            # the classes are created by exec_module_%(name)s(), see _render_module_state_funcs()
+            code = re.sub(r"auto module = PyModule_Create\(.*?return module;",
+                          "return PyModuleDef_Init(&%(module_def)s);", code, flags=re.S)
         code = change_text_indent(code, 0)
 
         init_calls = ""
@@ -499,6 +738,21 @@ class Renderer:
 
         return code
 
+    def _render_module_export(self):
+        """Renders the function that python calls when importing the module
+        from a shared library, outside of all namespaces"""
+        code = """
+        /* -- extension module entry point -- */
+        PyMODINIT_FUNC PyInit_%(name)s()
+        {
+            return %(prefix)screate_module_%(name)s_func();
+        }
+        """
+        return change_text_indent(code, 0).lstrip() % {
+            "name": self.context.module_name,
+            "prefix": self._namespace_prefix(self.namespaces),
+        }
+
     def _render_module_def(self):
         """Renders classes, methods and global functions"""
         dic = { "name": self.context.module_name,
@@ -508,36 +762,287 @@ class Renderer:
                 "m_methods" : "nullptr",
                 "m_size": "-1",
                 "doc": to_c_string(self.context.module_doc) }
+        self._instrumented = [] if self.is_instrumented else None
         code = ""
         if self.classes:
             code += "/* ---- classes ---- */\n\n"
             for c in self.classes:
                 code += self._render_class_def(c)
-        if self.functions:
+        if self.functions or self.is_instrumented:
+            entries = None
+            if self.is_instrumented:
+                entries = ['{ "_lolpig_stats", reinterpret_cast<PyCFunction>(lolpig_stats_func), METH_NOARGS, '
+                           '"Returns a dict of python name -> dict with number of calls and time in seconds" },']
             code += "/* ---- global functions ---- */\n%s\n" \
-                    % self._render_method_struct(self.context.method_struct_name, self.functions)
+                    % self._render_method_struct(self.context.method_struct_name, self.functions, entries)
             dic.update({ "m_methods": self.context.method_struct_name})
+        if self.is_instrumented:
+            code = self._render_instrumentation() + "\n" + code
+            self._instrumented = None
+        if self.is_limited_api and self.classes:
+            code = self._render_free_heap_object().lstrip("\n") + "\n" + code
+        if self.is_multi_phase:
+            code = self._render_module_state() + "\n" + code
+            code += self._render_module_state_funcs() + "\n"
+            dic.update({
+                "m_size": "sizeof(%s)" % self.context.state_struct_name,
+                "m_reload": self.context.slots_struct_name,
+                "m_traverse": "traverse_module_%s" % self.context.module_name,
+                "m_clear": "clear_module_%s" % self.context.module_name,
+                "m_free": "free_module_%s" % self.context.module_name,
+            })
 
         code += """/* module definition for '%(name)s' */\nstatic const char* %(m_doc)s = "%(doc)s";\n""" % dic
         code += render_struct("PyModuleDef", PyModuleDef, dic["struct_name"], dic,
                               first_line="PyModuleDef_HEAD_INIT,")
+        if self.is_multi_phase:
+            code += "\n" + self._render_module_state_lookup()
         return code
 
-    def _render_method_struct(self, struct_name, functions):
+    def _module_state_func_name(self):
+        return "get_%s" % self.context.state_struct_name
+
+    def _module_state_objects(self):
+        """Returns the expressions of all object references in the module state"""
+        objs = []
+        for c in self.classes:
+            objs.append("state->%s" % c.state_type_name)
+        for c in self.classes:
+            for i in range(len(c.attribute_names)):
+                objs.append("state->%s_names[%d]" % (c.attribute_table_name, i))
+        return objs
+
+    def _render_module_state(self):
+        """Renders the per-module state struct of multi-phase initialization"""
+        members = ""
+        for c in self.classes:
+            members += "PyTypeObject* %s;\n" % c.state_type_name
+        for c in self.classes:
+            if c.attribute_names:
+                members += "PyObject* %s_names[%d];\n" % (c.attribute_table_name, len(c.attribute_names))
+                members += "int %s_slots[%d];\n" % (c.attribute_table_name, self._attribute_table_size(c))
+        code = """
+        /* ---- per-module state ---- */
+        struct %(state)s
+        {
+            %(members)s
+        };
+        """
+        code = change_text_indent(code, 0)
+        if self.classes:
+            code += "\n\n" + self._render_free_heap_object()
+        if not members:
+            code = re.sub(r"^[ \t]*%\(members\)s\n", "", code, flags=re.M)
+        return apply_string_dict(code, {
+            "state": self.context.state_struct_name,
+            "members": members,
+        })
+
+    def _render_free_heap_object(self):
+        code = """
+        /* Frees an instance of a heap type and releases it's reference to the type */
+        void free_heap_object(PyObject* self)
+        {
+            PyTypeObject* type = Py_TYPE(self);
+            type->tp_free(self);
+            Py_DECREF(type);
+        }
+        """
+        if self.is_limited_api:
+            code = code.replace("type->tp_free(self);",
+                                "reinterpret_cast<freefunc>(PyType_GetSlot(type, Py_tp_free))(self);")
+        return change_text_indent(code, 0)
+
+    def _render_module_state_funcs(self):
+        """Renders the Py_mod_exec function, the garbage collection of the
+        module state and the module slots"""
+        code = """
+        /* Creates the classes of a new '%(name)s' module instance */
+        int exec_module_%(name)s(PyObject* module)
+        {
+            %(state)s* state = reinterpret_cast<%(state)s*>(PyModule_GetState(module));
+            %(init_calls)s
+            return 0;
+        }
+
+        int traverse_module_%(name)s(PyObject* module, visitproc visit, void* arg)
+        {
+            %(state)s* state = reinterpret_cast<%(state)s*>(PyModule_GetState(module));
+            if (state)
+            {
+                %(visits)s
+            }
+            return 0;
+        }
+
+        int clear_module_%(name)s(PyObject* module)
+        {
+            %(state)s* state = reinterpret_cast<%(state)s*>(PyModule_GetState(module));
+            if (state)
+            {
+                %(clears)s
+            }
+            return 0;
+        }
+
+        void free_module_%(name)s(void* module)
+        {
+            clear_module_%(name)s(reinterpret_cast<PyObject*>(module));
+        }
+
+        static PyModuleDef_Slot %(slots)s[] =
+        {
+            { Py_mod_exec, reinterpret_cast<void*>(exec_module_%(name)s) },
+        #if PY_VERSION_HEX >= 0x030C0000
+            { Py_mod_multiple_interpreters, %(interpreters)s },
+        #endif
+            { 0, NULL }
+        };
+        """
+        code = change_text_indent(code, 0)
+        init_calls = ""
+        for c in self.classes:
+            init_calls += "if (!%s(module, state))\n%sreturn -1;\n" % (c.init_func_name, INDENT)
+        objs = self._module_state_objects()
+        visits = "".join("Py_VISIT(%s);\n" % o for o in objs) or "(void)visit; (void)arg;"
+        clears = "".join("Py_CLEAR(%s);\n" % o for o in objs) or "(void)state;"
+        init_calls = init_calls or "(void)state;"
+        return apply_string_dict(code, {
+            "name": self.context.module_name,
+            "state": self.context.state_struct_name,
+            "slots": self.context.slots_struct_name,
+            "init_calls": init_calls,
+            "visits": visits,
+            "clears": clears,
+            "interpreters": "Py_MOD_PER_INTERPRETER_GIL_SUPPORTED" if self.is_per_interpreter_gil
+                            else "Py_MOD_MULTIPLE_INTERPRETERS_SUPPORTED",
+        })
+
+    def _render_module_state_lookup(self):
+        code = """
+        /* Returns the state of the '%(name)s' module instance of obj, which is the module itself
+           or an instance of one of it's classes or of a derived class, or NULL */
+        %(state)s* %(func)s(PyObject* obj)
+        {
+            if (PyModule_Check(obj))
+            {
+                if (PyModule_GetDef(obj) != &%(module_def)s)
+                    return NULL;
+                return reinterpret_cast<%(state)s*>(PyModule_GetState(obj));
+            }
+            PyObject* mro = Py_TYPE(obj)->tp_mro;
+            for (Py_ssize_t i=0; mro && i<PyTuple_GET_SIZE(mro); ++i)
+            {
+                PyTypeObject* type = reinterpret_cast<PyTypeObject*>(PyTuple_GET_ITEM(mro, i));
+                if (!(type->tp_flags & Py_TPFLAGS_HEAPTYPE))
+                    continue;
+                PyObject* module = reinterpret_cast<PyHeapTypeObject*>(type)->ht_module;
+                if (module && PyModule_GetDef(module) == &%(module_def)s)
+                    return reinterpret_cast<%(state)s*>(PyModule_GetState(module));
+            }
+            return NULL;
+        }
+        """
+        code = change_text_indent(code, 0)
+        return apply_string_dict(code, {
+            "name": self.context.module_name,
+            "state": self.context.state_struct_name,
+            "func": self._module_state_func_name(),
+            "module_def": self.context.struct_name,
+        })
+
+    def _render_method_struct(self, struct_name, functions, entries=None):
         code = "static PyMethodDef %s[] =\n{\n" % struct_name
         for i in functions:
             code += INDENT + self._render_method_struct_entry(i) + "\n"
+        for i in entries or []:
+            code += INDENT + i + "\n"
         code += "\n" + INDENT + "{ NULL, NULL, 0, NULL }\n};\n"
         return code
 
     def _render_method_struct_entry(self, func):
+        c_name = self._instrumented_name(func)
+        # let the compiler verify the signature of vectorcall functions
+        if func.is_fastcall():
+            c_name = "static_cast<%s>(%s)" % (func.get_function_type(), c_name)
         return '{ "%s", reinterpret_cast<PyCFunction>(%s), %s, "%s" },' % (
             func.py_name_single(),
-            func.full_c_name,
+            c_name,
             func.get_c_method_type(),
             to_c_string(func.py_doc)
         )
 
+    def _instrumented_name(self, func, py_name=None):
+        """Returns the name of the function to put into the python structs,
+        which is a call counting shim for func while rendering instrumented code"""
+        if self._instrumented is None:
+            return func.full_c_name
+        self._instrumented.append((py_name or func.py_name, func))
+        return "lolpig_instrumented_%d" % (len(self._instrumented) - 1)
+
+    def _render_instrumentation(self):
+        """Renders the call statistics and the shims registered by _instrumented_name()"""
+        code = """
+        /* ---- call counting and timing of the functions below ---- */
+        struct lolpig_call_stats { const char* name; unsigned long long calls; long long ns; };
+
+        static lolpig_call_stats lolpig_stats[] =
+        {
+            %(stats)s
+            { NULL, 0, 0 }
+        };
+
+        /* Counts a call and adds it's duration on destruction */
+        struct lolpig_call_timer
+        {
+            lolpig_call_stats& stats;
+            std::chrono::steady_clock::time_point start;
+            lolpig_call_timer(lolpig_call_stats& s) : stats(s), start(std::chrono::steady_clock::now()) { }
+            ~lolpig_call_timer()
+            {
+                ++stats.calls;
+                stats.ns += std::chrono::duration_cast<std::chrono::nanoseconds>(
+                                std::chrono::steady_clock::now() - start).count();
+            }
+        };
+
+        /* Returns a dict of python name -> dict with number of calls and time in seconds */
+        PyObject* lolpig_stats_func(PyObject*, PyObject*)
+        {
+            PyObject* dict = PyDict_New();
+            if (!dict)
+                return NULL;
+            for (lolpig_call_stats* s = lolpig_stats; s->name; ++s)
+            {
+                PyObject* value = Py_BuildValue("{s:K,s:d}", "calls", s->calls, "time", s->ns * 1e-9);
+                if (!value || 0 != PyDict_SetItemString(dict, s->name, value))
+                {
+                    Py_XDECREF(value);
+                    Py_DECREF(dict);
+                    return NULL;
+                }
+                Py_DECREF(value);
+            }
+            return dict;
+        }
+
+        /* the functions in the python structs */
+        %(shims)s
+        """
+        stats = ""
+        shims = ""
+        for i, (py_name, func) in enumerate(self._instrumented):
+            stats += '{ "%s", 0, 0 },\n' % to_c_string(py_name)
+            args = ", ".join("%s arg%d" % (a.c_type, j) for j, a in enumerate(func.arguments))
+            call_args = ", ".join("arg%d" % j for j in range(len(func.arguments)))
+            shims += "%s lolpig_instrumented_%d(%s) { lolpig_call_timer t(lolpig_stats[%d]); return %s(%s); }\n" % (
+                func.c_return_type, i, args, i, func.full_c_name, call_args)
+        code = change_text_indent(code, 0)
+        return apply_string_dict(code, {
+            "stats": stats.strip(),
+            "shims": shims.strip(),
+        })
+
     def _render_class_def(self, cls):
         """Renders full class definition"""
         cls.finalize()
@@ -545,60 +1050,377 @@ class Renderer:
 
         code += 'static const char* %s = "%s";\n\n' % (cls.doc_string_name, to_c_string(cls.py_doc))
 
+        if self._has_alloc_func(cls):
+            code += self._render_class_alloc_decl(cls)
+
         # general methods
-        if cls.normal_methods:
+        if self._has_method_struct(cls):
             code += "\n\n/* ---- %s methods ---- */\n" % cls.py_name
-            code += self._render_method_struct(cls.method_struct_name, cls.normal_methods)
+            code += self._render_method_struct(cls.method_struct_name, cls.normal_methods,
+                                               self._render_class_extra_method_entries(cls))
 
-        # special methods
-        if cls.has_number_method():
-            code += "\n\n/* ---- %s number methods ---- */\n" % cls.py_name
-            code += "/* https://docs.python.org/3/c-api/typeobj.html#number-object-structures */\n"
-            code += self._render_class_number_struct(cls)
-        if cls.has_sequence_method():
-            code += "\n\n/* ---- %s sequence methods ---- */\n" % cls.py_name
-            code += "/* https://docs.python.org/3/c-api/typeobj.html#sequence-object-structures */\n"
-            code += self._render_class_sequence_struct(cls)
+        # special methods, part of the type spec of heap types
+        if not self._has_heap_types():
+            code += self._render_class_special_structs(cls)
 
         # properties
         if cls.properties:
             code += "\n\n/* ----- %s properties -------- */\n" % cls.py_name
             code += self._render_class_getset_struct(cls)
 
+        # struct members
+        if cls.members:
+            code += "\n\n/* ----- %s members -------- */\n" % cls.py_name
+            code += self._render_class_members_struct(cls)
+
         # init/dealloc
         code += "\n" + self._render_class_init_funcs(cls)
 
+        if cls.get_compare_methods():
+            code += "\n" + self._render_class_richcompare_func(cls)
+
         # c-api type struct
-        code += "\n" + self._render_class_type_struct(cls)
+        if self._has_heap_types():
+            code += "\n" + self._render_class_type_spec(cls)
+        else:
+            code += "\n" + self._render_class_type_struct(cls)
+        if self.is_limited_api:
+            code += "\n/* created from the spec by %s() */\n" % cls.init_func_name
+            code += "static PyTypeObject* %s = NULL;\n" % cls.state_type_name
+
+        if self._has_alloc_func(cls):
+            code += "\n" + self._render_class_alloc_funcs(cls)
+
+        if cls.attribute_names:
+            code += "\n" + self._render_class_attribute_table(cls)
 
         # class->module init func
         code += "\n" + self._render_class_init_func(cls)
 
         return code + "\n"
 
-    def _render_class_number_struct(self, cls):
+    def _render_class_special_structs(self, cls):
+        """Renders the number, sequence, mapping and buffer structs"""
+        code = ""
+        if cls.has_number_method():
+            code += "\n\n/* ---- %s number methods ---- */\n" % cls.py_name
+            code += "/* https://docs.python.org/3/c-api/typeobj.html#number-object-structures */\n"
+            code += self._render_class_number_struct(cls)
+        if cls.has_sequence_method():
+            code += "\n\n/* ---- %s sequence methods ---- */\n" % cls.py_name
+            code += "/* https://docs.python.org/3/c-api/typeobj.html#sequence-object-structures */\n"
+            code += self._render_class_sequence_struct(cls)
+        if cls.has_mapping_method():
+            code += "\n\n/* ---- %s mapping methods ---- */\n" % cls.py_name
+            code += "/* https://docs.python.org/3/c-api/typeobj.html#mapping-object-structures */\n"
+            code += self._render_class_mapping_struct(cls)
+        if cls.has_buffer_method():
+            code += "\n\n/* ---- %s buffer methods ---- */\n" % cls.py_name
+            code += "/* https://docs.python.org/3/c-api/typeobj.html#buffer-object-structures */\n"
+            code += self._render_class_buffer_struct(cls)
+        return code
+
+    def _has_method_struct(self, cls):
+        return bool(cls.normal_methods or self._render_class_extra_method_entries(cls))
+
+    def _render_class_extra_method_entries(self, cls):
+        """Returns PyMethodDef entries for generated methods"""
+        entries = []
+        if self._freelist_size(cls):
+            entries.append('{ "_freelist_stats", reinterpret_cast<PyCFunction>(%s), METH_NOARGS | METH_STATIC, '
+                           '"Returns a dict with size, capacity, hits and misses of the free list" },'
+                           % cls.freelist_stats_func_name)
+        return entries
+
+    def _freelist_size(self, cls):
+        """The free list is only used with static types, with multi-phase initialization
+        it would be state shared by all module instances and with the limited API
+        recycled instances can not be cleared for the garbage collector"""
+        return 0 if self._has_heap_types() else cls.freelist_size
+
+    def _has_alloc_func(self, cls):
+        """Returns True if instances are created by a generated alloc function
+        instead of PyObject_New"""
+        return bool(self._freelist_size(cls) or cls.is_gc())
+
+    def _render_class_alloc_decl(self, cls):
+        code = "/* allocation of %s instances, see below */\n" % cls.py_name
+        code += "PyObject* %s(struct _typeobject * type);\n" % cls.class_alloc_func_name
+        if self._freelist_size(cls):
+            code += "void %s(void* ptr);\n" % cls.class_free_func_name
+            code += "PyObject* %s(PyObject*, PyObject*);\n" % cls.freelist_stats_func_name
+        return "\n" + code + "\n"
+
+    def _render_class_alloc_funcs(self, cls):
+        code = ""
+        if self._freelist_size(cls):
+            code += """
+            /* ---- %(name)s free list ---- */
+            static PyObject* %(freelist)s[%(size)s];
+            static int %(freelist)s_size = 0;
+            static Py_ssize_t %(freelist)s_hits = 0;
+            static Py_ssize_t %(freelist)s_misses = 0;
+
+            /* Returns a %(name)s instance from the free list or a newly allocated one.
+               Instances of derived types are never taken from the free list. */
+            PyObject* %(alloc_func)s(struct _typeobject * type)
+            {
+                PyObject* self;
+                if (type == &%(type_struct)s && %(freelist)s_size > 0)
+                {
+                    ++%(freelist)s_hits;
+                    self = PyObject_Init(%(freelist)s[--%(freelist)s_size], type);
+                }
+                else
+                {
+                    ++%(freelist)s_misses;
+                    self = %(object_new)s(PyObject, type);
+                }
+                %(gc_track)s
+                return self;
+            }
+
+            /* tp_free of %(name)s, keeps instances for reuse until the free list is full */
+            void %(free_func)s(void* ptr)
+            {
+                PyObject* self = reinterpret_cast<PyObject*>(ptr);
+                if (Py_TYPE(self) == &%(type_struct)s && %(freelist)s_size < %(size)s)
+                    %(freelist)s[%(freelist)s_size++] = self;
+                else
+                    %(object_del)s(self);
+            }
+
+            PyObject* %(stats_func)s(PyObject*, PyObject*)
+            {
+                return Py_BuildValue("{s:i,s:i,s:n,s:n}",
+                                     "size", %(freelist)s_size,
+                                     "capacity", %(size)s,
+                                     "hits", %(freelist)s_hits,
+                                     "misses", %(freelist)s_misses);
+            }
+            """
+        else:
+            code += """
+            /* Returns a new %(name)s instance tracked by the garbage collector */
+            PyObject* %(alloc_func)s(struct _typeobject * type)
+            {
+                PyObject* self = %(alloc_call)s;
+                %(gc_track)s
+                return self;
+            }
+            """
+        gc_track = ""
+        # tp_basicsize is not accessible with the limited API, PyType_GenericAlloc()
+        # clears and tracks the instance instead
+        alloc_call = "%s(PyObject, type)" % ("PyObject_GC_New" if cls.is_gc() else "PyObject_New")
+        if self.is_limited_api:
+            alloc_call = "PyType_GenericAlloc(type, 0)"
+        elif cls.is_gc():
+            gc_track = change_text_indent("""
+            if (self)
+            {
+                /* tp_traverse may be called before __init__, so clear all members */
+                memset(reinterpret_cast<char*>(self) + sizeof(PyObject), 0,
+                       type->tp_basicsize - sizeof(PyObject));
+                PyObject_GC_Track(self);
+            }
+            """, 0).strip()
+        code = change_text_indent(code, 0)
+        if not gc_track:
+            code = re.sub(r"^[ \t]*%\(gc_track\)s\n", "", code, flags=re.M)
+        return apply_string_dict(code, {
+            "name": cls.py_name,
+            "size": str(self._freelist_size(cls)),
+            "freelist": cls.freelist_name,
+            "type_struct": cls.type_struct_name,
+            "alloc_func": cls.class_alloc_func_name,
+            "free_func": cls.class_free_func_name,
+            "stats_func": cls.freelist_stats_func_name,
+            "object_new": "PyObject_GC_New" if cls.is_gc() else "PyObject_New",
+            "alloc_call": alloc_call,
+            "object_del": "PyObject_GC_Del" if cls.is_gc() else "PyObject_Del",
+            "gc_track": gc_track,
+        })
+
+    def _attribute_table_size(self, cls):
+        """Number of slots of the hash table of attribute names, a power of two
+        with at most half of the slots in use"""
+        size = 2
+        while size < 2 * len(cls.attribute_names):
+            size *= 2
+        return size
+
+    def _render_class_attribute_table(self, cls):
+        code = """
+        /* ---- %(name)s attribute names ---- */
+        static const char* %(table)s_strings[%(count)s] = { %(strings)s };
+        %(static_tables)s
+
+        inline size_t %(table)s_hash(PyObject* name)
+        {
+            return (reinterpret_cast<size_t>(name) >> 4) & %(mask)s;
+        }
+
+        /* Creates the interned name objects, called by %(init_func)s() */
+        bool %(attr_init_func)s(%(init_params)s)
+        {
+            if (%(names)s[%(last)s])
+                return true;
+            for (int i=0; i<%(count)s; ++i)
+            {
+                PyObject* name = PyUnicode_InternFromString(%(table)s_strings[i]);
+                if (!name)
+                {
+                    CPPY_ERROR("Failed to create attribute names of class %(name)s");
+                    return false;
+                }
+                %(names)s[i] = name;
+                size_t h = %(table)s_hash(name);
+                while (%(slots)s[h])
+                    h = (h + 1) & %(mask)s;
+                %(slots)s[h] = i + 1;
+            }
+            return true;
+        }
+        """
+        code = change_text_indent(code, 0)
+        names = cls.attribute_names
+        size = self._attribute_table_size(cls)
+        dic = self._get_attribute_table_dict(cls)
+        # with multi-phase initialization the tables are part of the module state
+        static_tables = ""
+        if not self.is_multi_phase:
+            static_tables = change_text_indent("""
+            static PyObject* %(names)s[%(count)s];
+            /* open addressing hash table of the interned name objects' addresses,
+               contains id + 1 or 0 for an empty slot */
+            static int %(slots)s[%(size)s];
+            """ % {"names": dic["names"], "slots": dic["slots"], "count": len(names), "size": size}, 0).strip("\n")
+        dic.update({
+            "name": cls.py_name,
+            "table": cls.attribute_table_name,
+            "count": str(len(names)),
+            "last": str(len(names) - 1),
+            "size": str(size),
+            "mask": str(size - 1),
+            "strings": ", ".join('"%s"' % n for n in names),
+            "init_func": cls.init_func_name,
+            "attr_init_func": cls.attribute_init_func_name,
+            "static_tables": static_tables,
+            "init_params": "%s* state" % self.context.state_struct_name if self.is_multi_phase else "",
+        })
+        return apply_string_dict(code, dic)
+
+    def _get_attribute_table_dict(self, cls):
+        """Returns the expressions of the name object and hash tables of a class"""
+        prefix = "state->" if self.is_multi_phase else ""
+        return {
+            "names": "%s%s_names" % (prefix, cls.attribute_table_name),
+            "slots": "%s%s_slots" % (prefix, cls.attribute_table_name),
+        }
+
+    def _render_class_attribute_id_func(self, cls):
+        code = """
+        /* Returns the index of name in the attributes of %(name)s or -1 */
+        int %(id_func)s(%(id_params)s)
+        {
+            %(get_state)s
+            size_t h = %(table)s_hash(name);
+            while (int id = %(slots)s[h])
+            {
+                if (%(names)s[id - 1] == name)
+                    return id - 1;
+                h = (h + 1) & %(mask)s;
+            }
+            /* an interned string equal to one of the names would have been found */
+            if (!PyUnicode_Check(name) || PyUnicode_CHECK_INTERNED(name))
+                return -1;
+            for (int i=0; i<%(count)s; ++i)
+                if (0 == PyUnicode_CompareWithASCIIString(name, %(table)s_strings[i]))
+                    return i;
+            return -1;
+        }
+        """
+        code = change_text_indent(code, 0)
+        if self.is_limited_api:
+            # the interned state is not part of the limited API, so every miss compares the strings
+            code = code.replace(
+                "/* an interned string equal to one of the names would have been found */\n"
+                "    if (!PyUnicode_Check(name) || PyUnicode_CHECK_INTERNED(name))",
+                "if (!PyUnicode_Check(name))")
+        get_state = ""
+        if self.is_multi_phase:
+            get_state = "%s* state = %s(self);\nif (!state)\n%sreturn -1;" % (
+                self.context.state_struct_name, self._module_state_func_name(), INDENT)
+        else:
+            code = re.sub(r"^[ \t]*%\(get_state\)s\n", "", code, flags=re.M)
+        dic = self._get_attribute_table_dict(cls)
+        dic.update({
+            "name": cls.py_name,
+            "id_func": cls.attribute_id_func,
+            "table": cls.attribute_table_name,
+            "count": str(len(cls.attribute_names)),
+            "mask": str(self._attribute_table_size(cls) - 1),
+            "id_params": "PyObject* self, PyObject* name" if self.is_multi_phase else "PyObject* name",
+            "get_state": get_state,
+        })
+        return apply_string_dict(code, dic)
+
+    def _get_class_number_dict(self, cls):
         dic = {}
         for i in NUMBER_FUNCS:
             if cls.has_method(i[0]):
-                val = cls.get_method(i[0]).full_c_name
+                val = self._instrumented_name(cls.get_method(i[0]))
                 dic.update({i[1]: val})
-        return render_struct("PyNumberMethods", PyNumberMethods, cls.number_struct_name, dic)
+        return dic
 
-    def _render_class_sequence_struct(self, cls):
+    def _render_class_number_struct(self, cls):
+        return render_struct("PyNumberMethods", PyNumberMethods, cls.number_struct_name,
+                             self._get_class_number_dict(cls))
+
+    def _get_class_sequence_dict(self, cls):
         dic = {}
         for i in SEQUENCE_FUNCS:
+            f = cls.get_sequence_method(i[0])
+            if f:
+                dic.update({i[1]: self._instrumented_name(f)})
+        return dic
+
+    def _render_class_sequence_struct(self, cls):
+        return render_struct("PySequenceMethods", PySequenceMethods, cls.sequence_struct_name,
+                             self._get_class_sequence_dict(cls))
+
+    def _get_class_mapping_dict(self, cls):
+        dic = {}
+        for i in MAPPING_FUNCS:
+            f = cls.get_mapping_method(i[0])
+            if f:
+                dic.update({i[1]: self._instrumented_name(f)})
+        return dic
+
+    def _render_class_mapping_struct(self, cls):
+        return render_struct("PyMappingMethods", PyMappingMethods, cls.mapping_struct_name,
+                             self._get_class_mapping_dict(cls))
+
+    def _get_class_buffer_dict(self, cls):
+        dic = {}
+        for i in BUFFER_FUNCS:
             if cls.has_method(i[0]):
                 val = cls.get_method(i[0]).full_c_name
                 dic.update({i[1]: val})
-        return render_struct("PySequenceMethods", PySequenceMethods, cls.sequence_struct_name, dic)
+        return dic
+
+    def _render_class_buffer_struct(self, cls):
+        return render_struct("PyBufferProcs", PyBufferProcs, cls.buffer_struct_name,
+                             self._get_class_buffer_dict(cls))
 
     def _render_class_getset_struct(self, cls):
         code = "static PyGetSetDef %s[] =\n{\n" % cls.getset_struct_name
         for i in cls.properties():
             name = to_c_string(i[0].py_name_single())
             doc = to_c_string(change_text_indent(i[0].py_doc, 0).strip())
-            get = i[0].full_c_name
-            set = i[1].full_c_name if i[1] else "NULL"
+            get = self._instrumented_name(i[0], i[0].py_name + ".__get__")
+            set = self._instrumented_name(i[1], i[1].py_name + ".__set__") if i[1] else "NULL"
             line = '{ const_cast<char*>("%s"), static_cast<getter>(%s), static_cast<setter>(%s), const_cast<char*>("%s"), NULL },\n'  % (
                 name, get, set, doc,
             )
@@ -606,7 +1428,30 @@ class Renderer:
         code += "\n" + INDENT + "{ NULL, NULL, NULL, NULL, NULL }\n};\n"
         return code
 
-    def _render_class_type_struct(self, cls):
+    def _render_class_members_struct(self, cls):
+        code = "static PyMemberDef %s[] =\n{\n" % cls.members_struct_name
+        for m in cls.members:
+            line = '{ const_cast<char*>("%s"), %s, %s, %s, const_cast<char*>("%s") },\n' % (
+                to_c_string(m.py_name), m.member_type,
+                # unknown offsets are set in the class init function
+                "0" if m.offset is None else str(m.offset),
+                "READONLY" if m.is_readonly else "0",
+                to_c_string(change_text_indent(m.py_doc, 0).strip()),
+            )
+            code += INDENT + line
+        code += "\n" + INDENT + "{ NULL, 0, 0, 0, NULL }\n};\n"
+        return code
+
+    def _render_class_member_offsets(self, cls):
+        """Assignments of the member offsets which are only known to the user's code"""
+        code = ""
+        for i, m in enumerate(cls.members):
+            if m.offset is None:
+                code += INDENT + "%s[%d].offset = %s%s(%d);\n" % (
+                    cls.members_struct_name, i, cls.get_namespace_prefix(), cls.member_offset_func, i)
+        return code
+
+    def _get_class_type_dict(self, cls):
         dic = {}
         for i in PyTypeObject:
             dic[i[0]] = "NULL"
@@ -620,26 +1465,123 @@ class Renderer:
             "tp_doc": cls.doc_string_name,
             "tp_new": cls.class_new_func_name
         })
-        if cls.normal_methods:
+        if self._has_method_struct(cls):
             dic.update({"tp_methods": cls.method_struct_name})
+        if cls.members:
+            dic.update({"tp_members": cls.members_struct_name})
+        if self._freelist_size(cls):
+            dic.update({"tp_free": cls.class_free_func_name})
+        elif cls.is_gc():
+            dic.update({"tp_free": "PyObject_GC_Del"})
+        if cls.is_gc():
+            dic.update({"tp_flags": "Py_TPFLAGS_DEFAULT | Py_TPFLAGS_BASETYPE | Py_TPFLAGS_HAVE_GC"})
         if cls.bases:
             dic.update({ "tp_base": "&" + cls.bases[0].type_struct_name })
         for i in TYPE_FUNCS:
             if cls.has_method(i[0]):
                 dic.update({i[1]: cls.get_method(i[0]).full_c_name})
+        if cls.has_vectorcall_call():
+            dic.update({"tp_call": cls.class_call_func_name})
+        if cls.is_gc():
+            # traverse and clear may come from a base class
+            dic.update({"tp_dealloc": cls.class_dealloc_func_name,
+                        "tp_traverse": cls.get_inherited_method("__traverse__").full_c_name})
+            if self._has_heap_types():
+                dic.update({"tp_traverse": cls.class_traverse_func_name})
+            if cls.get_inherited_method("__clear__"):
+                dic.update({"tp_clear": cls.get_inherited_method("__clear__").full_c_name})
+        if cls.get_compare_methods():
+            dic.update({"tp_richcompare": cls.class_richcompare_func_name})
+        if self._vectorcall_class(cls) and cls.has_method("__new__"):
+            dic.update({"tp_new": cls.class_new_func_name})
         if cls.has_sequence_method():
             dic.update({"tp_as_sequence": "&" + cls.sequence_struct_name})
+        if cls.has_mapping_method():
+            dic.update({"tp_as_mapping": "&" + cls.mapping_struct_name})
         if cls.has_number_method():
             dic.update({"tp_as_number": "&" + cls.number_struct_name})
+        if cls.has_buffer_method():
+            dic.update({"tp_as_buffer": "&" + cls.buffer_struct_name})
         if cls.properties:
             dic.update({"tp_getset": cls.getset_struct_name})
+        return dic
 
+    def _render_class_type_struct(self, cls):
         return "/* https://docs.python.org/3/c-api/typeobj.html */\n" + \
                 render_struct("PyTypeObject", PyTypeObject,
-                             cls.type_struct_name, dic,
+                             cls.type_struct_name, self._get_class_type_dict(cls),
                              first_line="PyVarObject_HEAD_INIT(NULL, 0)")
 
+    def _render_class_type_spec(self, cls):
+        """Renders the PyType_Slot table and PyType_Spec of a heap type,
+        with the same contents as the static type struct"""
+        dic = self._get_class_type_dict(cls)
+        # these are given in the spec or by PyType_FromModuleAndSpec
+        spec_members = ("tp_name", "tp_basicsize", "tp_itemsize", "tp_flags", "tp_base",
+                        "tp_as_number", "tp_as_sequence", "tp_as_mapping", "tp_as_buffer")
+        slots = [(i[0], i[1], dic[i[0]]) for i in PyTypeObject
+                 if i[0] in dic and i[0] not in spec_members]
+        for table, sub_dic in ((PyNumberMethods, self._get_class_number_dict(cls)),
+                               (PySequenceMethods, self._get_class_sequence_dict(cls)),
+                               (PyMappingMethods, self._get_class_mapping_dict(cls)),
+                               (PyBufferProcs, self._get_class_buffer_dict(cls))):
+            slots += [(i[0], i[1], sub_dic[i[0]]) for i in table if i[0] in sub_dic]
+
+        code = "/* https://docs.python.org/3/c-api/type.html#c.PyType_Spec */\n"
+        code += "static PyType_Slot %s[] =\n{\n" % cls.type_slots_name
+        for member, type, value in slots:
+            if value == "NULL":
+                continue
+            if type == "const char*":
+                value = "const_cast<char*>(%s)" % value
+            else:
+                # not all function typedefs are part of the limited API
+                if self.is_limited_api and type in FUNCTIONS:
+                    type = self._function_pointer_type(type)
+                # see render_struct()
+                cast = "reinterpret" if member == "tp_new" else "static"
+                value = "reinterpret_cast<void*>(%s_cast<%s>(%s))" % (cast, type, value)
+            code += INDENT + "{ Py_%s, %s },\n" % (member, value)
+        code += INDENT + "{ 0, NULL }\n};\n\n"
+        code += "static PyType_Spec %s =\n{\n" % cls.type_spec_name
+        code += INDENT + "%s,\n" % dic["tp_name"]
+        code += INDENT + "static_cast<int>(%s),\n" % dic["tp_basicsize"]
+        code += INDENT + "0,\n"
+        code += INDENT + "%s,\n" % dic["tp_flags"]
+        code += INDENT + "%s\n" % cls.type_slots_name
+        code += "}; /* %s */\n" % cls.type_spec_name
+        return code
+
+    def _render_class_richcompare_func(self, cls):
+        """Renders the tp_richcompare function dispatching to the single comparison methods"""
+        cases = ""
+        for f, op in cls.get_compare_methods():
+            cases += "case %s: return %s(self, other);\n" % (op, f.full_c_name)
+        fallback = cls.get_inherited_richcompare_method()
+        if fallback:
+            cases += "default: return %s(self, other, op);\n" % fallback.full_c_name
+        else:
+            cases += "default: Py_RETURN_NOTIMPLEMENTED;\n"
+        code = """
+        /* Dispatches the comparison operators of %(name)s */
+        PyObject* %(func_name)s(PyObject* self, PyObject* other, int op)
+        {
+            switch (op)
+            {
+                %(cases)s
+            }
+        }
+        """
+        code = change_text_indent(code, 0)
+        return apply_string_dict(code, {
+            "name": cls.py_name,
+            "func_name": cls.class_richcompare_func_name,
+            "cases": cases.strip(),
+        })
+
     def _render_class_init_func(self, cls):
+        if self._has_heap_types():
+            return self._render_class_heap_type_init_func(cls)
         code = """
         bool %(func_name)s(PyObject* module)
         {
@@ -664,32 +1606,275 @@ class Renderer:
             "func_name": cls.init_func_name,
             "struct_name": cls.type_struct_name
         }
-        return change_text_indent(code, 0)
+        code = change_text_indent(code, 0)
+        slots = self._render_class_runtime_slots(cls, cls.type_struct_name + ".")
+        slots += self._render_class_member_offsets(cls)
+        if cls.attribute_names:
+            slots += INDENT + "if (!%s())\n" % cls.attribute_init_func_name
+            slots += INDENT * 2 + "return false;\n"
+        if slots:
+            code = code.replace("{\n", "{\n" + slots, 1)
+        return code
+
+    def _render_class_runtime_slots(self, cls, type_prefix):
+        """Assignments to type struct members which are not available in all python versions,
+        type_prefix is the member access of the type struct, e.g. 'X_type_struct.'"""
+        code = ""
+        # the members are not accessible with the limited API
+        if self.is_limited_api:
+            # construction would silently fall back to __new__/__init__
+            if cls.has_method("__vectorcall__"):
+                raise ValueError("Class %s defines __vectorcall__, which can not be used with "
+                                 "the limited API (-abi3)" % cls.py_name)
+            return code
+        if cls.has_method("__vectorcall__"):
+            code += "#if PY_VERSION_HEX >= 0x03090000\n"
+            code += INDENT + "%stp_vectorcall = %s;\n" % (
+                type_prefix, cls.get_method("__vectorcall__").full_c_name)
+            code += "#endif\n"
+        vcls = cls.get_vectorcall_class()
+        if vcls:
+            code += "#if PY_VERSION_HEX >= 0x03080000\n"
+            code += INDENT + "%stp_vectorcall_offset = %s%s();\n" % (
+                type_prefix, vcls.get_namespace_prefix(), vcls.vectorcall_offset_func)
+            code += INDENT + "%stp_flags |= Py_TPFLAGS_HAVE_VECTORCALL;\n" % type_prefix
+            code += "#endif\n"
+        return code
+
+    def _render_class_heap_type_init_func(self, cls):
+        """Renders the function creating the heap type of the class, for one module
+        instance with multi-phase initialization, or once in a static variable"""
+        code = """
+        bool %(func_name)s(%(params)s)
+        {
+            %(member_offsets)s
+            PyObject* type = %(create_call)s;
+            if (!type)
+            {
+                CPPY_ERROR("Failed to create class %(name)s for Python module");
+                return false;
+            }
+            %(type_ref)s = reinterpret_cast<PyTypeObject*>(type);
+            %(runtime_slots)s
+            %(attributes)s
+            Py_INCREF(type);
+            if (0 != PyModule_AddObject(module, "%(name)s", type))
+            {
+                Py_DECREF(type);
+                CPPY_ERROR("Failed to add class %(name)s to Python module");
+                return false;
+            }
+            return true;
+        }
+        """
+        code = change_text_indent(code, 0)
+        member_offsets = self._render_class_member_offsets(cls)
+        if member_offsets and self.is_multi_phase:
+            # the member table is shared by all module instances, fill it in only once
+            member_offsets = "static const bool members_ready = []()\n{\n%s%sreturn true;\n}();\n" \
+                             "(void)members_ready;" % (member_offsets, INDENT)
+        member_offsets = member_offsets.strip("\n")
+        prefix = "state->" if self.is_multi_phase else ""
+        attributes = ""
+        if cls.attribute_names:
+            attributes = "if (!%s(%s))\n%sreturn false;" % (
+                cls.attribute_init_func_name, "state" if self.is_multi_phase else "", INDENT)
+        runtime_slots = self._render_class_runtime_slots(cls, "%s%s->" % (prefix, cls.state_type_name))
+        if not member_offsets:
+            code = re.sub(r"^[ \t]*%\(member_offsets\)s\n", "", code, flags=re.M)
+        if not runtime_slots:
+            code = re.sub(r"^[ \t]*%\(runtime_slots\)s\n", "", code, flags=re.M)
+        if not attributes:
+            code = re.sub(r"^[ \t]*%\(attributes\)s\n", "", code, flags=re.M)
+        bases = "reinterpret_cast<PyObject*>(%s%s)" % (prefix, cls.bases[0].state_type_name) \
+                if cls.bases else "NULL"
+        if self.is_multi_phase:
+            params = "PyObject* module, %s* state" % self.context.state_struct_name
+            create_call = "PyType_FromModuleAndSpec(module, &%s, %s)" % (cls.type_spec_name, bases)
+        else:
+            params = "PyObject* module"
+            create_call = "PyType_FromSpecWithBases(&%s, %s)" % (cls.type_spec_name, bases)
+        return apply_string_dict(code, {
+            "name": cls.py_name,
+            "func_name": cls.init_func_name,
+            "params": params,
+            "create_call": create_call,
+            "type_ref": prefix + cls.state_type_name,
+            "member_offsets": member_offsets,
+            "runtime_slots": runtime_slots.rstrip("\n"),
+            "attributes": attributes,
+        })
 
     def _render_class_init_funcs(self, cls):
         code = ""
-        if not cls.has_method("__new__"):
+        vcls = self._vectorcall_class(cls)
+        if vcls:
+            code += """
+            /* Stores the vectorcall function for %(name)s.__call__ in the instance */
+            PyObject* %(init_vectorcall_func)s(PyObject* self)
+            {
+            #if PY_VERSION_HEX >= 0x03080000
+                if (self)
+                    *reinterpret_cast<vectorcallfunc*>(
+                        reinterpret_cast<char*>(self) + %(offset_func)s()) = %(call_func)s;
+            #endif
+                return self;
+            }
+            """
+        if vcls and cls.has_method("__new__"):
+            code += """
+            /* Creates new instance of %(name)s class via the user __new__ function. */
+            PyObject* %(new_func)s(struct _typeobject * type, PyObject * args, PyObject * kwargs)
+            {
+                return %(init_vectorcall_func)s(%(user_new_func)s(type, args, kwargs));
+            }
+            """
+        elif vcls:
+            code += """
+            /* Creates new instance of %(name)s class. */
+            PyObject* %(new_func)s(struct _typeobject * type, PyObject *, PyObject *)
+            {
+                return %(init_vectorcall_func)s(%(alloc_call)s);
+            }
+            """
+        elif not cls.has_method("__new__"):
             code += """
             /* Creates new instance of %(name)s class. */
             PyObject* %(new_func)s(struct _typeobject * type, PyObject *, PyObject *)
             {
-                return PyObject_New(PyObject, type);
+                return %(alloc_call)s;
+            }
+            """
+        if cls.has_vectorcall_call() and self.is_limited_api:
+            code += """
+            /* Calls %(name)s.__call__ with an argument tuple, instances of the limited API have no vectorcall */
+            PyObject* %(class_call_func)s(PyObject* self, PyObject* args, PyObject* kwargs)
+            {
+                Py_ssize_t nargs = PyTuple_Size(args);
+                Py_ssize_t nkw = kwargs ? PyDict_Size(kwargs) : 0;
+                PyObject** stack = PyMem_New(PyObject*, nargs + nkw);
+                PyObject* kwnames = nkw ? PyTuple_New(nkw) : NULL;
+                if (!stack || (nkw && !kwnames))
+                {
+                    PyMem_Free(stack);
+                    Py_XDECREF(kwnames);
+                    return PyErr_NoMemory();
+                }
+                for (Py_ssize_t i=0; i<nargs; ++i)
+                    stack[i] = PyTuple_GetItem(args, i);
+                PyObject *key, *value;
+                Py_ssize_t pos = 0, i = 0;
+                while (nkw && PyDict_Next(kwargs, &pos, &key, &value))
+                {
+                    Py_INCREF(key);
+                    PyTuple_SetItem(kwnames, i, key);
+                    stack[nargs + i++] = value;
+                }
+                PyObject* ret = %(call_func)s(self, stack, nargs, kwnames);
+                Py_XDECREF(kwnames);
+                PyMem_Free(stack);
+                return ret;
             }
             """
-        if not cls.has_method("__dealloc__"):
+        elif cls.has_vectorcall_call():
+            code += """
+            /* Calls %(name)s.__call__ with an argument tuple, for interpreters without vectorcall */
+            PyObject* %(class_call_func)s(PyObject* self, PyObject* args, PyObject* kwargs)
+            {
+                Py_ssize_t nargs = PyTuple_GET_SIZE(args);
+                Py_ssize_t nkw = kwargs ? PyDict_Size(kwargs) : 0;
+                if (!nkw)
+                    return %(call_func)s(self, &PyTuple_GET_ITEM(args, 0), nargs, NULL);
+
+                PyObject** stack = PyMem_New(PyObject*, nargs + nkw);
+                PyObject* kwnames = PyTuple_New(nkw);
+                if (!stack || !kwnames)
+                {
+                    PyMem_Free(stack);
+                    Py_XDECREF(kwnames);
+                    return PyErr_NoMemory();
+                }
+                for (Py_ssize_t i=0; i<nargs; ++i)
+                    stack[i] = PyTuple_GET_ITEM(args, i);
+                PyObject *key, *value;
+                Py_ssize_t pos = 0, i = 0;
+                while (PyDict_Next(kwargs, &pos, &key, &value))
+                {
+                    Py_INCREF(key);
+                    PyTuple_SET_ITEM(kwnames, i, key);
+                    stack[nargs + i++] = value;
+                }
+                PyObject* ret = %(call_func)s(self, stack, nargs, kwnames);
+                Py_DECREF(kwnames);
+                PyMem_Free(stack);
+                return ret;
+            }
+            """
+        if cls.is_gc() and cls.has_method("__dealloc__"):
+            code += """
+            /* Untracks a %(name)s instance from the garbage collector before deleting it */
+            void %(dealloc_func)s(PyObject* self)
+            {
+                PyObject_GC_UnTrack(self);
+                %(user_dealloc_func)s(self);
+            }
+            """
+        elif cls.is_gc() and cls.get_inherited_method("__clear__"):
+            code += """
+            /* Deletes a %(name)s instance */
+            void %(dealloc_func)s(PyObject* self)
+            {
+                PyObject_GC_UnTrack(self);
+                %(clear_func)s(self);
+                %(free_self)s;
+            }
+            """
+        elif cls.is_gc():
             code += """
             /* Deletes a %(name)s instance */
             void %(dealloc_func)s(PyObject* self)
             {
-                self->ob_type->tp_free(self);
+                PyObject_GC_UnTrack(self);
+                %(free_self)s;
+            }
+            """
+        elif not cls.has_method("__dealloc__"):
+            code += """
+            /* Deletes a %(name)s instance */
+            void %(dealloc_func)s(PyObject* self)
+            {
+                %(free_self)s;
+            }
+            """
+        if self._has_heap_types() and cls.is_gc():
+            code += """
+            /* Visits the heap type of a %(name)s instance, which is referenced by each instance */
+            int %(traverse_func)s(PyObject* self, visitproc visit, void* arg)
+            {
+                Py_VISIT(Py_TYPE(self));
+                return %(user_traverse_func)s(self, visit, arg);
             }
             """
+        clear_func = cls.get_inherited_method("__clear__")
         code %= {
             "name": cls.py_name,
             "struct_name": cls.class_struct_name,
             "type_struct": cls.type_struct_name,
             "new_func": cls.class_new_func_name,
             "dealloc_func": cls.class_dealloc_func_name,
+            "user_new_func": cls.get_method("__new__").full_c_name if cls.has_method("__new__") else "",
+            "alloc_call": "%s(type)" % cls.class_alloc_func_name if self._has_alloc_func(cls)
+                            else "PyObject_New(PyObject, type)",
+            "user_dealloc_func": cls.get_method("__dealloc__").full_c_name if cls.has_method("__dealloc__") else "",
+            "clear_func": clear_func.full_c_name if clear_func else "",
+            "init_vectorcall_func": cls.class_init_vectorcall_func_name,
+            "offset_func": vcls.get_namespace_prefix() + vcls.vectorcall_offset_func if vcls else "",
+            "call_func": cls.get_method("__call__").full_c_name if cls.has_vectorcall_call()
+                         else vcls.get_method("__call__").full_c_name if vcls else "",
+            "class_call_func": cls.class_call_func_name,
+            "free_self": "free_heap_object(self)" if self._has_heap_types() else "self->ob_type->tp_free(self)",
+            "traverse_func": cls.class_traverse_func_name,
+            "user_traverse_func": cls.get_inherited_method("__traverse__").full_c_name if cls.is_gc() else "",
         }
         return change_text_indent(code, 0)
 
@@ -712,21 +1897,88 @@ class Renderer:
         return code
 
     def _render_class_user_funcs(self, cls):
+        if self.is_multi_phase:
+            return self._render_class_heap_type_user_funcs(cls)
         code = """
-        _typeobject* %(type_func)s() { return &%(type_struct)s; }
-        %(struct)s* %(new_func)s() { return PyObject_NEW(%(struct)s, &%(type_struct)s); }
-        bool %(is_func)s(PyObject* obj) { return PyObject_TypeCheck(obj, &%(type_struct)s); }
+        _typeobject* %(type_func)s() { return %(type_ref)s; }
+        %(struct)s* %(new_func)s() { return %(new_call)s; }
+        bool %(is_func)s(PyObject* obj) { return PyObject_TypeCheck(obj, %(type_ref)s); }
         """
         code = change_text_indent(code, 0)
 
+        # the heap type created by the init function with the limited API
+        type_ref = cls.state_type_name if self.is_limited_api else "&" + cls.type_struct_name
+        new_call = "PyObject_NEW(%s, %s)" % (cls.class_struct_name, type_ref)
+        # expression returning a PyObject*
+        obj = None
+        if self._has_alloc_func(cls):
+            obj = "%s(%s)" % (cls.class_alloc_func_name, type_ref)
+        if self._vectorcall_class(cls):
+            obj = "%s(%s)" % (cls.class_init_vectorcall_func_name,
+                              obj or "reinterpret_cast<PyObject*>(%s)" % new_call)
+        if obj:
+            new_call = "reinterpret_cast<%s*>(%s)" % (cls.class_struct_name, obj)
+
         code %= {
+            "new_call": new_call,
             "struct": cls.class_struct_name,
-            "type_struct": #self._namespace_prefix(self.namespaces) +
-                           cls.type_struct_name,
+            "type_ref": type_ref,
             "new_func": cls.user_new_func,
             "is_func": cls.user_is_func,
             "type_func": cls.user_type_func,
         }
+        if cls.attribute_names:
+            code += self._render_class_attribute_id_func(cls)
+        return code
+
+    def _render_class_heap_type_user_funcs(self, cls):
+        """The helper functions with multi-phase initialization, which find the
+        heap type through the module state of an object of the same module"""
+        code = """
+        _typeobject* %(type_func)s(PyObject* self)
+        {
+            %(state)s* state = %(state_func)s(self);
+            return state ? state->%(state_type)s : NULL;
+        }
+        %(struct)s* %(new_func)s(PyObject* self)
+        {
+            _typeobject* type = %(type_func)s(self);
+            if (!type)
+            {
+                PyErr_SetString(PyExc_TypeError, "%(new_func)s() needs an object of module %(module)s");
+                return NULL;
+            }
+            return %(new_call)s;
+        }
+        bool %(is_func)s(PyObject* obj)
+        {
+            _typeobject* type = %(type_func)s(obj);
+            return type && PyObject_TypeCheck(obj, type);
+        }
+        """
+        code = change_text_indent(code, 0)
+        new_call = "PyObject_New(%s, type)" % cls.class_struct_name
+        obj = None
+        if self._has_alloc_func(cls):
+            obj = "%s(type)" % cls.class_alloc_func_name
+        if cls.get_vectorcall_class():
+            obj = "%s(%s)" % (cls.class_init_vectorcall_func_name,
+                              obj or "reinterpret_cast<PyObject*>(%s)" % new_call)
+        if obj:
+            new_call = "reinterpret_cast<%s*>(%s)" % (cls.class_struct_name, obj)
+        code = apply_string_dict(code, {
+            "new_call": new_call,
+            "struct": cls.class_struct_name,
+            "state": self.context.state_struct_name,
+            "state_func": self._module_state_func_name(),
+            "state_type": cls.state_type_name,
+            "module": self.context.module_name,
+            "new_func": cls.user_new_func,
+            "is_func": cls.user_is_func,
+            "type_func": cls.user_type_func,
+        })
+        if cls.attribute_names:
+            code += self._render_class_attribute_id_func(cls)
         return code
 
     def _namespace_prefix(self, ns):
@@ -801,7 +2053,7 @@ class Renderer:
         code = apply_string_dict(code, {
             "lolpig_head": self._lolpig_head(),
             "lolpig_macro": macro,
-            "default_inc": self.default_inc,
+            "default_inc": self._python_inc(),
             "module_name": self.context.module_name,
             "namespace_open": self._render_namespace_open(self.namespaces),
             "namespace_close": self._render_namespace_close(self.namespaces),
@@ -0,0 +1,311 @@
+import os, sys, shutil, tempfile, subprocess, unittest
+from unittest import TestCase
+from liblolpig import Context, Class, Function, Argument, Renderer
+from liblolpig.cmdline import Arguments
+from liblolpig.manifest import Manifest
+
+
+class TestArguments(TestCase):
+
+    def _parse(self, *args):
+        a = Arguments()
+        a.parse(["lolpig"] + list(args))
+        return a
+
+    def test_switches(self):
+        a = self._parse("-i", "x.h", "x.cpp", "-o", "out", "-m", "vec", "-n", "MOP", "-j", "2")
+        self.assertTrue(a.ok, a.error_txt)
+        self.assertEqual(["x.h", "x.cpp"], a.input_filenames)
+        self.assertEqual("out.cpp", a.output_cpp)
+        self.assertEqual("out.h", a.output_hpp)
+        self.assertEqual("vec", a.module_name)
+        self.assertEqual(["MOP"], a.namespaces)
+        self.assertEqual(2, a.jobs)
+        self.assertEqual("none", a.stamp)
+
+    def test_trailing_flags(self):
+        a = self._parse("-i", "x.h", "-o", "out", "-instrument")
+        self.assertTrue(a.ok, a.error_txt)
+        self.assertTrue(a.is_instrumented)
+
+        a = self._parse("-i", "x.h", "-o", "out", "-abi3")
+        self.assertTrue(a.ok, a.error_txt)
+        self.assertTrue(a.is_limited_api)
+        self.assertTrue(a.is_shared_lib)
+
+        a = self._parse("-i", "x.h", "-o", "out", "-force", "-multiphase", "-quiet")
+        self.assertTrue(a.is_force)
+        self.assertTrue(a.is_multi_phase)
+        self.assertTrue(a.is_quiet)
+        self.assertFalse(a.is_per_interpreter_gil)
+
+        a = self._parse("-i", "x.h", "-o", "out", "-profilemem")
+        self.assertTrue(a.is_profile)
+        self.assertTrue(a.is_profile_memory)
+
+        a = self._parse("-i", "x.h", "-o", "out", "-owngil")
+        self.assertTrue(a.ok, a.error_txt)
+        self.assertTrue(a.is_per_interpreter_gil)
+        self.assertTrue(a.is_multi_phase)
+
+    def test_flags_after_unlimited_params(self):
+        a = self._parse("-o", "out", "-i", "x.h", "y.h", "-shared")
+        self.assertTrue(a.ok, a.error_txt)
+        self.assertEqual(["x.h", "y.h"], a.input_filenames)
+        self.assertTrue(a.is_shared_lib)
+
+    def test_errors(self):
+        self.assertFalse(self._parse("-i", "x.h", "-o", "out", "-unknown").ok)
+        self.assertFalse(self._parse("-i", "x.h", "-o", "out", "-abi3", "-multiphase").ok)
+        self.assertFalse(self._parse("-i", "x.h").ok)
+
+
+class TestManifest(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.source = self._write("a.cpp", "#include \"a.h\"")
+        self.header = self._write("a.h", "struct A;")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _write(self, name, text):
+        fn = os.path.join(self.directory, name)
+        with open(fn, "w") as f:
+            f.write(text)
+        return fn
+
+    def _manifest(self):
+        m = Manifest(os.path.join(self.directory, "module.lolpig"))
+        m.update_hashes([self.source])
+        return m
+
+    def test_unit_dependencies(self):
+        old = self._manifest()
+        old.add_unit(self.source, [self.source], Context(), [self.header])
+        old.save()
+        old = Manifest.load(old.filename)
+        self.assertEqual((self.header,), old.get_unit_dependencies(self.source))
+
+        current = self._manifest()
+        self.assertTrue(old.is_up_to_date(current))
+        self.assertIsNotNone(old.get_unit(self.source, current))
+
+        # only the included header changes
+        self._write("a.h", "struct A { int a; };")
+        current = self._manifest()
+        self.assertFalse(old.is_up_to_date(current))
+        self.assertIsNone(old.get_unit(self.source, current))
+
+        os.remove(self.header)
+        self.assertIsNone(old.get_unit(self.source, self._manifest()))
+
+
+class TestRenderer(TestCase):
+
+    def test_limited_api_vectorcall(self):
+        ctx = Context()
+        ctx.module_name = "vc"
+        ctx.header_name = "vc_module.h"
+        cls = Class()
+        cls.py_name, cls.c_name = "Vec", "Vec"
+        f = Function()
+        f.py_name, f.c_name, f.c_return_type = "Vec.__vectorcall__", "vec_vectorcall", "PyObject*"
+        f.arguments = [Argument("PyObject*", "type"), Argument("PyObject*const*", "args"),
+                       Argument("size_t", "nargsf"), Argument("PyObject*", "kwnames")]
+        cls.methods.append(f)
+        ctx.classes.append(cls)
+        ctx.finalize()
+        r = Renderer(ctx)
+        r.render_cpp()
+        r.is_limited_api = True
+        r.is_shared_lib = True
+        with self.assertRaises(ValueError):
+            r.render_cpp()
+
+
+def _compiler_available():
+    """Returns True if extension modules can be built here"""
+    try:
+        import setuptools
+    except ImportError:
+        return False
+    return bool(shutil.which("c++") or shutil.which("g++"))
+
+
+def _build_module(ctx, impl, directory, **settings):
+    """Renders the Context as extension module with the C++ implementation impl
+    and builds it in directory with the generated setuptools script"""
+    r = Renderer(ctx)
+    r.is_timestamp = False
+    r.is_shared_lib = True
+    for key, value in settings.items():
+        setattr(r, key, value)
+    with open(os.path.join(directory, ctx.header_name), "w") as f:
+        f.write(r.render_hpp())
+    with open(os.path.join(directory, "module.cpp"), "w") as f:
+        f.write(r.render_cpp())
+    with open(os.path.join(directory, "impl.cpp"), "w") as f:
+        f.write(impl)
+    with open(os.path.join(directory, "setup.py"), "w") as f:
+        f.write(r.render_setup_py(["module.cpp", "impl.cpp"], ["."]))
+    subprocess.check_call([sys.executable, "setup.py", "-q", "build_ext", "--inplace"],
+                          cwd=directory, stdout=subprocess.DEVNULL)
+
+
+def _run_script(directory, script):
+    """Runs the python script in a new interpreter, which imports from directory"""
+    return subprocess.run([sys.executable, "-c", script], cwd=directory,
+                          stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+
+
+class BuildTestCase(TestCase):
+    """Builds the module of _context() with the implementation IMPL and runs SCRIPT with it"""
+
+    IMPL = ""
+    SCRIPT = ""
+
+    def _context(self):
+        raise NotImplementedError
+
+    def _test_build(self, **settings):
+        directory = tempfile.mkdtemp()
+        try:
+            _build_module(self._context(), self.IMPL, directory, **settings)
+            result = _run_script(directory, self.SCRIPT)
+            self.assertEqual(0, result.returncode, result.stdout)
+        finally:
+            shutil.rmtree(directory)
+
+
+@unittest.skipUnless(_compiler_available(), "needs setuptools and a c++ compiler")
+class TestRichCompare(BuildTestCase):
+    """The comparison operators of a class and it's bases in a built module"""
+
+    IMPL = """
+#include "cmp_module.h"
+
+struct Base { PyObject_HEAD };
+struct Derived : public Base { };
+size_t sizeof_Base() { return sizeof(Base); }
+size_t sizeof_Derived() { return sizeof(Derived); }
+
+PyObject* base_lt(PyObject*, PyObject*) { Py_RETURN_TRUE; }
+PyObject* derived_eq(PyObject*, PyObject*) { Py_RETURN_TRUE; }
+"""
+
+    SCRIPT = """
+import cmp
+a, b = cmp.Derived(), cmp.Derived()
+assert cmp.Base() < cmp.Base()
+assert a < b, "inherited __lt__"
+assert a == b, "own __eq__"
+try:
+    a <= b
+except TypeError:
+    pass
+else:
+    raise AssertionError("__le__ is not implemented")
+"""
+
+    def _context(self):
+        ctx = Context()
+        ctx.module_name = "cmp"
+        ctx.header_name = "cmp_module.h"
+        base, derived = Class(), Class()
+        base.py_name, base.c_name = "Base", "Base"
+        derived.py_name, derived.c_name = "Derived", "Derived"
+        derived.bases = [base]
+        for cls, name, c_name in ((base, "__lt__", "base_lt"), (derived, "__eq__", "derived_eq")):
+            f = Function()
+            f.py_name, f.c_name, f.c_return_type = "%s.%s" % (cls.py_name, name), c_name, "PyObject*"
+            f.arguments = [Argument("PyObject*", "self"), Argument("PyObject*", "other")]
+            cls.methods.append(f)
+            ctx.classes.append(cls)
+        ctx.finalize()
+        return ctx
+
+    def test_static_types(self):
+        self._test_build()
+
+    def test_multi_phase(self):
+        self._test_build(is_multi_phase=True)
+
+    def test_limited_api(self):
+        self._test_build(is_limited_api=True)
+
+
+@unittest.skipUnless(_compiler_available(), "needs setuptools and a c++ compiler")
+class TestVectorcallNew(BuildTestCase):
+    """Construction through a class __vectorcall__ instead of __new__/__init__"""
+
+    IMPL = """
+#include "vc_module.h"
+
+struct Vec { PyObject_HEAD double x; };
+size_t sizeof_Vec() { return sizeof(Vec); }
+
+PyObject* vec_vectorcall(PyObject* type, PyObject* const* args, size_t nargsf, PyObject*)
+{
+    if (PyVectorcall_NARGS(nargsf) != 1)
+    {
+        PyErr_SetString(PyExc_TypeError, "Vec() takes one argument");
+        return NULL;
+    }
+    double x = PyFloat_AsDouble(args[0]);
+    if (x == -1. && PyErr_Occurred())
+        return NULL;
+    Vec* vec = reinterpret_cast<Vec*>(PyType_GenericAlloc(reinterpret_cast<PyTypeObject*>(type), 0));
+    if (vec)
+        vec->x = x;
+    return reinterpret_cast<PyObject*>(vec);
+}
+
+int vec_init(PyObject* self, PyObject*, PyObject*)
+{
+    reinterpret_cast<Vec*>(self)->x = 42.;
+    return 0;
+}
+
+PyObject* vec_get_x(PyObject* self)
+{
+    return PyFloat_FromDouble(reinterpret_cast<Vec*>(self)->x);
+}
+"""
+
+    SCRIPT = """
+import vc
+assert vc.Vec(3.0).get_x() == 3.0, "__vectorcall__ is not used"
+try:
+    vc.Vec()
+except TypeError:
+    pass
+else:
+    raise AssertionError("no argument check")
+"""
+
+    def _context(self):
+        ctx = Context()
+        ctx.module_name = "vc"
+        ctx.header_name = "vc_module.h"
+        cls = Class()
+        cls.py_name, cls.c_name = "Vec", "Vec"
+        for name, c_name, ret, args in (
+                ("__vectorcall__", "vec_vectorcall", "PyObject*",
+                 [("PyObject*", "type"), ("PyObject*const*", "args"), ("size_t", "nargsf"), ("PyObject*", "kwnames")]),
+                ("__init__", "vec_init", "int", [("PyObject*", "self"), ("PyObject*", "args"), ("PyObject*", "kwargs")]),
+                ("get_x", "vec_get_x", "PyObject*", [("PyObject*", "self")])):
+            f = Function()
+            f.py_name, f.c_name, f.c_return_type = "Vec.%s" % name, c_name, ret
+            f.arguments = [Argument(t, n) for t, n in args]
+            cls.methods.append(f)
+        ctx.classes.append(cls)
+        ctx.finalize()
+        return ctx
+
+    def test_static_types(self):
+        self._test_build()
+
+    def test_multi_phase(self):
+        self._test_build(is_multi_phase=True)
@@ -167,6 +167,31 @@ PyObject* vec_getitem(PyObject* self, Py_ssize_t idx)
     return toPython(vec->v[idx]);
 }
 
+/** @ingroup lolpig
+    @p vec.__getitem__
+    Index and slice access
+*/
+PyObject* vec_subscript(PyObject* self, PyObject* key)
+{
+    VectorBase* vec = pyobject_cast<VectorBase*>(self);
+    if (PySlice_Check(key))
+    {
+        Py_ssize_t start, stop, step, len;
+        if (PySlice_GetIndicesEx(key, vec->len, &start, &stop, &step, &len) < 0)
+            return NULL;
+        return pyobject_cast<PyObject*>(
+                    createVector(len, len ? &vec->v[start] : NULL, step));
+    }
+    Py_ssize_t idx = PyNumber_AsSsize_t(key, PyExc_IndexError);
+    if (idx == -1 && PyErr_Occurred())
+        return NULL;
+    if (idx < 0)
+        idx += vec->len;
+    if (!checkIndex(idx, vec->len))
+        return NULL;
+    return toPython(vec->v[idx]);
+}
+
 /** @ingroup lolpig
     @p vec.__setitem__
 */
@@ -189,6 +214,25 @@ Py_ssize_t vec_len(PyObject* self)
     return vec->len;
 }
 
+/** @ingroup lolpig
+    @p vec.__getbuffer__
+    Exposes the elements as a contiguous buffer of doubles
+*/
+int vec_getbuffer(PyObject* self, Py_buffer* view, int flags)
+{
+    VectorBase* vec = pyobject_cast<VectorBase*>(self);
+    if (PyBuffer_FillInfo(view, self, vec->v, vec->len * sizeof(double), 0, flags) < 0)
+        return -1;
+    view->itemsize = sizeof(double);
+    view->format = (flags & PyBUF_FORMAT) ? const_cast<char*>("d") : NULL;
+    if (flags & PyBUF_ND)
+    {
+        vec->shape = vec->len;
+        view->shape = &vec->shape;
+    }
+    return 0;
+}
+
 
 /** @ingroup lolpig
     @p vec.__iter__
@@ -234,14 +278,24 @@ PyObject* veciter_next(PyObject* self)
 }
 
 /** @ingroup lolpig
-    @p _vec_iter.__dealloc__
+    @p _vec_iter.__traverse__
+*/
+int veciter_traverse(PyObject* self, visitproc visit, void* arg)
+{
+    VectorIter* iter = pyobject_cast<VectorIter*>(self);
+    Py_VISIT(iter->vec);
+    return 0;
+}
+
+/** @ingroup lolpig
+    @p _vec_iter.__clear__
 */
-void veciter_dealloc(PyObject* self)
+int veciter_clear(PyObject* self)
 {
     VectorIter* iter = pyobject_cast<VectorIter*>(self);
-    //PRINT("DEALLOC " << iter->toString());
+    //PRINT("CLEAR " << iter->toString());
     Py_CLEAR(iter->vec);
-    self->ob_type->tp_free(self);
+    return 0;
 }
 
 // ------------ attributes ----------------
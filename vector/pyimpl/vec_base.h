@@ -45,6 +45,8 @@ extern "C" {
         PyObject_HEAD
         double* v;
         int len;
+        /** len as shape of the exported buffer */
+        Py_ssize_t shape;
 
         void alloc(int len);
         void dealloc();
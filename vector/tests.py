@@ -108,6 +108,14 @@ class TestVec(TestCase):
         with self.assertRaises(IndexError):
             a[-4]
 
+    def test_getitem_slice(self):
+        a = vec(1,2,3,4)
+        self.assertEqual(vec(2,3), a[1:3])
+        self.assertEqual(vec3(1,2,3), a[:3])
+        self.assertEqual(vec(1,3), a[::2])
+        self.assertEqual(vec(4,3,2,1), a[::-1])
+        self.assertEqual(0, len(a[2:2]))
+
     def test_setitem(self):
         a = vec(0,0,0)
         a[0] = 1
@@ -157,6 +165,13 @@ class TestVec(TestCase):
         self.assertEqual([1,2,3], [x for x in vec(1,2,3)])
         self.assertEqual([3,2,1], [x for x in reversed(vec(1, 2, 3))])
 
+    def test_buffer(self):
+        self.assertEqual([1,2,3], memoryview(vec(1,2,3)).tolist())
+        self.assertEqual("d", memoryview(vec(1,2,3)).format)
+        v = vec(1,2,3)
+        memoryview(v)[1] = 5
+        self.assertEqual(vec(1,5,3), v)
+
     def test_split(self):
         self.assertEqual([vec(1,2),vec(3,4)],   vec(1,2,3,4).split(2))
         self.assertEqual([vec3(1,2,3),vec(4)],  vec(1,2,3,4).split(3))